@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Multi-session analysis
+
+Summarizes any number of session data files (the ..._data-Phase<n>.csv files
+written by MainScreen.write_comp_data) at once. Each file is read into NumPy
+column arrays (one array per data column) and every metric is worked out with
+array operations over the whole session, grouped by trial, instead of row by
+row. Files are spread over a process pool, so a whole cohort's history is
+summarized in seconds.
+
+Three tables are written (as .csv, next to each other):
+
+    <output>_trials.csv   -> one row per trial attempt: key/background/ITI
+                             peck counts, latency to the first key peck, mean
+                             and SD of the pecks' CenterPythDist, whether the
+                             attempt was reinforced by a peck or by the
+                             auto-timer, the background peck rate, and (phase
+                             2) the choice. A wrong choice in phase 2 is
+                             followed by correction trials with the same
+                             TrialNum; each is an attempt of its own
+                             (Attempt 1, 2, ...; CorrectionTrial = 1), timed
+                             from the end of the attempt before it.
+    <output>_stimuli.csv  -> one row per subject, phase and stimulus (the
+                             center stimulus in phases 0/1; each choice
+                             stimulus or SBE color in phase 2), pooled over
+                             all of that subject's sessions
+    <output>_sessions.csv -> one row per session file (Trials counts trials,
+                             Attempts also counts correction trials)
+
+Usage (from this folder):
+
+    python P039_Analysis.py <data folder> [--subjects A B] [--phases 1 2]
+                            [--processes 4] [--output P039_summary]
+
+Needs NumPy.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from csv import reader, writer
+from glob import glob
+from os import path as os_path
+from time import perf_counter
+
+import numpy as np
+
+from P039_DataWriter import DATA_HEADER_LIST, DATA_COLUMN_KINDS
+from P039_Catalog import SESSION_FILE_PATTERN
+
+# Columns read as numbers ("NA" -> NaN); everything else is kept as text
+NUMERIC_COLUMNS = [name for name, kind in zip(DATA_HEADER_LIST, DATA_COLUMN_KINDS)
+                   if kind in ["int", "float"]]
+
+TRIAL_COLUMNS = ["Subject", "SessionStart", "Phase", "TrialNum", "Attempt", "TrialType",
+                 "CenterStim", "LeftStim", "RightStim", "CorrectionTrial",
+                 "KeyPecks", "BackgroundPecks", "ITIPecks", "FirstPeckLatency",
+                 "CenterDistMean", "CenterDistSD", "PeckReinforced",
+                 "AutoReinforced", "TrialDuration", "BackgroundPeckRate",
+                 "Choice", "ChoiceCorrect"]
+
+# Counts (and 0/1 flags), written as integers in every table. NumPy works
+# them out as floats (see group_stat).
+INTEGER_COLUMNS = ["Phase", "TrialNum", "Attempt", "CorrectionTrial", "Trials",
+                   "Attempts", "KeyPecks",
+                   "BackgroundPecks", "ITIPecks", "PeckReinforced", "AutoReinforced"]
+
+
+def find_session_files(data_folder, subjects = None, phases = None):
+    # Returns the paths of every session data file in <data folder>/<subject>/
+    # (optionally only for some subjects and phases), sorted
+    paths = []
+    for file_path in glob(os_path.join(data_folder, "*", "*_data-Phase*.csv")):
+        match = SESSION_FILE_PATTERN.match(os_path.basename(file_path))
+        if match is None:
+            continue # e.g., the latency reports
+        if subjects and match["subject"] not in subjects:
+            continue
+        if phases is not None and int(match["phase"]) not in phases:
+            continue
+        paths.append(file_path)
+    return sorted(paths)
+
+
+def load_session(file_path):
+    # Reads a session data file into {column name: NumPy array}. Number
+    # columns are float arrays (NaN for "NA"), the others are str arrays.
+    with open(file_path, newline='') as f:
+        rows = list(reader(f))
+    header, rows = rows[0], rows[1:]
+    if rows:
+        columns = [np.array(column) for column in zip(*rows)]
+    else:
+        columns = [np.array([], dtype=str) for name in header]
+    data = dict(zip(header, columns))
+    for name in NUMERIC_COLUMNS:
+        if name in data:
+            column = data[name]
+            data[name] = np.where((column == "NA") | (column == ""), "nan", column).astype(float)
+    return data
+
+
+def group_stat(inverse, n_groups, values, mask, how):
+    # One value per group (trial) from values[mask]: "count", "sum",
+    # "min", "max", "mean" or "sd" (NaN where a group has no values)
+    mask = mask & ~np.isnan(values) if how != "count" else mask
+    counts = np.bincount(inverse[mask], minlength = n_groups).astype(float)
+    if how == "count":
+        return counts
+    if how in ["min", "max"]:
+        result = np.full(n_groups, np.nan)
+        (np.fmin if how == "min" else np.fmax).at(result, inverse[mask], values[mask])
+        return result
+    sums = np.bincount(inverse[mask], weights = values[mask], minlength = n_groups)
+    if how == "sum":
+        return sums
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        means = sums / counts
+        if how == "mean":
+            return means
+        squares = np.bincount(inverse[mask], weights = values[mask] ** 2,
+                              minlength = n_groups)
+        variances = (squares - counts * means ** 2) / (counts - 1)
+    return np.sqrt(np.clip(variances, 0, None)) # sd (sample)
+
+
+def first_in_group(inverse, n_groups, values):
+    # The first value of each group (in file order)
+    first = np.full(n_groups, -1)
+    order = np.arange(len(inverse))[::-1]
+    first[inverse[order]] = order # Later writes (earlier rows) win
+    return values[first]
+
+
+def summarize_session(file_path):
+    # Returns {column: array} with one entry per trial attempt of a session
+    # (see TRIAL_COLUMNS). Runs in a worker process.
+    match = SESSION_FILE_PATTERN.match(os_path.basename(file_path))
+    data = load_session(file_path)
+    trial_nums = data["TrialNum"]
+    in_trial = ~np.isnan(trial_nums) & (trial_nums > 0)
+    data = {name: column[in_trial] for name, column in data.items()}
+    events = data["EventType"]
+    phase = int(match["phase"])
+
+    # Trial numbers only go up during a session, so rows group by trial. A
+    # trial's attempt is the number of wrong choices before the row in that
+    # trial (the CorrectionTrial column can't be used: it is reset on the
+    # hopper rows).
+    trial_nums = data["TrialNum"]
+    incorrect = (events == "incorrect_choice").astype(int)
+    trial_start = np.r_[True, trial_nums[1:] != trial_nums[:-1]]
+    incorrect_before = np.cumsum(incorrect) - incorrect
+    attempt = incorrect_before - incorrect_before[trial_start][np.cumsum(trial_start) - 1]
+    groups, inverse = np.unique(np.column_stack([trial_nums, attempt]), axis = 0,
+                                return_inverse = True)
+    inverse = inverse.reshape(-1)
+    trials, attempts = groups[:, 0], groups[:, 1].astype(int)
+    n = len(trials)
+
+    key_peck = np.char.endswith(events, "_key_peck")
+    background_peck = events == "background_peck"
+    # The stimulus is shown in substage 2 in phases 0/1 and substage 1 in phase 2
+    response_stage = 1 if phase == 2 else 2
+    response_peck = key_peck & (data["TrialSubStage"] == response_stage)
+    all_rows = np.ones(len(events), dtype=bool)
+
+    trial_time = np.where(data["TrialTime"] >= 0, data["TrialTime"], np.nan)
+    # TrialTime runs on through a trial's attempts, so each one is timed
+    # from the end of the one before (groups are sorted by trial, attempt)
+    attempt_end = group_stat(inverse, n, trial_time, all_rows, "max")
+    trial_duration = attempt_end - np.where(attempts > 0, np.r_[np.nan, attempt_end[:-1]], 0)
+    background_pecks = group_stat(inverse, n, trial_time, background_peck, "count")
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        background_rate = np.where(trial_duration > 0,
+                                   background_pecks / (trial_duration / 60), np.nan)
+
+    if phase == 2:
+        left_choice = group_stat(inverse, n, trial_time, events == "left_stimulus_choice", "count")
+        right_choice = group_stat(inverse, n, trial_time, events == "right_stimulus_choice", "count")
+        choice = np.where(left_choice > 0, "left", np.where(right_choice > 0, "right", "NA"))
+        correct = group_stat(inverse, n, trial_time, events == "correct_choice", "count")
+        incorrect = group_stat(inverse, n, trial_time, events == "incorrect_choice", "count")
+        choice_correct = np.where(correct > 0, 1.0, np.where(incorrect > 0, 0.0, np.nan))
+    else:
+        choice = np.full(n, "NA")
+        choice_correct = np.full(n, np.nan)
+
+    return {
+        "Subject": np.full(n, match["subject"]),
+        "SessionStart": np.full(n, match["start"]),
+        "Phase": np.full(n, phase),
+        "TrialNum": trials.astype(int),
+        "Attempt": attempts,
+        "TrialType": first_in_group(inverse, n, data["TrialType"]),
+        "CenterStim": first_in_group(inverse, n, data["CenterStim"]),
+        "LeftStim": first_in_group(inverse, n, data["LeftStim"]),
+        "RightStim": first_in_group(inverse, n, data["RightStim"]),
+        "CorrectionTrial": (attempts > 0).astype(int),
+        "KeyPecks": group_stat(inverse, n, trial_time, key_peck, "count"),
+        "BackgroundPecks": background_pecks,
+        "ITIPecks": group_stat(inverse, n, trial_time, events == "ITI_peck", "count"),
+        "FirstPeckLatency": group_stat(inverse, n, data["TrialSubStageTimer"], response_peck, "min"),
+        "CenterDistMean": group_stat(inverse, n, data["CenterPythDist"], key_peck, "mean"),
+        "CenterDistSD": group_stat(inverse, n, data["CenterPythDist"], key_peck, "sd"),
+        "PeckReinforced": (group_stat(inverse, n, trial_time, events == "reinforcer_provided", "count") > 0).astype(int),
+        "AutoReinforced": (group_stat(inverse, n, trial_time, events == "auto_reinforcer_provided", "count") > 0).astype(int),
+        "TrialDuration": trial_duration,
+        "BackgroundPeckRate": background_rate,
+        "Choice": choice,
+        "ChoiceCorrect": choice_correct,
+        }
+
+
+def concatenate(tables):
+    # Joins {column: array} tables with the same columns end to end
+    if not tables:
+        return {name: np.array([]) for name in TRIAL_COLUMNS}
+    return {name: np.concatenate([t[name] for t in tables]) for name in tables[0]}
+
+
+def summarize_stimuli(trials):
+    # Pools the trial table by subject, phase and stimulus. In phase 2 each
+    # trial attempt counts for both of its stimuli (with Chosen = 1 for the one
+    # picked); SBE trials are listed under their key colors.
+    phase = trials["Phase"]
+    center = phase != 2
+    sides = [(center, trials["CenterStim"], np.full(len(phase), np.nan))]
+    for side in ["Left", "Right"]:
+        chosen = np.where(trials["Choice"] == side.lower(), 1.0,
+                          np.where(trials["Choice"] == "NA", np.nan, 0.0))
+        sides.append((~center, trials[f"{side}Stim"], chosen))
+    rows = np.concatenate([np.nonzero(mask)[0] for mask, _, _ in sides])
+    stimulus = np.concatenate([names[mask] for mask, names, _ in sides])
+    chosen = np.concatenate([values[mask] for mask, _, values in sides])
+
+    keys = np.char.add(np.char.add(trials["Subject"][rows], "\t"),
+                       np.char.add(np.char.add(trials["Phase"][rows].astype(str), "\t"),
+                                   stimulus))
+    groups, inverse = np.unique(keys, return_inverse = True)
+    n = len(groups)
+    everything = np.ones(len(rows), dtype=bool)
+
+    def stat(column, how, values = None):
+        values = trials[column][rows] if values is None else values
+        return group_stat(inverse, n, values, everything, how)
+
+    peck = stat("PeckReinforced", "sum")
+    auto = stat("AutoReinforced", "sum")
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        peck_reinforced_rate = peck / (peck + auto)
+    split = [g.split("\t") for g in groups]
+    return {
+        "Subject": np.array([s[0] for s in split]),
+        "Phase": np.array([int(s[1]) for s in split]),
+        "Stimulus": np.array([s[2] for s in split]),
+        "Trials": group_stat(inverse, n, trials["KeyPecks"][rows],
+                             trials["Attempt"][rows] == 0, "count"),
+        "Attempts": stat("KeyPecks", "count"),
+        "KeyPecksMean": stat("KeyPecks", "mean"),
+        "FirstPeckLatencyMean": stat("FirstPeckLatency", "mean"),
+        "CenterDistSDMean": stat("CenterDistSD", "mean"),
+        "PeckReinforcedRate": peck_reinforced_rate,
+        "AutoReinforcedRate": auto / stat("KeyPecks", "count"),
+        "BackgroundPeckRateMean": stat("BackgroundPeckRate", "mean"),
+        "ChoiceProportion": group_stat(inverse, n, chosen, everything, "mean"),
+        }
+
+
+def summarize_sessions(trials):
+    # One row per session (subject + session start + phase)
+    keys = np.char.add(np.char.add(trials["Subject"], "\t"),
+                       np.char.add(np.char.add(trials["SessionStart"], "\t"),
+                                   trials["Phase"].astype(str)))
+    groups, inverse = np.unique(keys, return_inverse = True)
+    n = len(groups)
+    everything = np.ones(len(keys), dtype=bool)
+
+    def stat(column, how):
+        return group_stat(inverse, n, trials[column].astype(float), everything, how)
+
+    split = [g.split("\t") for g in groups]
+    return {
+        "Subject": np.array([s[0] for s in split]),
+        "SessionStart": np.array([s[1] for s in split]),
+        "Phase": np.array([int(s[2]) for s in split]),
+        "Trials": group_stat(inverse, n, trials["KeyPecks"], trials["Attempt"] == 0, "count"),
+        "Attempts": stat("KeyPecks", "count"),
+        "KeyPecks": stat("KeyPecks", "sum"),
+        "BackgroundPecks": stat("BackgroundPecks", "sum"),
+        "ITIPecks": stat("ITIPecks", "sum"),
+        "FirstPeckLatencyMean": stat("FirstPeckLatency", "mean"),
+        "PeckReinforced": stat("PeckReinforced", "sum"),
+        "AutoReinforced": stat("AutoReinforced", "sum"),
+        "BackgroundPeckRateMean": stat("BackgroundPeckRate", "mean"),
+        "ChoiceCorrectMean": stat("ChoiceCorrect", "mean"),
+        }
+
+
+def summarize_cohort(file_paths, processes = None):
+    # Summarizes every session in a process pool; returns the trial,
+    # stimulus and session tables
+    if processes == 1:
+        tables = [summarize_session(p) for p in file_paths]
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            tables = list(pool.map(summarize_session, file_paths,
+                                   chunksize = max(1, len(file_paths) // 64)))
+    trials = concatenate([t for t in tables if len(t["TrialNum"])])
+    return trials, summarize_stimuli(trials), summarize_sessions(trials)
+
+
+def format_value(value, integer = False):
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return "NA"
+        return int(value) if integer else round(float(value), 4)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def write_table(table, file_path):
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(list(table))
+        integer = [name in INTEGER_COLUMNS for name in table]
+        for row in zip(*table.values()):
+            w.writerow([format_value(v, i) for v, i in zip(row, integer)])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Summarize P039 session data files")
+    parser.add_argument("data_folder", help="Folder with one subfolder of data files per subject")
+    parser.add_argument("--subjects", nargs="*")
+    parser.add_argument("--phases", nargs="*", type=int)
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Worker processes (default: one per CPU; 1 = no pool)")
+    parser.add_argument("--output", default="P039_summary",
+                        help="Output path prefix for the three .csv tables")
+    args = parser.parse_args()
+
+    t0 = perf_counter()
+    file_paths = find_session_files(args.data_folder, args.subjects, args.phases)
+    trials, stimuli, sessions = summarize_cohort(file_paths, args.processes)
+    for name, table in [("trials", trials), ("stimuli", stimuli), ("sessions", sessions)]:
+        write_table(table, f"{args.output}_{name}.csv")
+    print(f"{len(file_paths)} session files ({int(sum(trials['Attempt'] == 0))} trials, "
+          f"{len(trials['TrialNum'])} attempts, "
+          f"{len(set(trials['Subject']))} subjects) summarized in "
+          f"{perf_counter() - t0:.2f} s -> {args.output}_*.csv")
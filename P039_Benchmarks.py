@@ -0,0 +1,881 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Benchmarks
+
+Small, self-contained timing scripts for the parts of the P039 program that
+run while a bird is in the box. None of these need the touchscreen or the
+GPIO hardware, so they can be run on a Pi (to get realistic numbers) or on
+any other computer. Usage:
+
+    python P039_Benchmarks.py iti_write
+    python P039_Benchmarks.py memory
+    python P039_Benchmarks.py session_start
+    python P039_Benchmarks.py phase1_schedule
+    python P039_Benchmarks.py stimulus_onset
+    python P039_Benchmarks.py hit_test
+    python P039_Benchmarks.py trial_fsm
+    python P039_Benchmarks.py analysis
+
+Each benchmark prints a short report to the terminal. The ones that also
+check something (hit_test, trial_fsm, analysis) exit with an error code if a check
+fails, so they can be run in CI.
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from csv import writer, QUOTE_MINIMAL
+from datetime import timedelta, date
+from filecmp import cmp
+from io import StringIO
+from math import atan2, cos, degrees, radians, sin
+from os import devnull, path as os_path
+from PIL import Image
+from random import Random
+from statistics import mean, median
+from sys import _getframe, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import start as start_tracemalloc, stop as stop_tracemalloc, \
+     get_traced_memory
+
+from P039_Stimuli import StimulusCache, StimulusBundle, read_stimulus_names, \
+     build_stimulus_bundle
+from P039_Schedule import build_phase1_schedule, build_warm_up_blocks, \
+     run_violations, ScheduleError
+from P039_Scene import CanvasScene
+from P039_DataWriter import StreamingSessionWriter, CompactEventStore, \
+     DATA_HEADER_LIST, DATA_COLUMN_KINDS
+from P039_TrialFSM import TrialStateMachine, TransitionTableError, \
+     compile_trial_table, trial_transitions, TRANSITION, IGNORED, UNEXPECTED
+
+
+def make_synthetic_trial(rng, trial_num, events_per_trial, session_start,
+                         session_time_as_text = False):
+    # Builds the data rows of a single choice task (phase 2) trial, laid out
+    # exactly like the rows MainScreen.format_data_row() produces. The old
+    # write_data() stored SessionTime as text; set session_time_as_text to
+    # mimic that.
+    rows = []
+    left_color, right_color = "#77FF00", "#FF8100"
+    for e in range(events_per_trial):
+        x, y = rng.randint(0, 1023), rng.randint(0, 767)
+        session_time = session_start + timedelta(seconds = trial_num * 60 + e * 0.25,
+                                                 microseconds = rng.randint(0, 999))
+        event_time_ns = (session_time - session_start) // timedelta(microseconds = 1) * 1000
+        if session_time_as_text:
+            session_time = str(session_time)
+        keytag = rng.choice(["left_stimulus_key", "right_stimulus_key"])
+        rows.append([
+            "TEST", date.today(), 2, "Choice Task",
+            session_time, trial_num, "SBE_trial",
+            f"{keytag}_peck", 1,
+            round(rng.uniform(0, 30), 5), round(rng.uniform(0, 30), 5), 20000,
+            x, y,
+            ((x - 512) ** 2 + (y - 584) ** 2) ** 0.5,
+            ((x - 211.5) ** 2 + (y - 374) ** 2) ** 0.5,
+            ((x - 812.5) ** 2 + (y - 374) ** 2) ** 0.5,
+            "NA", f"{left_color}_SBE", "NA", "NA", left_color,
+            f"{right_color}_SBE", "NA", "NA", right_color,
+            10, e // 2, e - e // 2, "NA", "NA", 0, "left",
+            1, "NA", "NA", "NA", 2024, event_time_ns])
+    return rows
+
+
+def full_rewrite(file_path, data_frame):
+    # The original MainScreen.write_comp_data(): rewrite everything, every ITI
+    with open(file_path, 'w', newline='') as myFile:
+        w = writer(myFile, quoting=QUOTE_MINIMAL)
+        w.writerows(data_frame)
+
+
+def summarize(label, latencies):
+    # Prints mean/median/max of a list of latencies (in seconds) as ms
+    print(f"{label:>22} | mean {mean(latencies)*1000:8.3f} ms | "
+          f"median {median(latencies)*1000:8.3f} ms | "
+          f"max {max(latencies)*1000:8.3f} ms | "
+          f"total {sum(latencies)*1000:9.1f} ms")
+
+
+def benchmark_iti_write(n_trials, events_per_trial, seed):
+    # Compares the time spent writing data on ITI entry for the old full
+    # rewrite vs. the streaming (append-only) writer across a whole session,
+    # then checks that the two final files are byte-identical.
+    rng = Random(seed)
+    session_start = timedelta(0)
+    trials = [make_synthetic_trial(rng, t, events_per_trial, session_start)
+              for t in range(1, n_trials + 1)]
+
+    with TemporaryDirectory() as tmp_dir:
+        rewrite_path = os_path.join(tmp_dir, "rewrite_data.csv")
+        stream_path = os_path.join(tmp_dir, "stream_data.csv")
+
+        rewrite_latencies = []
+        data_frame = [DATA_HEADER_LIST]
+        for trial_rows in trials:
+            data_frame.extend(trial_rows)
+            t0 = perf_counter()
+            full_rewrite(rewrite_path, data_frame)
+            rewrite_latencies.append(perf_counter() - t0)
+
+        stream_latencies = []
+        data_frame = [DATA_HEADER_LIST]
+        stream_writer = StreamingSessionWriter(stream_path)
+        for trial_rows in trials:
+            data_frame.extend(trial_rows)
+            t0 = perf_counter()
+            stream_writer.write_new_rows(data_frame, sync=True)
+            stream_latencies.append(perf_counter() - t0)
+        stream_writer.close()
+
+        identical = cmp(rewrite_path, stream_path, shallow=False)
+
+    print(f"\nITI-entry data write: {n_trials} trials x {events_per_trial} events/trial")
+    summarize("Full rewrite (old)", rewrite_latencies)
+    summarize("Streaming append", stream_latencies)
+    print(f"{'Final .csv identical':>22} | {identical}")
+    print(f"{'Late-session speedup':>22} | "
+          f"{rewrite_latencies[-1] / max(stream_latencies[-1], 1e-9):.1f}x on the last ITI")
+    print("(The old rewrite never fsynced; the streaming writer fsyncs on every ITI.)")
+
+
+def csv_text(rows):
+    # Returns the exact text csv.writer would write for these rows
+    buffer = StringIO()
+    writer(buffer, quoting=QUOTE_MINIMAL).writerows(rows)
+    return buffer.getvalue()
+
+
+def benchmark_memory(minutes, pecks_per_second, seed):
+    # Compares the memory held by the old list-of-lists data matrix with the
+    # CompactEventStore for one synthetic session, and checks that both write
+    # exactly the same .csv.
+    n_events = int(minutes * 60 * pecks_per_second)
+    events_per_trial = 60
+    n_trials = -(-n_events // events_per_trial)
+
+    # The old list-of-lists; each row is built the way write_data() used to
+    rng = Random(seed)
+    start_tracemalloc()
+    data_frame = [DATA_HEADER_LIST]
+    for t in range(1, n_trials + 1):
+        data_frame.extend(make_synthetic_trial(rng, t, events_per_trial, timedelta(0),
+                                               session_time_as_text = True))
+    list_bytes = get_traced_memory()[0]
+    stop_tracemalloc()
+
+    # The compact store, fed the same rows one at a time (as the data writer
+    # thread does), so only the store itself is left in memory afterwards
+    rng = Random(seed)
+    start_tracemalloc()
+    store = CompactEventStore(DATA_HEADER_LIST, DATA_COLUMN_KINDS)
+    for t in range(1, n_trials + 1):
+        for row in make_synthetic_trial(rng, t, events_per_trial, timedelta(0)):
+            store.append(row)
+    store_bytes = get_traced_memory()[0]
+    stop_tracemalloc()
+
+    t0 = perf_counter()
+    identical = csv_text(store[:]) == csv_text(data_frame)
+    export_time = perf_counter() - t0
+
+    print(f"\nData matrix memory: {minutes} min session at {pecks_per_second} pecks/s "
+          f"({len(store) - 1} events)")
+    print(f"{'List of lists (old)':>22} | {list_bytes / 2**20:8.2f} MiB | "
+          f"{list_bytes / (len(store) - 1):7.1f} bytes/event")
+    print(f"{'CompactEventStore':>22} | {store_bytes / 2**20:8.2f} MiB | "
+          f"{store_bytes / (len(store) - 1):7.1f} bytes/event")
+    print(f"{'Reduction':>22} | {list_bytes / store_bytes:.1f}x "
+          f"({len(store.string_table)} distinct strings, {len(store.overflow)} overflow values)")
+    print(f"{'.csv output identical':>22} | {identical} "
+          f"(both exports took {export_time*1000:.0f} ms)")
+
+
+def benchmark_session_start(stimuli_folder, assignments_csv, size, repeats):
+    # Times the stimulus loading done between the spacebar press and the
+    # first ITI for a phase 1 session (84 trials drawn from the 12 stimuli
+    # with StimulusNum 1 or 5), three ways:
+    #   1) the original code: open + resize a .jpg for every trial
+    #   2) the StimulusCache: open + resize each distinct .jpg once
+    #   3) the mmap'd bundle: no .jpg decoding at all
+    # The final conversion into Tkinter PhotoImages needs a display, so it
+    # is left out here (it is the same for all three). MainScreen prints the
+    # full spacebar-to-first-ITI setup time when a session starts.
+    names = [n for n in read_stimulus_names(assignments_csv)
+             if n.split(".")[0][-1] in "15"]
+    schedule = (names * 7)[:84]
+
+    def decode(file_path, size):
+        return Image.open(file_path).resize((size, size))
+
+    def load_uncached():
+        for name in schedule:
+            decode(os_path.join(stimuli_folder, name), size)
+
+    def load_cached():
+        cache = StimulusCache(stimuli_folder, image_factory = decode)
+        for name in schedule:
+            cache.get(name, size)
+
+    with TemporaryDirectory() as tmp_dir:
+        bundle_path = os_path.join(tmp_dir, "bundle.bin")
+        t0 = perf_counter()
+        build_stimulus_bundle(stimuli_folder, assignments_csv, size, bundle_path)
+        build_time = perf_counter() - t0
+
+        def open_bundle():
+            bundle = StimulusBundle(bundle_path)
+            bundle.is_current(stimuli_folder, read_stimulus_names(assignments_csv), size)
+            return bundle
+
+        def load_bundled(bundle):
+            cache = StimulusCache(stimuli_folder,
+                                  image_factory = lambda p, s: bundle.get_image(os_path.basename(p)))
+            for name in schedule:
+                cache.get(name, size)
+
+        results = {"Decode per trial (old)": [], "Cache, decode once": [],
+                   "Open bundle (pre-space)": [], "Load from bundle": []}
+        for r in range(repeats):
+            t0 = perf_counter(); load_uncached()
+            results["Decode per trial (old)"].append(perf_counter() - t0)
+            t0 = perf_counter(); load_cached()
+            results["Cache, decode once"].append(perf_counter() - t0)
+            t0 = perf_counter(); bundle = open_bundle()
+            results["Open bundle (pre-space)"].append(perf_counter() - t0)
+            t0 = perf_counter(); load_bundled(bundle)
+            results["Load from bundle"].append(perf_counter() - t0)
+
+    print(f"\nSpacebar-to-first-ITI stimulus loading ({len(schedule)} trials, "
+          f"{len(set(schedule))} distinct stimuli, {size} px, {repeats} repeats)")
+    for label, latencies in results.items():
+        summarize(label, latencies)
+    print(f"{'One-time bundle build':>22} | {build_time*1000:.1f} ms")
+
+
+def legacy_phase1_schedule(stimuli, probe_stimulus_order, rng, n_blocks = 6,
+                           check_whole_block = False, max_attempts = 100000):
+    # The original first_ITI() phase 1 schedule: warm-up blocks, then each
+    # main block is reshuffled until no three stimuli in a row share a
+    # training set. The original only checked positions 2-11 of each block
+    # (check_whole_block = False); check_whole_block = True checks the whole
+    # block, which is what the rejection loop would need for larger sets.
+    # Returns the schedule and the number of shuffles made (or None for the
+    # schedule if a block needed more than max_attempts shuffles).
+    schedule = build_warm_up_blocks(stimuli, probe_stimulus_order, 2, rng)
+    pool = list(stimuli)
+    shuffles = 0
+    for block in range(n_blocks):
+        for attempt in range(max_attempts):
+            shuffles += 1
+            rng.shuffle(pool)
+            last = len(pool) if check_whole_block else 12
+            if not any(pool[i]["TrainingSet"] == pool[i - 1]["TrainingSet"] ==
+                       pool[i - 2]["TrainingSet"] for i in range(2, last)):
+                break
+        else:
+            return None, shuffles
+        schedule.extend(pool)
+    return schedule, shuffles
+
+
+def make_stimulus_set(per_set_counts):
+    # Stimulus dictionaries like the assignments .csv rows; per_set_counts
+    # gives the number of stimuli in each training set (set 0 = probes)
+    return [{"Name": f"TS{s}_{n}.jpg", "TrainingSet": str(s), "StimulusNum": str(n)}
+            for s, count in enumerate(per_set_counts) for n in range(1, count + 1)]
+
+
+def benchmark_phase1_schedule(repeats, seed):
+    # Times building a phase 1 schedule the old way (rejection shuffling)
+    # and with the constraint-based generator, for the real stimulus set and
+    # for larger/uneven ones, and counts the schedules that break the "no
+    # more than two in a row from one training set" rule anywhere.
+    stimulus_sets = {"Real set (6 x 2)": make_stimulus_set([2, 2, 2, 2, 2, 2]),
+                     "6 sets x 6": make_stimulus_set([6] * 6),
+                     "Uneven (2,12,4,4,4,4)": make_stimulus_set([2, 12, 4, 4, 4, 4]),
+                     "Tight (2,16,3,3,3,3)": make_stimulus_set([2, 16, 3, 3, 3, 3])}
+    probe_stimulus_order = [1, 2]
+    rng = Random(seed)
+    print(f"\nPhase 1 schedule generation ({repeats} schedules each)")
+    for label, stimuli in stimulus_sets.items():
+        print(f"{label} ({len(stimuli)} stimuli):")
+        for method in ["Rejection (old)", "Rejection, full check", "Constraint-based"]:
+            latencies, violations, failures = [], 0, 0
+            for r in range(repeats):
+                t0 = perf_counter()
+                if method == "Constraint-based":
+                    try:
+                        schedule = build_phase1_schedule(stimuli, probe_stimulus_order,
+                                                         rng = rng)
+                    except ScheduleError:
+                        schedule = None
+                else:
+                    schedule, shuffles = legacy_phase1_schedule(stimuli, probe_stimulus_order, rng,
+                                                                check_whole_block = method != "Rejection (old)",
+                                                                max_attempts = 20000)
+                latencies.append(perf_counter() - t0)
+                if schedule is None:
+                    failures += 1
+                elif run_violations(schedule):
+                    violations += 1
+            summarize(method, latencies)
+            print(f"{'':>22} | invalid schedules: {violations}/{repeats} | "
+                  f"gave up: {failures}/{repeats}")
+
+
+def build_choice_keys(create, tag_bind, callback):
+    # Draws the phase 2 background and SBE keys (receptive fields + arcs) the
+    # way the MainScreen does; create(layout, item name, kind, *coords, **options)
+    create("background", "rect", "rectangle", 0, 0, 1024, 768, fill = "#7F7F7F",
+           outline = "#7F7F7F", tags = ("bkgrd",))
+    for side, (x, y) in {"left": (211.5, 374), "right": (812.5, 374)}.items():
+        create("SBE_keys", None, "oval", x - 175, y + 155, x + 14, y + 344,
+               outline = "#7F7F7F", fill = "#7F7F7F", tags = (f"{side}_stimulus_key",))
+        create("SBE_keys", f"{side}_arc", "arc", x - 175, y + 165, x + 95, y + 435,
+               extent = 70, outline = "black", fill = "#7F7F7F",
+               tags = (f"{side}_stimulus_key",))
+    for tag in ["bkgrd", "left_stimulus_key", "right_stimulus_key"]:
+        tag_bind(tag, "<Button-1>", callback)
+
+
+def benchmark_stimulus_onset(repeats):
+    # Times a stage change (black ITI screen -> SBE keys with new arc colors)
+    # from its start until Tk has drawn the new screen, for the old
+    # delete("all") + redraw approach and the retained scene (show/hide +
+    # itemconfigure). Needs a display; without one, the headless canvas from
+    # the simulation is used instead, which only times the Python side.
+    try:
+        from tkinter import Tk, Canvas
+        root = Tk()
+        canvas = Canvas(root, width = 1024, height = 768, highlightthickness = 0)
+        canvas.pack()
+        redraw = root.update_idletasks # Draws everything pending
+        print("\nStimulus onset (Tk canvas)")
+    except Exception:
+        from P039_Simulation import HeadlessCanvas
+        root = None
+        canvas = HeadlessCanvas(1024, 768)
+        redraw = lambda: None
+        print("\nStimulus onset (no display: headless canvas, Python side only)")
+    arc_colors = [("red", "blue"), ("blue", "red")]
+
+    latencies = []
+    for r in range(repeats):
+        left, right = arc_colors[r % 2]
+        t0 = perf_counter()
+        canvas.delete("all")
+        build_choice_keys(lambda layout, name, kind, *coords, **options:
+                              getattr(canvas, f"create_{kind}")(*coords, **options),
+                          canvas.tag_bind, lambda event: None)
+        canvas.itemconfigure(canvas.find_withtag("left_stimulus_key")[-1], fill = left)
+        canvas.itemconfigure(canvas.find_withtag("right_stimulus_key")[-1], fill = right)
+        redraw()
+        latencies.append(perf_counter() - t0)
+        canvas.delete("all") # ITI screen
+        canvas.create_rectangle(0, 0, 1024, 768, fill = "black", outline = "black")
+        redraw()
+    summarize("Delete all + redraw", latencies)
+
+    canvas.delete("all")
+    scene = CanvasScene(canvas)
+    build_choice_keys(scene.create, canvas.tag_bind, lambda event: None)
+    latencies = []
+    for r in range(repeats):
+        left, right = arc_colors[r % 2]
+        t0 = perf_counter()
+        scene.show(["background", "SBE_keys"],
+                   {("background", "rect"): {"fill": "#7F7F7F", "outline": "#7F7F7F"},
+                    ("SBE_keys", "left_arc"): {"fill": left},
+                    ("SBE_keys", "right_arc"): {"fill": right}})
+        redraw()
+        latencies.append(perf_counter() - t0)
+        scene.show(["background"], # ITI screen
+                   {("background", "rect"): {"fill": "black", "outline": "black"}})
+        redraw()
+    summarize("Retained scene", latencies)
+    if root is not None:
+        root.destroy()
+
+
+def scene_screens(screen):
+    # Every screen a session can show: {label: (layouts, configure)}
+    image = screen.stimulus_cache.get("placeholder.jpg", screen.image_diameter)
+    screens = {"ITI": (["background"], {}),
+               "ITI message": (["background", "message"], {("message", "text"): {"text": "ITI (10 sec.)"}})}
+    if screen.training_phase == 0:
+        screens["Pre-training key"] = (["background", "pretraining"], {})
+    elif screen.training_phase == 1:
+        screens["Stimulus"] = (["background", "stimulus"],
+                               {("stimulus", "image"): {"image": image}})
+    elif screen.training_phase == 2:
+        screens["SBE keys"] = (["background", "SBE_keys"],
+                               {("SBE_keys", "left_arc"): {"fill": "red"},
+                                ("SBE_keys", "right_arc"): {"fill": "blue"}})
+        screens["Choice keys"] = (["background", "choice_keys"],
+                                  {("choice_keys", "left_image"): {"image": image},
+                                   ("choice_keys", "right_image"): {"image": image}})
+        screens["Terminal link"] = (["background", "terminal_link"], {})
+    # provide_food() clears the whole canvas before showing the message
+    screens["Food message"] = (["message"], {("message", "text"): {"text": "Food accessible (3 s)"}})
+    return screens
+
+
+def tk_reference(scene):
+    # A real Tk canvas with the same items as the scene, or None without a
+    # display. Returns (root, function to sync the visible layouts and
+    # their images and text, function to find the tag under a touch,
+    # function giving the Tk bounds of a scene item).
+    try:
+        from tkinter import Tk, Canvas, PhotoImage
+        root = Tk()
+    except Exception:
+        return None
+    canvas = Canvas(root, width = 1024, height = 768, highlightthickness = 0)
+    ids = {}
+    for item_id in scene.order:
+        layout, kind, coords, options = scene.specs[item_id]
+        options = dict(options)
+        if kind == "image":
+            options["image"] = ""
+        ids[item_id] = getattr(canvas, f"create_{kind}")(*coords, **options)
+    photos = {}
+
+    def sync():
+        for item_id, tk_id in ids.items():
+            layout = scene.specs[item_id][0]
+            canvas.itemconfigure(tk_id, state = "normal" if layout in scene.visible else "hidden")
+            image = scene.applied[item_id].get("image")
+            if image:
+                size = (image.width(), image.height())
+                if size not in photos:
+                    photos[size] = PhotoImage(width = size[0], height = size[1])
+                canvas.itemconfigure(tk_id, image = photos[size])
+            text = scene.applied[item_id].get("text")
+            if text is not None:
+                canvas.itemconfigure(tk_id, text = text)
+
+    def topmost_tag(x, y):
+        # What the <Button-1> bindings get: the topmost visible item within
+        # closeenough (1 px) of the touch. find_closest() with that halo
+        # gives it, or the closest item overall if none is that close,
+        # hence the check against the items overlapping the halo.
+        found = canvas.find_closest(x, y, 1)
+        if not found or found[0] not in canvas.find_overlapping(x - 1, y - 1, x + 1, y + 1):
+            return None
+        tags = canvas.gettags(found[0])
+        return tags[0] if tags else None
+    return root, sync, topmost_tag, lambda item_id: canvas.bbox(ids[item_id])
+
+
+def tk_library_reference(scene, text_bbox, close_enough = 1.0):
+    # Without a display, Tk's own point-distance routines (from the Tk
+    # library, the ones its canvas items use) can still be called: returns
+    # a function to find the tag under a touch from them, or None if the
+    # library can't be loaded. Only how each item combines them is written
+    # out here (after the canvas item code in Tk 8.6): the box of a filled
+    # rectangle grown by half its outline; the straight edges of a pieslice
+    # arc plus its oval within the arc's angles; the box of an image (its
+    # position rounded); the bounds of a text (as the headless canvas
+    # estimates them). All the scene's rectangles and arcs are filled with
+    # at most a 1 px outline, which is all this covers.
+    try:
+        import _tkinter # Loads the Tcl/Tk libraries
+        from ctypes import CDLL, c_double, c_int
+        from ctypes.util import find_library
+        tk = CDLL(find_library(f"tk{_tkinter.TK_VERSION}") or f"libtk{_tkinter.TK_VERSION}.so")
+        for name in ["TkOvalToPoint", "TkLineToPoint", "TkPolygonToPoint"]:
+            getattr(tk, name).restype = c_double
+    except Exception:
+        return None
+    point_type, pair_type, box_type = c_double * 2, c_double * 2, c_double * 4
+
+    def polygon(x1, y1, x2, y2, point):
+        # A box, closed (Tk's polygons repeat their first point at the end)
+        corners = (c_double * 10)(x1, y1, x2, y1, x2, y2, x1, y2, x1, y1)
+        return tk.TkPolygonToPoint(corners, c_int(5), point)
+
+    def distance(item_id, x, y):
+        layout, kind, coords, options = scene.specs[item_id]
+        point = point_type(x, y)
+        no_outline = options.get("outline") == ""
+        width = 0.0 if no_outline else float(options.get("width", 1))
+        filled = no_outline or bool(options.get("fill"))
+        if kind == "image":
+            image = scene.applied[item_id].get("image")
+            if not image:
+                return None
+            ix, iy = (int(c + 0.5) if c >= 0 else int(c - 0.5) for c in coords)
+            x1, y1 = ix - image.width() // 2, iy - image.height() // 2
+            return polygon(x1, y1, x1 + image.width(), y1 + image.height(), point)
+        if kind == "text":
+            bounds = text_bbox(item_id)
+            return None if not bounds else polygon(*bounds, point)
+        if not filled or width > 1:
+            raise ValueError(f"{kind} item {item_id}: not covered by the reference")
+        x1, y1, x2, y2 = (float(c) for c in coords)
+        x1, x2, y1, y2 = min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
+        if kind == "rectangle":
+            return polygon(x1 - width / 2, y1 - width / 2, x2 + width / 2, y2 + width / 2, point)
+        oval = box_type(x1, y1, x2, y2)
+        if kind == "oval":
+            return tk.TkOvalToPoint(oval, c_double(width), c_int(1), point)
+        # Pieslice arc (ArcToPoint in tkCanvArc.c)
+        start, extent = float(options.get("start", 0)), float(options.get("extent", 90))
+        center = pair_type((x1 + x2) / 2, (y1 + y2) / 2)
+        t1 = (y - center[1]) / (y2 - y1) if y2 != y1 else 0.0
+        t2 = (x - center[0]) / (x2 - x1) if x2 != x1 else 0.0
+        angle = 0.0 if t1 == t2 == 0 else -degrees(atan2(t1, t2))
+        diff = angle - start
+        diff -= int(diff / 360) * 360
+        if diff < 0:
+            diff += 360
+        dist = min(tk.TkLineToPoint(center, pair_type((x1 + x2) / 2 + (x2 - x1) / 2 * cos(radians(a)),
+                                                      (y1 + y2) / 2 - (y2 - y1) / 2 * sin(radians(a))),
+                                    point)
+                   for a in [start, start + extent])
+        if diff <= extent or (extent < 0 and diff - 360 >= extent):
+            dist = min(dist, tk.TkOvalToPoint(oval, c_double(width), c_int(1), point))
+        return dist
+
+    def topmost_tag(x, y):
+        for item_id in reversed(scene.order):
+            if scene.specs[item_id][0] not in scene.visible:
+                continue
+            dist = distance(item_id, x, y)
+            if dist is not None and dist <= close_enough:
+                tags = scene.specs[item_id][3].get("tag", scene.specs[item_id][3].get("tags", ()))
+                return tags if isinstance(tags, str) else (tags[0] if tags else None)
+        return None
+    return topmost_tag
+
+
+def benchmark_hit_test(step, repeats):
+    # Checks that the touch geometry (P039_HitTest.py) finds the same key as
+    # the tag bindings for a grid of touches (every step px) over every
+    # screen of every phase, and compares the time per touch: finding the
+    # topmost item + working out the distances in write_data (old) vs. one
+    # call to TouchGeometry.locate(). The reference is a real Tk canvas if
+    # there is a display (with the geometry measuring text on it too),
+    # otherwise Tk's distance routines called from the Tk library (see
+    # tk_library_reference), or failing that the headless canvas's Tk-like
+    # hit testing. Returns the number of touches where the two disagree.
+    from P039_Simulation import HeadlessMainScreen, TRAINING_PHASE_NAME_LIST
+    failed = 0
+    with TemporaryDirectory() as tmp_dir:
+        for phase in [0, 1, 2]:
+            screen = HeadlessMainScreen("Itzamna", False, tmp_dir, phase,
+                                        TRAINING_PHASE_NAME_LIST, False)
+            screen.root.press_key("<space>") # Builds the scene
+            scene, geometry = screen.scene, screen.touch_geometry
+            tk = tk_reference(scene)
+            if tk is None:
+                topmost_tag = tk_library_reference(scene, screen.mastercanvas.bbox)
+                reference = "Tk library routines"
+            if tk is None and topmost_tag is None:
+                reference = "headless canvas"
+                def topmost_tag(x, y):
+                    item = screen.mastercanvas.find_topmost(x, y)
+                    return item.tags[0] if item is not None and item.tags else None
+            elif tk is not None:
+                reference = "Tk canvas"
+                tk_root, sync, topmost_tag, tk_bbox = tk
+                geometry.text_bbox = tk_bbox # Text measured with Tk's fonts
+            anchors = [a for a in geometry.anchors if a is not None]
+            print(f"\nPhase {phase} ({reference} as reference, touches every {step} px)")
+            for label, (layouts, configure) in scene_screens(screen).items():
+                scene.show(layouts, configure)
+                if tk is not None:
+                    sync()
+                points = [(x, y) for x in range(0, screen.mainscreen_width + 1, step)
+                          for y in range(0, screen.mainscreen_height + 1, step)]
+                mismatches = [(x, y) for x, y in points
+                              if geometry.locate(x, y).tag != topmost_tag(x, y)]
+                keys = sorted({str(geometry.locate(x, y).tag) for x, y in points})
+                print(f"{label:>22} | {len(points)} touches | keys: {', '.join(keys)} | "
+                      f"mismatches: {len(mismatches)} {mismatches[:5]}")
+                failed += len(mismatches)
+
+                sample = points[::max(1, len(points) // 2000)]
+                old, new = [], []
+                for r in range(repeats):
+                    t0 = perf_counter()
+                    for x, y in sample:
+                        screen.mastercanvas.find_topmost(x, y)
+                        for a in anchors:
+                            ((x - a[0]) ** 2 + (y - a[1]) ** 2) ** 0.5
+                    old.append((perf_counter() - t0) / len(sample))
+                    t0 = perf_counter()
+                    for x, y in sample:
+                        geometry.locate(x, y)
+                    new.append((perf_counter() - t0) / len(sample))
+                summarize("Per touch: items+dist", old)
+                summarize("Per touch: geometry", new)
+            if tk is not None:
+                tk_root.destroy()
+            screen.io_writer.close()
+    return failed
+
+
+class ActionRecorder(object):
+    # Stands in for the MainScreen: every action only notes that it ran
+    def __init__(self, action_names):
+        self.calls = []
+        for name in action_names:
+            setattr(self, name, lambda *args, name = name: self.calls.append(name))
+
+
+def stack_depth():
+    depth, frame = 0, _getframe(1)
+    while frame is not None:
+        depth, frame = depth + 1, frame.f_back
+    return depth
+
+
+def expected_trial_protocol(training_phase, record_video):
+    # The trial protocol, written out by hand (independently of
+    # P039_TrialFSM.trial_transitions) as {(state, event): next state}.
+    # Any (state, event) pair that isn't listed must leave the state alone.
+    if training_phase in [0, 1]:
+        # ITI -> trial (delay, then the key) -> reinforcement -> ITI
+        protocol = {("waiting", "start"): "ITI",
+                    ("ITI", "ITI_elapsed"): "trial_delay",
+                    ("trial_delay", "delay_elapsed"): "response",
+                    ("response", "key_peck"): "response",
+                    ("response", "ratio_met"): "reinforcement",
+                    ("response", "auto_timer_elapsed"): "reinforcement"}
+    else:
+        # ITI -> choice -> reinforcement (correct), a 5 s timeout then the
+        # same choice again (incorrect) or straight to the ITI (free choice)
+        protocol = {("waiting", "start"): "ITI",
+                    ("choice", "key_peck"): "choice",
+                    ("choice", "correct_choice"): "reinforcement",
+                    ("choice", "incorrect_choice"): "correction_timeout",
+                    ("choice", "free_choice"): "ITI",
+                    ("correction_timeout", "timeout_elapsed"): "choice"}
+        if record_video:
+            # The choice only starts once both the ITI is over and the
+            # cameras are recording
+            protocol.update({("ITI", "recording_due"): "ITI",
+                             ("ITI", "ITI_elapsed"): "awaiting_cameras",
+                             ("ITI", "cameras_started"): "ITI_cameras_ready",
+                             ("awaiting_cameras", "cameras_started"): "choice",
+                             ("ITI_cameras_ready", "ITI_elapsed"): "choice"})
+        else:
+            protocol[("ITI", "ITI_elapsed")] = "choice"
+    protocol.update({("reinforcement", "hopper_timer_elapsed"): "reinforcement",
+                     ("reinforcement", "hopper_down"): "ITI",
+                     ("ITI", "trials_completed"): "ended"})
+    # The session can be ended from anywhere
+    for state in {state for state, event in protocol} | set(protocol.values()):
+        if state != "ended":
+            protocol[(state, "exit")] = "ended"
+    return protocol
+
+
+def benchmark_trial_fsm(seeds, repeats):
+    # Checks every (state, event) pair of every phase's transition table
+    # (P039_TrialFSM.py) against the protocol written out in
+    # expected_trial_protocol(): fired in that state, the event must move
+    # the trial to the protocol's next state, running the table's action
+    # (only), and an event the protocol doesn't list must leave the state
+    # (and everything else) alone. Then runs simulated sessions of each
+    # phase to see which transitions real trials use, that none of them is
+    # unexpected and that the call stack doesn't grow, and times dispatching
+    # an event. Returns the number of failed checks.
+    failed = 0
+    print("\nEvery transition of every table, against the protocol")
+    for phase, record_video in [(0, False), (0, True), (1, False), (1, True),
+                                (2, False), (2, True)]:
+        rows, ignored = trial_transitions(phase, record_video)
+        recorder = ActionRecorder({row[3] for row in rows if row[3] is not None})
+        table = compile_trial_table(phase, record_video, recorder)
+        actions = {(row[0], row[1]): row[3] for row in rows}
+        protocol = expected_trial_protocol(phase, record_video)
+        failures, kinds = [], {TRANSITION: 0, IGNORED: 0, UNEXPECTED: 0}
+        # Pairs of the protocol the table doesn't know about at all
+        failures += [(state, event) for state, event in protocol
+                     if (state, event) not in table]
+        for (state, event), (next_state, action, kind) in table.items():
+            kinds[kind] += 1
+            machine = TrialStateMachine(table, state)
+            recorder.calls = []
+            with open(devnull, "w") as hidden, redirect_stdout(hidden):
+                machine.fire(event)
+            expected_calls = [actions[(state, event)]] if kind == TRANSITION and \
+                actions[(state, event)] is not None else []
+            expected_unexpected = 1 if kind == UNEXPECTED else 0
+            if (machine.state != protocol.get((state, event), state) or
+                    (kind == TRANSITION) != ((state, event) in protocol) or
+                    recorder.calls != expected_calls or
+                    sum(machine.unexpected.values()) != expected_unexpected):
+                failures.append((state, event))
+        states = {state for state, event in table}
+        events = {event for state, event in table}
+        print(f"Phase {phase}, video {'on ' if record_video else 'off'} | {len(states)} states x "
+              f"{len(events)} events | {kinds[TRANSITION]} transitions, {kinds[IGNORED]} ignored, "
+              f"{kinds[UNEXPECTED]} unexpected | failures: {len(failures)} {failures[:3]}")
+        failed += len(failures)
+    try:
+        compile_trial_table(2, False, ActionRecorder(["ITI"]))
+        print("A table with missing actions compiled (it shouldn't)")
+        failed += 1
+    except TransitionTableError as e:
+        print(f"A table with missing actions is rejected: {e}")
+
+    print(f"\nSimulated sessions ({seeds} per phase, random pigeon)")
+    from P039_Simulation import HeadlessSession, AGENTS
+    for phase in [0, 1, 2]:
+        used, depths, unexpected, table_size = set(), [], 0, 0
+        for seed in range(seeds):
+            with open(devnull, "w") as hidden, redirect_stdout(hidden):
+                session = HeadlessSession(AGENTS["random"](), "Itzamna", phase, seed)
+                machine = session.screen.trial_fsm
+                record = machine.on_transition
+                def hook(state, event, next_state, ns):
+                    used.add((state, event))
+                    depths.append(stack_depth())
+                    record(state, event, next_state, ns)
+                machine.on_transition = hook
+                session.run()
+            unexpected += sum(machine.unexpected.values())
+            failed += sum(machine.unexpected.values())
+            table_size = sum(1 for entry in machine.table.values() if entry[2] == TRANSITION)
+        print(f"Phase {phase} | {len(depths)} transitions | used {len(used)}/{table_size} of the "
+              f"table's transitions | unexpected events: {unexpected} | "
+              f"stack depth {min(depths)}-{max(depths)}")
+        print("Last session:")
+        print(session.screen.transition_times.report())
+        print(session.screen.timers.report())
+
+    print(f"\nDispatch ({repeats} x 100000 events, no-op actions)")
+    rows, ignored = trial_transitions(0)
+    handler = type("NoOps", (), {row[3]: (lambda self, *args: None)
+                                 for row in rows if row[3] is not None})()
+    table = compile_trial_table(0, False, handler)
+    cycle = ["start", "ITI_elapsed", "delay_elapsed", "key_peck", "ratio_met",
+             "hopper_timer_elapsed", "hopper_down"]
+    latencies = []
+    for r in range(repeats):
+        machine = TrialStateMachine(table)
+        t0 = perf_counter()
+        for i in range(100000 // len(cycle)):
+            for event in cycle[1 if i else 0:]:
+                machine.fire(event)
+        latencies.append((perf_counter() - t0) / (100000 // len(cycle) * (len(cycle) - 1)))
+    print(f"{'Per event':>22} | mean {mean(latencies)*1e6:6.3f} us | "
+          f"median {median(latencies)*1e6:6.3f} us | max {max(latencies)*1e6:6.3f} us")
+    return failed
+
+
+def benchmark_analysis(seeds):
+    # Runs simulated choice task (phase 2) sessions, summarizes each data
+    # file with P039_Analysis.py and checks the summary against the
+    # session's own live ChoiceStatistics (every choice, correction trials
+    # included). Returns the number of sessions that disagree.
+    from P039_Analysis import summarize_session
+    from P039_ChoiceStats import PAIR_TYPES
+    from P039_Simulation import HeadlessSession, AGENTS
+    failed = 0
+    print(f"\nAnalysis vs. live choice statistics ({seeds} phase 2 sessions, random pigeon)")
+    with TemporaryDirectory() as tmp_dir:
+        for seed in range(seeds):
+            with open(devnull, "w") as hidden, redirect_stdout(hidden):
+                session = HeadlessSession(AGENTS["random"](), "Itzamna", 2, seed, tmp_dir)
+                session.run()
+            stats = session.screen.choice_stats
+            t0 = perf_counter()
+            trials = summarize_session(session.screen.data_file_path())
+            elapsed = perf_counter() - t0
+            chose = trials["Choice"] != "NA"
+            SBE = chose & (trials["TrialType"] == "SBE_trial")
+            checks = {"choices": (int(chose.sum()), stats.choices),
+                      "left": (int((trials["Choice"] == "left").sum()), stats.left_choices),
+                      "SBE": (int(SBE.sum()), stats.SBE_choices),
+                      "SBE correct": (int((trials["ChoiceCorrect"][SBE] == 1).sum()), stats.SBE_correct),
+                      "corrections": (int((trials["CorrectionTrial"][SBE] == 1).sum()),
+                                      stats.correction_choices)}
+            for pair_type in PAIR_TYPES:
+                checks[pair_type] = (int((chose & (trials["TrialType"] == pair_type)).sum()),
+                                     stats.pairs[pair_type]["trials"])
+            wrong = {name: values for name, values in checks.items() if values[0] != values[1]}
+            failed += 1 if wrong else 0
+            print(f"Seed {seed} | {int(sum(trials['Attempt'] == 0))} trials, {len(chose)} attempts | "
+                  f"{stats.choices} choices, {stats.SBE_correct}/{stats.SBE_choices} SBE correct | "
+                  f"summarized in {elapsed*1000:.1f} ms | mismatches (analysis, live): {wrong or 'none'}")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="P039 benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("iti_write",
+                              help="Data write latency on ITI entry (full rewrite vs. streaming)")
+    p.add_argument("--trials", type=int, default=90)
+    p.add_argument("--events", type=int, default=60, help="Events per trial")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = subparsers.add_parser("memory",
+                              help="Data matrix memory (list of lists vs. CompactEventStore)")
+    p.add_argument("--minutes", type=float, default=90)
+    p.add_argument("--peck-rate", type=float, default=4, help="Pecks per second")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = subparsers.add_parser("session_start",
+                              help="Stimulus loading on the spacebar-to-first-ITI path")
+    p.add_argument("--folder", default="P039a_Stimuli")
+    p.add_argument("--csv", default="P039a_Stimuli/P039a_stimuli_assignments.csv")
+    p.add_argument("--size", type=int, default=100)
+    p.add_argument("--repeats", type=int, default=10)
+
+    p = subparsers.add_parser("phase1_schedule",
+                              help="Phase 1 schedule generation (rejection shuffling vs. constraint-based)")
+    p.add_argument("--repeats", type=int, default=50)
+    p.add_argument("--seed", type=int, default=1)
+
+    p = subparsers.add_parser("stimulus_onset",
+                              help="Stage change to stimulus visible (delete/redraw vs. retained scene)")
+    p.add_argument("--repeats", type=int, default=200)
+
+    p = subparsers.add_parser("hit_test",
+                              help="Touch geometry vs. tag-based hit testing (agreement and time per touch)")
+    p.add_argument("--step", type=int, default=2, help="Grid spacing (px)")
+    p.add_argument("--repeats", type=int, default=5)
+
+    p = subparsers.add_parser("trial_fsm",
+                              help="Trial state machine (every transition, simulated sessions, dispatch time)")
+    p.add_argument("--seeds", type=int, default=5, help="Simulated sessions per phase")
+    p.add_argument("--repeats", type=int, default=5)
+
+    p = subparsers.add_parser("analysis",
+                              help="Multi-session analysis vs. live choice statistics (simulated sessions)")
+    p.add_argument("--seeds", type=int, default=3, help="Simulated phase 2 sessions")
+
+    args = parser.parse_args()
+    if args.benchmark == "iti_write":
+        benchmark_iti_write(args.trials, args.events, args.seed)
+    elif args.benchmark == "memory":
+        benchmark_memory(args.minutes, args.peck_rate, args.seed)
+    elif args.benchmark == "session_start":
+        benchmark_session_start(args.folder, args.csv, args.size, args.repeats)
+    elif args.benchmark == "phase1_schedule":
+        benchmark_phase1_schedule(args.repeats, args.seed)
+    elif args.benchmark == "stimulus_onset":
+        benchmark_stimulus_onset(args.repeats)
+    elif args.benchmark == "hit_test":
+        failed = benchmark_hit_test(args.step, args.repeats)
+        if failed:
+            print(f"\nThe touch geometry disagreed with the reference on {failed} touch(es)")
+            exit(1)
+    elif args.benchmark == "trial_fsm":
+        failed = benchmark_trial_fsm(args.seeds, args.repeats)
+        if failed:
+            print(f"\n{failed} trial state machine check(s) failed")
+            exit(1)
+    elif args.benchmark == "analysis":
+        failed = benchmark_analysis(args.seeds)
+        if failed:
+            print(f"\nThe analysis disagreed with the live statistics in {failed} session(s)")
+            exit(1)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Session catalog
+
+An SQLite database (P039_sessions.sqlite, in the top of the data folder)
+with one row per session data file: subject, phase, start/end time, trial
+and event counts, peck and reinforcer counters, end reason, video files and
+session plan seed. The MainScreen adds each session once its data file has
+been closed (write_comp_data(True)), so finding a subject's sessions, the
+sessions of a phase, or everything run in a date range is an indexed query
+instead of globbing and opening every .csv.
+
+The database uses write-ahead logging (WAL), so it can be read (e.g., by the
+analysis scripts) while a box is writing to it, and several boxes sharing a
+data folder wait for each other rather than failing.
+
+Usage (from this folder):
+
+    python P039_Catalog.py rebuild <data folder>     (index every existing file)
+    python P039_Catalog.py list <data folder> [--subject S] [--phase N]
+                                              [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+"""
+
+from argparse import ArgumentParser
+from csv import reader
+from datetime import datetime, timedelta
+from glob import glob
+from os import path as os_path
+from re import compile as compile_regex
+import sqlite3
+
+CATALOG_FILE_NAME = "P039_sessions.sqlite"
+
+# Data files are named <subject>_<YYYY-MM-DD_HH.MM.SS>_P034b_data-Phase<n>.csv
+SESSION_FILE_PATTERN = compile_regex(r"^(?P<subject>.+)_(?P<start>\d{4}-\d{2}-\d{2}_\d{2}\.\d{2}\.\d{2})"
+                                     r"_P034b_data-Phase(?P<phase>\d)\.csv$")
+
+# The columns of the sessions table, in order
+SESSION_COLUMNS = ["data_file", "subject", "phase", "phase_name", "start_time",
+                   "end_time", "duration_s", "trial_count", "event_count",
+                   "key_pecks", "background_pecks", "reinforcers",
+                   "auto_reinforcers", "end_reason", "video_recorded",
+                   "video_files", "plan_seed", "indexed_at"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    data_file        TEXT PRIMARY KEY, -- relative to the data folder
+    subject          TEXT NOT NULL,
+    phase            INTEGER NOT NULL,
+    phase_name       TEXT,
+    start_time       TEXT NOT NULL,    -- ISO format, local time
+    end_time         TEXT,
+    duration_s       REAL,
+    trial_count      INTEGER,
+    event_count      INTEGER,
+    key_pecks        INTEGER,
+    background_pecks INTEGER,
+    reinforcers      INTEGER,
+    auto_reinforcers INTEGER,
+    end_reason       TEXT,             -- e.g., TrialsCompleted, TimeCompleted, ManualExit
+    video_recorded   INTEGER,
+    video_files      TEXT,             -- ";"-separated
+    plan_seed        INTEGER,
+    indexed_at       TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_by_subject ON sessions (subject, phase, start_time);
+CREATE INDEX IF NOT EXISTS sessions_by_start ON sessions (start_time);
+"""
+
+
+def parse_session_time(text):
+    # "H:MM:SS.ffffff" (how timedelta is written) -> seconds
+    hours, minutes, seconds = text.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def session_record(file_path, data_folder, end_reason = None):
+    # Works out the catalog row of a session from its data file
+    match = SESSION_FILE_PATTERN.match(os_path.basename(file_path))
+    if match is None:
+        raise ValueError(f"Not a session data file name: {file_path}")
+    start_time = datetime.strptime(match["start"], "%Y-%m-%d_%H.%M.%S")
+    record = dict.fromkeys(SESSION_COLUMNS)
+    record.update(data_file = os_path.relpath(file_path, data_folder),
+                  subject = match["subject"],
+                  phase = int(match["phase"]),
+                  start_time = start_time.isoformat(),
+                  end_reason = end_reason,
+                  indexed_at = datetime.now().isoformat(timespec = "seconds"))
+    trial_count = event_count = key_pecks = background_pecks = 0
+    reinforcers = auto_reinforcers = video_recorded = 0
+    video_files = []
+    last_session_time = None
+    with open(file_path, newline='') as f:
+        rows = reader(f)
+        header = next(rows)
+        col = {name: i for i, name in enumerate(header)}
+        for row in rows:
+            event_count += 1
+            event = row[col["EventType"]]
+            if event.endswith("_key_peck"):
+                key_pecks += 1
+            elif event == "background_peck":
+                background_pecks += 1
+            elif event == "reinforcer_provided":
+                reinforcers += 1
+            elif event == "auto_reinforcer_provided":
+                auto_reinforcers += 1
+            trial_num = row[col["TrialNum"]]
+            if trial_num.isdigit():
+                trial_count = max(trial_count, int(trial_num))
+            if row[col["VideoRecorded"]] in ["True", "1"]:
+                video_recorded = 1
+                for name in ["TopVideoFileName", "SideVideoFileName"]:
+                    video_file = row[col[name]]
+                    if video_file not in ["NA", ""] and video_file not in video_files:
+                        video_files.append(video_file)
+            last_session_time = row[col["SessionTime"]]
+            record["phase_name"] = row[col["ExpPhaseName"]]
+            if "SessionPlanSeed" in col and row[col["SessionPlanSeed"]].isdigit():
+                record["plan_seed"] = int(row[col["SessionPlanSeed"]])
+    if last_session_time:
+        duration_s = parse_session_time(last_session_time)
+        record["duration_s"] = round(duration_s, 3)
+        record["end_time"] = (start_time + timedelta(seconds = duration_s)).isoformat(timespec = "seconds")
+    record.update(trial_count = trial_count, event_count = event_count,
+                  key_pecks = key_pecks, background_pecks = background_pecks,
+                  reinforcers = reinforcers, auto_reinforcers = auto_reinforcers,
+                  video_recorded = video_recorded,
+                  video_files = ";".join(video_files))
+    return record
+
+
+class SessionCatalog(object):
+    # The catalog of one data folder. Opens (and, if needed, creates) the
+    # database; use as a context manager or call close().
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        self.path = os_path.join(data_folder, CATALOG_FILE_NAME)
+        self.connection = sqlite3.connect(self.path, timeout = 30) # Waits for other writers
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL") # Safe with WAL
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_session(self, file_path, end_reason = None):
+        # Indexes (or re-indexes) a session data file. An end reason that was
+        # already recorded is kept if none is given (e.g., when rebuilding).
+        record = session_record(file_path, self.data_folder, end_reason)
+        placeholders = ", ".join("?" for c in SESSION_COLUMNS)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in SESSION_COLUMNS
+                            if c not in ["data_file", "end_reason"])
+        with self.connection:
+            self.connection.execute(
+                f"INSERT INTO sessions ({', '.join(SESSION_COLUMNS)}) VALUES ({placeholders}) "
+                f"ON CONFLICT(data_file) DO UPDATE SET {updates}, "
+                f"end_reason = COALESCE(excluded.end_reason, sessions.end_reason)",
+                [record[c] for c in SESSION_COLUMNS])
+        return record
+
+    def rebuild(self):
+        # Indexes every session data file in the data folder and drops rows
+        # whose file no longer exists. Returns the number of files indexed.
+        file_paths = [p for p in glob(os_path.join(self.data_folder, "*", "*_data-Phase*.csv"))
+                      if SESSION_FILE_PATTERN.match(os_path.basename(p))]
+        for file_path in sorted(file_paths):
+            self.add_session(file_path)
+        indexed = {os_path.relpath(p, self.data_folder) for p in file_paths}
+        with self.connection:
+            for row in self.connection.execute("SELECT data_file FROM sessions").fetchall():
+                if row["data_file"] not in indexed:
+                    self.connection.execute("DELETE FROM sessions WHERE data_file = ?",
+                                            (row["data_file"],))
+        return len(file_paths)
+
+    def sessions(self, subject = None, phase = None, since = None, until = None):
+        # Sessions (as sqlite3.Row, in start time order) matching every
+        # filter given. since/until are dates, datetimes or ISO strings;
+        # until is exclusive.
+        conditions, values = [], []
+        if subject is not None:
+            conditions.append("subject = ?")
+            values.append(subject)
+        if phase is not None:
+            conditions.append("phase = ?")
+            values.append(int(phase))
+        if since is not None:
+            conditions.append("start_time >= ?")
+            values.append(str(since.isoformat() if hasattr(since, "isoformat") else since))
+        if until is not None:
+            conditions.append("start_time < ?")
+            values.append(str(until.isoformat() if hasattr(until, "isoformat") else until))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self.connection.execute(
+            f"SELECT * FROM sessions {where} ORDER BY start_time, subject", values).fetchall()
+
+    def latest_session(self, subject, phase = None):
+        # The most recent session of a subject (in a phase), or None
+        query = "SELECT * FROM sessions WHERE subject = ?"
+        values = [subject]
+        if phase is not None:
+            query += " AND phase = ?"
+            values.append(int(phase))
+        return self.connection.execute(query + " ORDER BY start_time DESC LIMIT 1",
+                                       values).fetchone()
+
+    def session_counts(self):
+        # {(subject, phase): number of sessions}
+        rows = self.connection.execute(
+            "SELECT subject, phase, COUNT(*) AS n FROM sessions GROUP BY subject, phase")
+        return {(row["subject"], row["phase"]): row["n"] for row in rows}
+
+    def data_file_path(self, row):
+        # Full path of a session row's data file
+        return os_path.join(self.data_folder, row["data_file"])
+
+
+def catalog_session(data_folder, file_path, end_reason = None):
+    # Adds one finished session to its data folder's catalog (this is what
+    # the MainScreen calls, on its data writer thread)
+    with SessionCatalog(data_folder) as catalog:
+        return catalog.add_session(file_path, end_reason)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="P039 session catalog")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("rebuild", help="Index every data file in the data folder")
+    p.add_argument("data_folder")
+
+    p = subparsers.add_parser("list", help="List sessions")
+    p.add_argument("data_folder")
+    p.add_argument("--subject")
+    p.add_argument("--phase", type=int)
+    p.add_argument("--since", help="YYYY-MM-DD (inclusive)")
+    p.add_argument("--until", help="YYYY-MM-DD (exclusive)")
+
+    args = parser.parse_args()
+    with SessionCatalog(args.data_folder) as catalog:
+        if args.command == "rebuild":
+            n = catalog.rebuild()
+            print(f"{n} session files indexed in {catalog.path}")
+        elif args.command == "list":
+            rows = catalog.sessions(args.subject, args.phase, args.since, args.until)
+            print(f"{'Subject':>12} | Phase | {'Start':^19} | Trials | Events | "
+                  f"{'End reason':>15} | Data file")
+            for row in rows:
+                print(f"{row['subject']:>12} | {row['phase']:^5} | {row['start_time']:^19} | "
+                      f"{row['trial_count']:6d} | {row['event_count']:6d} | "
+                      f"{str(row['end_reason']):>15} | {row['data_file']}")
+            print(f"{len(rows)} sessions")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Live choice statistics (phase 2)
+
+Keeps running statistics of the choices made during a choice task session,
+so a side-biased bird can be spotted while it is still in the box:
+
+    side bias        -> proportion of left choices, over the whole session
+                        and over the last `window` choices, with a warning
+                        when the recent choices are mostly on one side
+    SBE accuracy     -> correct choices on SBE trials, and how many SBE
+                        choices were made on correction trials
+    probe choices    -> for each probe pair type (PvP, PvC, CvC), the number
+                        of trials and left choices, and for PvC trials how
+                        often the probe (training set 0) was chosen
+    choice latency   -> from the start of the choice substage until the
+                        choice (mean, SD, min and max, by trial type)
+
+Every choice updates the running counts, sums and the recent-choices window
+in constant time (no list of past choices is ever scanned again), so this
+can run inside the peck handler. The MainScreen shows summary_text() on the
+control panel after every choice and writes summary_rows() next to the data
+file (..._choice_summary.csv) at the end of the session.
+"""
+
+from collections import deque
+from csv import writer
+from math import inf, nan, sqrt
+
+PAIR_TYPES = ["PvP", "PvC", "CvC"]
+
+
+class RunningStats(object):
+    # Count, mean, SD, min and max of a stream of numbers (Welford's method)
+    __slots__ = ["n", "mean", "m2", "min", "max"]
+
+    def __init__(self):
+        self.n, self.mean, self.m2 = 0, 0.0, 0.0
+        self.min, self.max = inf, -inf
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def sd(self):
+        return sqrt(self.m2 / (self.n - 1)) if self.n > 1 else nan
+
+    def values(self):
+        # (n, mean, sd, min, max); NaN where there is no data yet
+        if self.n == 0:
+            return (0, nan, nan, nan, nan)
+        return (self.n, self.mean, self.sd, self.min, self.max)
+
+
+def proportion(part, whole):
+    return part / whole if whole else nan
+
+
+class ChoiceStatistics(object):
+    # window: number of recent choices used for the running side bias.
+    # bias_threshold: warn when at least this proportion of the recent
+    # choices (once the window is full) were to one side.
+    def __init__(self, window = 20, bias_threshold = 0.8):
+        self.window = window
+        self.bias_threshold = bias_threshold
+        self.choices = 0
+        self.left_choices = 0
+        self.recent = deque(maxlen = window) # 1 = left, 0 = right
+        self.recent_left = 0
+        self.SBE_choices = 0
+        self.SBE_correct = 0
+        self.correction_choices = 0 # SBE choices made on correction trials
+        self.pairs = {pair_type: {"trials": 0, "left": 0, "probe_chosen": 0}
+                      for pair_type in PAIR_TYPES}
+        self.latencies = {} # trial type ("SBE_trial", "PvC", ...) -> RunningStats
+        self.all_latencies = RunningStats()
+
+    def record(self, side, trial_type, latency_s, correct = None,
+               correction_trial = False, probe_side = None):
+        # side: "left"/"right". correct: True/False on SBE trials (None on
+        # probe trials). probe_side: on PvC trials, the side of the probe.
+        left = 1 if side == "left" else 0
+        self.choices += 1
+        self.left_choices += left
+        if len(self.recent) == self.window:
+            self.recent_left -= self.recent[0] # About to drop out of the window
+        self.recent.append(left)
+        self.recent_left += left
+
+        if trial_type == "SBE_trial":
+            self.SBE_choices += 1
+            self.SBE_correct += 1 if correct else 0
+            self.correction_choices += 1 if correction_trial else 0
+        elif trial_type in self.pairs:
+            pair = self.pairs[trial_type]
+            pair["trials"] += 1
+            pair["left"] += left
+            if probe_side is not None and side == probe_side:
+                pair["probe_chosen"] += 1
+        self.latencies.setdefault(trial_type, RunningStats()).add(latency_s)
+        self.all_latencies.add(latency_s)
+
+    @property
+    def left_proportion(self):
+        return proportion(self.left_choices, self.choices)
+
+    @property
+    def recent_left_proportion(self):
+        return proportion(self.recent_left, len(self.recent))
+
+    @property
+    def biased_side(self):
+        # "left"/"right" if the (full) recent window is mostly to one side
+        if len(self.recent) < self.window:
+            return None
+        if self.recent_left_proportion >= self.bias_threshold:
+            return "left"
+        if 1 - self.recent_left_proportion >= self.bias_threshold:
+            return "right"
+        return None
+
+    def summary_text(self):
+        # A few lines for the control panel
+        if self.choices == 0:
+            return "No choices yet"
+        lines = [f"Choices: {self.choices} | left {self.left_proportion:.0%} "
+                 f"(last {len(self.recent)}: {self.recent_left_proportion:.0%})"]
+        if self.biased_side is not None:
+            lines.append(f"*** SIDE BIAS: {self.biased_side.upper()} ***")
+        if self.SBE_choices:
+            lines.append(f"SBE: {self.SBE_correct}/{self.SBE_choices} correct | "
+                         f"correction trials {proportion(self.correction_choices, self.SBE_choices):.0%}")
+        for pair_type, pair in self.pairs.items():
+            if pair["trials"]:
+                line = f"{pair_type}: {pair['trials']} | left {proportion(pair['left'], pair['trials']):.0%}"
+                if pair_type == "PvC":
+                    line += f" | probe {proportion(pair['probe_chosen'], pair['trials']):.0%}"
+                lines.append(line)
+        lines.append(f"Choice latency: {self.all_latencies.mean:.2f} s "
+                     f"(SD {self.all_latencies.sd:.2f})")
+        return "\n".join(lines)
+
+    def summary_rows(self):
+        # [Measure, Group, Count, Value] rows for the end-of-session summary
+        rows = [["choices", "all", self.choices, self.choices],
+                ["left_proportion", "all", self.choices, self.left_proportion],
+                ["left_proportion", f"last_{self.window}", len(self.recent),
+                 self.recent_left_proportion],
+                ["biased_side", f"last_{self.window}", len(self.recent),
+                 self.biased_side or "none"],
+                ["SBE_correct_proportion", "SBE_trial", self.SBE_choices,
+                 proportion(self.SBE_correct, self.SBE_choices)],
+                ["correction_trial_proportion", "SBE_trial", self.SBE_choices,
+                 proportion(self.correction_choices, self.SBE_choices)]]
+        for pair_type, pair in self.pairs.items():
+            rows.append(["left_proportion", pair_type, pair["trials"],
+                         proportion(pair["left"], pair["trials"])])
+            if pair_type == "PvC":
+                rows.append(["probe_chosen_proportion", pair_type, pair["trials"],
+                             proportion(pair["probe_chosen"], pair["trials"])])
+        for trial_type, stats in sorted(self.latencies.items()) + [("all", self.all_latencies)]:
+            n, mean, sd, minimum, maximum = stats.values()
+            for measure, value in [("mean", mean), ("sd", sd), ("min", minimum), ("max", maximum)]:
+                rows.append([f"choice_latency_{measure}_s", trial_type, n, value])
+        return rows
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "NA" if value != value else round(value, 4)
+    return value
+
+
+def write_choice_summary(rows, base_path):
+    # Writes <base_path>_choice_summary.csv from summary_rows()
+    file_path = f"{base_path}_choice_summary.csv"
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(["Measure", "Group", "Count", "Value"])
+        for row in rows:
+            w.writerow([format_value(v) for v in row])
+    return file_path
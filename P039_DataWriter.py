@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Data writing helpers
+
+This file holds the objects that the MainScreen uses to get the session data
+onto the disk. Previously, the entire data matrix was rewritten to the .csv
+after every trial (mode 'w'), which meant that the amount of data written at
+each ITI grew with every trial of the session. On the Raspberry Pis' SD cards
+this happens right as the next trial is being scheduled, so we now keep the
+.csv open and only append the rows added since the last write.
+
+The final .csv is byte-for-byte identical to the one the old full rewrite
+produced, because the same csv.writer settings are used and rows that have
+already been written are never changed afterwards.
+
+Building each data row, printing it to the terminal, and writing the .csv
+all happen on a dedicated writer thread (BackgroundDataWriter). The Tkinter
+callbacks only take a snapshot of the trial variables and drop it in a
+bounded queue, so a peck is never held up by the disk or the terminal.
+
+The data matrix itself is kept in a CompactEventStore rather than a list of
+36-element lists. Numbers are kept in typed arrays and repeated text (subject,
+phase name, stimulus names, "NA", etc.) is stored once and referred to by
+number. Rows only get turned back into the usual .csv layout when they are
+written out.
+"""
+
+from array import array
+from csv import writer, QUOTE_MINIMAL
+from datetime import timedelta
+from os import fsync
+from queue import Queue, Full, Empty
+from threading import Thread, main_thread
+
+
+# The columns of the session data .csv, in order, along with how each one is
+# kept in memory by the CompactEventStore (see below).
+DATA_HEADER_LIST = ["Subject", "Date", "ExpPhaseNum", "ExpPhaseName", 
+                    "SessionTime", "TrialNum", "TrialType", "EventType",
+                    "TrialSubStage", "TrialTime", "TrialSubStageTimer",
+                    "ITIDuration", "Xcord","Ycord", "CenterPythDist", 
+                    "LeftPythDist", "RightPythDist", "CenterStim",
+                    "LeftStim", "LeftStimTrainingSet", "LeftStimNumber", "LeftSBEColor",
+                    "RightStim", "RightStimTrainingSet", "RightStimNumber", "RightSBEColor",
+                    "SubPhase1RR", "SubPhase1LeftButtonPresses",
+                    "SubPhase1RightButtonPresses", "SubPhase2RR",
+                    "SubPhase2ButtonPresses", "CorrectionTrial",
+                    "CorrectChoice", "VideoRecorded",
+                    "TopVideoFileName", "SideVideoFileName",
+                    "EventLatencyMs", "SessionPlanSeed", "EventTimeNs"]
+
+DATA_COLUMN_KINDS = ["str", "str", "str", "str",
+                     "time", "int", "str", "str",
+                     "int", "float", "float",
+                     "int", "int", "int", "float",
+                     "float", "float", "str",
+                     "str", "str", "str", "str",
+                     "str", "str", "str", "str",
+                     "int", "int",
+                     "int", "int",
+                     "int", "int",
+                     "str", "str",
+                     "str", "str",
+                     "float", "int", "int"]
+
+
+class StreamingSessionWriter(object):
+    # This object owns the open data .csv for a single session. It is handed
+    # the growing data matrix (a list of rows, header first) and remembers how
+    # many rows have already been written, so each call only appends the new
+    # ones.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.rows_written = 0 # Number of rows (including header) already on disk
+        self.fsync_count = 0 # Number of times the file was forced to disk
+        self.data_file = None
+        self.csv_writer = None
+
+    def open_file(self):
+        # The first time the file is opened it is created fresh (just like the
+        # old 'w' rewrite). If the writer was closed and more rows show up
+        # afterwards, we re-open it in append mode so nothing is lost.
+        if self.rows_written == 0:
+            mode = 'w'
+        else:
+            mode = 'a'
+        self.data_file = open(self.file_path, mode, newline='')
+        self.csv_writer = writer(self.data_file, quoting=QUOTE_MINIMAL)
+
+    def write_new_rows(self, data_frame, sync=True):
+        # Appends any rows of data_frame that have not yet been written. If
+        # sync is True (e.g., at trial boundaries), the OS is also asked to
+        # physically write the file to the disk. Returns the number of rows
+        # appended.
+        new_rows = data_frame[self.rows_written:]
+        if self.data_file is None:
+            self.open_file()
+        if new_rows:
+            self.csv_writer.writerows(new_rows)
+            self.rows_written += len(new_rows)
+        self.data_file.flush()
+        if sync:
+            fsync(self.data_file.fileno())
+            self.fsync_count += 1
+        return len(new_rows)
+
+    def close(self):
+        # Closes the file (the session is over). Safe to call more than once.
+        if self.data_file is not None:
+            self.data_file.flush()
+            fsync(self.data_file.fileno())
+            self.fsync_count += 1
+            self.data_file.close()
+            self.data_file = None
+            self.csv_writer = None
+
+
+class CompactEventStore(object):
+    # A memory-efficient stand-in for the list-of-lists data matrix. It is
+    # built with the header row and then appended to row-by-row, and can be
+    # sliced/indexed like the old list (e.g., data_frame[n:] gives a list of
+    # ordinary rows), so the .csv writer doesn't need to know the difference.
+    #
+    # Each column is stored according to its kind:
+    #   "str"   -> text; each distinct value is stored once in a shared table
+    #              and the column holds its number (unsigned 32-bit array)
+    #   "int"   -> whole numbers (signed 64-bit array)
+    #   "float" -> decimals (64-bit float array)
+    #   "time"  -> timedelta (e.g., SessionTime) as microseconds
+    # "NA" in a numeric column is kept as a sentinel value. Anything else that
+    # doesn't match the column's kind is kept as text in a small "overflow"
+    # dictionary, so any value still comes out exactly as the old list would
+    # have written it.
+    INT_NA, INT_OTHER = -2**63, -2**63 + 1
+    FLOAT_NA = float("nan")
+
+    def __init__(self, header_list, column_kinds):
+        self.header_list = list(header_list)
+        self.column_kinds = list(column_kinds)
+        self.string_table = [] # code -> text
+        self.string_codes = {} # text -> code
+        self.overflow = {} # (column, row) -> text
+        self.n_rows = 0
+        self.columns = []
+        for kind in self.column_kinds:
+            if kind == "str":
+                self.columns.append(array('I'))
+            elif kind in ["int", "time"]:
+                self.columns.append(array('q'))
+            elif kind == "float":
+                self.columns.append(array('d'))
+            else:
+                raise ValueError(f"Unknown column kind: {kind}")
+
+    def encode_string(self, value):
+        # csv.writer writes None as an empty field and anything else as str()
+        if value is None:
+            value = ""
+        elif type(value) is not str:
+            value = str(value)
+        code = self.string_codes.get(value)
+        if code is None:
+            code = len(self.string_table)
+            self.string_table.append(value)
+            self.string_codes[value] = code
+        return code
+
+    def append(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} columns, got {len(row)}")
+        r = self.n_rows
+        for c, (kind, value, column) in enumerate(zip(self.column_kinds, row, self.columns)):
+            if kind == "str":
+                column.append(self.encode_string(value))
+            elif kind == "int":
+                if type(value) is int and self.INT_OTHER < value < 2**63:
+                    column.append(value)
+                elif value == "NA":
+                    column.append(self.INT_NA)
+                else:
+                    column.append(self.INT_OTHER)
+                    self.overflow[(c, r)] = self.string_table[self.encode_string(value)]
+            elif kind == "float":
+                if type(value) is float and value == value: # (NaN != NaN)
+                    column.append(value)
+                else:
+                    column.append(self.FLOAT_NA)
+                    if value != "NA":
+                        self.overflow[(c, r)] = self.string_table[self.encode_string(value)]
+            elif kind == "time":
+                if type(value) is timedelta:
+                    column.append((value.days * 86400 + value.seconds) * 1000000 + value.microseconds)
+                else:
+                    column.append(self.INT_OTHER)
+                    self.overflow[(c, r)] = self.string_table[self.encode_string(value)]
+        self.n_rows += 1
+
+    def materialize_row(self, r):
+        # Rebuilds event row r (0 = first event after the header) in the
+        # original .csv layout
+        row = []
+        for c, (kind, column) in enumerate(zip(self.column_kinds, self.columns)):
+            value = column[r]
+            if kind == "str":
+                row.append(self.string_table[value])
+            elif kind == "int":
+                if value == self.INT_NA:
+                    row.append("NA")
+                elif value == self.INT_OTHER:
+                    row.append(self.overflow[(c, r)])
+                else:
+                    row.append(value)
+            elif kind == "float":
+                if value != value:
+                    row.append(self.overflow.get((c, r), "NA"))
+                else:
+                    row.append(value)
+            elif kind == "time":
+                if value == self.INT_OTHER:
+                    row.append(self.overflow[(c, r)])
+                else:
+                    row.append(str(timedelta(microseconds = value)))
+        return row
+
+    def __len__(self):
+        # Like the old matrix, the header counts as the first row
+        return self.n_rows + 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CompactEventStore index out of range")
+        if index == 0:
+            return list(self.header_list)
+        return self.materialize_row(index - 1)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def nbytes(self):
+        # Approximate memory used by the store's arrays and string table
+        total = sum(column.itemsize * len(column) for column in self.columns)
+        total += sum(len(text) + 49 for text in self.string_table)
+        total += 100 * len(self.overflow)
+        return total
+
+
+class BackgroundDataWriter(object):
+    # A producer/consumer queue with a single writer thread. The MainScreen
+    # (on the Tkinter thread) submits four kinds of items:
+    #   1) Data events: a compact snapshot of the trial variables at the time
+    #       of the event. The writer thread turns it into a full data row with
+    #       format_row(), appends the row to the data matrix and prints the
+    #       terminal feedback line.
+    #   2) Flushes: append the new rows to the .csv (see StreamingSessionWriter)
+    #   3) Console messages: any other terminal output, kept in order with the
+    #       event lines.
+    #   4) Tasks: any other file writing (e.g., end of session reports), run
+    #       after everything submitted before them.
+    # If a journal is attached (see P039_Journal.py), every data row is also
+    # appended to it as it is built, and it is forced to disk with each flush.
+    # Data events are never dropped; if the queue is full the Tkinter thread
+    # waits for space (counted in "blocked_puts"). Terminal output is the
+    # only thing that gets dropped, either when the queue is full or when the
+    # writer has fallen more than console_backlog_limit items behind.
+    EVENT, FLUSH, CONSOLE, TASK, STOP = 0, 1, 2, 3, 4
+
+    def __init__(self, format_row, data_frame, max_queue_size = 5000,
+                 console_backlog_limit = 500, console_output = True,
+                 threaded = True):
+        self.format_row = format_row # function(snapshot) -> (row, console line)
+        self.data_frame = data_frame # The session's data matrix (appended to by the writer only)
+        self.console_backlog_limit = console_backlog_limit
+        self.console_output = console_output
+        self.threaded = threaded
+        self.item_queue = Queue(maxsize = max_queue_size)
+        self.thread = None
+        self.running = False # Items are queued (rather than handled inline)
+        self.stopping = False # A STOP item has been queued
+        self.journal = None # SessionJournal, once the session has started
+
+        # Counters (see stats())
+        self.events_submitted = 0
+        self.events_written = 0
+        self.console_lines_dropped = 0
+        self.blocked_puts = 0
+        self.max_queue_depth = 0
+        self.errors = 0
+
+    def start(self):
+        # Starts the writer thread. Without a thread (threaded = False or
+        # once closed), every item is handled immediately on the caller's
+        # thread instead. The thread isn't a daemon, so the program can't
+        # exit while it still holds rows that haven't been written (see run).
+        if self.threaded and not self.running:
+            self.running = True
+            self.thread = Thread(target = self.run,
+                                 name = "P039-data-writer",
+                                 daemon = False)
+            self.thread.start()
+
+    def put(self, item, droppable):
+        # Queues an item for the writer thread (or handles it inline if the
+        # thread isn't running). Returns False if the item was dropped.
+        if self.stopping and not self.thread.is_alive():
+            self.drain() # The writer has stopped but close() hasn't drained yet
+        if not self.running:
+            self.handle_item(item)
+            return True
+        try:
+            self.item_queue.put_nowait(item)
+        except Full:
+            if droppable:
+                self.console_lines_dropped += 1
+                return False
+            self.blocked_puts += 1
+            if self.stopping:
+                # The writer won't get past its STOP item, so wait for it
+                # to get there and handle this after everything before it
+                self.thread.join()
+                self.drain()
+                self.handle_item(item)
+                return True
+            self.item_queue.put(item) # Wait for the writer to catch up
+        depth = self.item_queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return True
+
+    def submit_event(self, snapshot):
+        self.events_submitted += 1
+        self.put((self.EVENT, snapshot), droppable = False)
+
+    def submit_flush(self, session_writer, close = False, message = None):
+        # Append (and fsync) any rows not yet in the .csv, optionally closing
+        # the file afterwards and printing message once it is written.
+        self.put((self.FLUSH, (session_writer, close, message)), droppable = False)
+
+    def console(self, text):
+        self.put((self.CONSOLE, text), droppable = True)
+
+    def submit_task(self, task):
+        # Runs task() on the writer thread
+        self.put((self.TASK, task), droppable = False)
+
+    def run(self):
+        # The writer thread's loop; runs until a STOP item is received, or
+        # until the program is exiting (its main thread has finished) without
+        # having called close() and everything queued has been handled
+        while True:
+            try:
+                item = self.item_queue.get(timeout = 0.5)
+            except Empty:
+                if not main_thread().is_alive():
+                    break
+                continue
+            if item[0] == self.STOP:
+                break
+            self.handle_item(item)
+
+    def handle_item(self, item):
+        kind, payload = item
+        try:
+            if kind == self.EVENT:
+                row, console_line = self.format_row(payload)
+                self.data_frame.append(row)
+                if self.journal is not None:
+                    self.journal.event(row)
+                self.events_written += 1
+                self.print_console(console_line)
+            elif kind == self.FLUSH:
+                session_writer, close, message = payload
+                session_writer.write_new_rows(self.data_frame, sync = True)
+                if self.journal is not None:
+                    self.journal.sync()
+                if close:
+                    session_writer.close()
+                if message is not None:
+                    self.print_console(message, always = True)
+            elif kind == self.CONSOLE:
+                self.print_console(payload)
+            elif kind == self.TASK:
+                payload()
+        except Exception as e: # Never let the writer thread die silently
+            self.errors += 1
+            print(f"ERROR in data writer: {e!r}")
+
+    def print_console(self, text, always = False):
+        # Skips terminal output if the writer has fallen too far behind
+        if not self.console_output:
+            return
+        if not always and self.item_queue.qsize() > self.console_backlog_limit:
+            self.console_lines_dropped += 1
+            return
+        print(text)
+
+    def close(self, timeout = 10):
+        # Drains the queue and stops the writer thread. Anything submitted
+        # afterwards is handled inline, so no data is lost if the program
+        # keeps running. Never returns with items still queued: if the
+        # writer is still busy it keeps waiting, with a warning (and the
+        # number of items left) every timeout s. Safe to call more than once.
+        if not self.running:
+            return
+        if not self.stopping:
+            self.stopping = True
+            self.item_queue.put((self.STOP, None))
+        waited = 0
+        while True:
+            self.thread.join(timeout)
+            if not self.thread.is_alive():
+                break
+            waited += timeout
+            print(f"WARNING: data writer still busy after {waited} s "
+                  f"({self.queue_depth} items queued), still waiting")
+        self.drain()
+
+    def drain(self):
+        # Once the writer thread has stopped: handles whatever was queued
+        # after its STOP item, in order, and everything inline from now on
+        self.running = False
+        self.stopping = False
+        while True:
+            try:
+                item = self.item_queue.get_nowait()
+            except Empty:
+                break
+            if item[0] != self.STOP:
+                self.handle_item(item)
+
+    @property
+    def queue_depth(self):
+        return self.item_queue.qsize()
+
+    def stats(self):
+        return {"queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "events_submitted": self.events_submitted,
+                "events_written": self.events_written,
+                "console_lines_dropped": self.console_lines_dropped,
+                "blocked_puts": self.blocked_puts,
+                "errors": self.errors}
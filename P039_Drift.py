@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Timer drift
+
+Compares every delay the session schedules with the time that actually
+passed, on the session clock (the scheduler's monotonic_ns(), see
+P039_Scheduler.py):
+
+    ITI                -> from scheduling the end of the ITI until the trial
+                          began (in the choice task, this includes waiting
+                          for the cameras to confirm they are recording)
+    trial_delay        -> from substage 1 until substage 2
+    auto_reinforcer    -> from substage 2 until the auto-reinforcer (only
+                          when it fired; a peck cancels it)
+    correction_timeout -> the grey screen before a correction trial
+    hopper             -> how long the hopper was actually up (timed on the
+                          hardware thread, see P039_Hardware.py)
+
+At the end of a session, ..._drift_report.csv (one row per delay) is written
+next to the data .csv, after the session clock's anchor (the date and time
+of day it was tied to, once, when the session started), and a summary is
+printed.
+"""
+
+from csv import writer
+from statistics import mean, stdev
+
+DRIFT_PURPOSES = ["ITI", "trial_delay", "auto_reinforcer",
+                  "correction_timeout", "hopper"]
+
+DRIFT_REPORT_HEADER = ["Purpose", "TrialNum", "ScheduledMs", "ActualMs", "ErrorMs"]
+
+
+class DriftMonitor(object):
+    # clock_ns: the session clock. Delays are started when they are
+    # scheduled and finished when whatever they were waiting for happens;
+    # only one delay per purpose can be running at a time.
+    def __init__(self, clock_ns):
+        self.clock_ns = clock_ns
+        self.running = {} # purpose -> (start ns, scheduled ms, trial)
+        self.delays = [] # (purpose, trial, scheduled ms, actual ms)
+
+    def start(self, purpose, scheduled_ms, trial_num):
+        self.running[purpose] = (self.clock_ns(), scheduled_ms, trial_num)
+
+    def finish(self, purpose):
+        # Records a running delay (if there is one) as elapsed now
+        started = self.running.pop(purpose, None)
+        if started is not None:
+            start_ns, scheduled_ms, trial_num = started
+            self.add(purpose, trial_num, scheduled_ms,
+                     (self.clock_ns() - start_ns) / 1e6)
+
+    def cancel(self, purpose):
+        self.running.pop(purpose, None)
+
+    def add(self, purpose, trial_num, scheduled_ms, actual_ms):
+        # Records a delay measured elsewhere (e.g., the hopper)
+        self.delays.append((purpose, trial_num, scheduled_ms, actual_ms))
+
+    def rows(self):
+        # One row of DRIFT_REPORT_HEADER per delay
+        return [[purpose, trial_num, scheduled_ms, round(actual_ms, 3),
+                 round(actual_ms - scheduled_ms, 3)]
+                for purpose, trial_num, scheduled_ms, actual_ms in self.delays]
+
+    def summary(self):
+        # {purpose: (count, mean error, SD of error, min error, max error)}
+        # in ms (actual - scheduled)
+        errors = {}
+        for purpose, trial_num, scheduled_ms, actual_ms in self.delays:
+            errors.setdefault(purpose, []).append(actual_ms - scheduled_ms)
+        summary = {}
+        for purpose in DRIFT_PURPOSES + sorted(set(errors) - set(DRIFT_PURPOSES)):
+            if purpose in errors:
+                e = errors[purpose]
+                summary[purpose] = (len(e), mean(e), stdev(e) if len(e) > 1 else 0.0,
+                                    min(e), max(e))
+        return summary
+
+    def report(self, system_clock_drift_ms = None):
+        # A short summary for the terminal
+        lines = ["Timer drift (actual - scheduled):",
+                 f"{'Delay':>20} |     n |  mean ms |    SD ms |   min ms |   max ms"]
+        for purpose, (n, mean_error, sd, minimum, maximum) in self.summary().items():
+            lines.append(f"{purpose:>20} | {n:5d} | {mean_error:8.3f} | {sd:8.3f} | "
+                         f"{minimum:8.3f} | {maximum:8.3f}")
+        if system_clock_drift_ms is not None:
+            lines.append(f"The computer's clock moved {system_clock_drift_ms:.3f} ms "
+                         f"against the session clock")
+        return "\n".join(lines)
+
+
+def write_drift_report(rows, anchor_wall_clock, anchor_ns, base_path):
+    # Writes <base_path>_drift_report.csv from DriftMonitor.rows(), after
+    # the session clock's anchor
+    file_path = f"{base_path}_drift_report.csv"
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(["SessionClockAnchor", anchor_wall_clock.isoformat(), anchor_ns])
+        w.writerow(DRIFT_REPORT_HEADER)
+        w.writerows(rows)
+    return file_path
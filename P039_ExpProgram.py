@@ -70,21 +70,43 @@ procedure and apparatus.
 
 # Prior to running any code, its conventional to first import relevant 
 # libraries for the entire script. These can range from python libraries (sys)
-# or sublibraries (setrecursionlimit) that are downloaded to every computer
+# or sublibraries (e.g., path from sys) that are downloaded to every computer
 # along with python, or other files within this folder (like control_panel or 
-# maestro).
+# maestro). The launch time is noted first, for the startup timing breakdown
+# (see P039_Startup.py); heavy libraries (PIL, http.server, sqlite3) are only
+# imported once a session needs them.
 # =============================================================================
+from time import perf_counter, perf_counter_ns
+launch_time = perf_counter()
 from copy import deepcopy
-from csv import writer, QUOTE_MINIMAL, DictReader
-from datetime import datetime, timedelta, date
-from sys import setrecursionlimit, path as sys_path
+from datetime import datetime, timedelta
+from sys import path as sys_path
 from tkinter import Toplevel, Canvas, BOTH, TclError, Tk, Label, Button, \
      StringVar, OptionMenu, IntVar, Radiobutton
-from time import time, sleep, strftime
 from os import getcwd, popen, mkdir, makedirs, path as os_path
-from PIL import ImageTk, Image  
-from random import choice, shuffle
-from subprocess import run
+from P039_DataWriter import StreamingSessionWriter, BackgroundDataWriter, \
+     CompactEventStore, DATA_HEADER_LIST, DATA_COLUMN_KINDS
+from P039_Stimuli import StimulusCache, load_stimulus_bundle
+from P039_VideoRecorder import AsyncVideoRecorder
+from P039_Scheduler import TkScheduler
+from P039_Latency import PeckLatencyMonitor, write_latency_report
+from P039_Scene import CanvasScene
+from P039_HitTest import TouchGeometry
+from P039_ChoiceStats import ChoiceStatistics, write_choice_summary
+from P039_Telemetry import PeckRate, start_telemetry_server, DEFAULT_TELEMETRY_PORT
+from P039_Drift import DriftMonitor, write_drift_report
+from P039_Journal import SessionJournal, journal_path, find_unfinished_journal, \
+    recover_data_file
+from P039_Hardware import BoxHardware, MockBackend, PigpioBackend, \
+    read_hopper_values, write_hardware_log, write_hopper_timing
+from P039_SessionPlan import SUBJECT_CONTROL_CONDITIONS, PROBE_STIMULUS_ORDERS, \
+     read_session_stimuli, next_session_plan, mark_session_plan_used
+from P039_Startup import StartupTimer
+from P039_TrialFSM import TrialStateMachine, TransitionTimes, compile_trial_table
+from P039_Timers import TimerRegistry
+
+startup = StartupTimer(launch_time) # Times each step until the control panel is ready
+startup.add("imports", launch_time)
 
 # The first variable declared is whether the program is the operant box version
 # for pigeons, or the test version for humans to view. The variable below is 
@@ -96,67 +118,62 @@ from subprocess import run
 # on a rapberry pi) or False if not. The output of os_path.expanduser('~')
 # should be "/home/blaisdelllab" on the RPis
 
-if os_path.expanduser('~').split("/")[2] =="blaisdelllab":
+if os_path.expanduser('~').split("/")[2:3] == ["blaisdelllab"]:
     operant_box_version = True
     print("*** Running operant box version *** \n")
 else:
     operant_box_version = False
     print("*** Running test version (no hardware) *** \n")
 
-# Import hopper/other specific libraries from files on operant box computers
-try:
-    if operant_box_version:
-        # Import additional libraries...
+# Set up the operant box hardware. The steps below don't depend on each
+# other, so each runs on its own thread while the control panel is built (see
+# finish_hardware_setup(), called once the control panel is ready).
+hardware_backend = None # The GPIO board (see P039_Hardware.py); None if not in a box
+hardware_setup = None # The box's setup steps (see P039_Startup.py)
+if operant_box_version:
+    # Setup GPIO numbers (NOT PINS; gpio only compatible with GPIO num)
+    GPIO_nums = {"servo": 2,
+                 "hopper_light": 13,
+                 "house_light": 21,
+                 "LED_strings": 5} # Only in box 1
+    
+    # The proper UP/DOWN values for the hopper are stored in a csv file
+    hopper_vals_csv_path = str(os_path.expanduser('~')+"/Desktop/Box_Info/Hopper_vals.csv")
+    
+    def connect_GPIO_board():
+        # Import additional libraries, then connect to the board and set each
+        # GPIO to output
         import pigpio # import pi, OUTPUT
-        import csv
-        
-        # Setup GPIO numbers (NOT PINS; gpio only compatible with GPIO num)
-        servo_GPIO_num = 2
-        hopper_light_GPIO_num = 13
-        house_light_GPIO_num = 21
-        string_LED_GPIO_num = 5 # Only in box 1
-        
-        # Setup use of pi()
-        rpi_board = pigpio.pi()
-        
-        # Then set each pin to output 
-        rpi_board.set_mode(servo_GPIO_num,
-                           pigpio.OUTPUT) # Servo motor...
-        rpi_board.set_mode(hopper_light_GPIO_num,
-                           pigpio.OUTPUT) # Hopper light LED...
-        rpi_board.set_mode(house_light_GPIO_num,
-                           pigpio.OUTPUT) # House light LED...
-        rpi_board.set_mode(string_LED_GPIO_num,
-                           pigpio.OUTPUT) # House light LED...
-        
-        # Setup the servo motor 
-        rpi_board.set_PWM_frequency(servo_GPIO_num,
-                                    50) # Default frequency is 50 MhZ
-        
-        # Next grab the up/down 
-        hopper_vals_csv_path = str(os_path.expanduser('~')+"/Desktop/Box_Info/Hopper_vals.csv")
-        
-        # Store the proper UP/DOWN values for the hopper from csv file
-        up_down_table = list(csv.reader(open(hopper_vals_csv_path)))
-        hopper_up_val = up_down_table[1][0]
-        hopper_down_val = up_down_table[1][1]
-        
-        # Lastly, run the shell script that maps the touchscreen to operant box monitor
-        popen("sh /home/blaisdelllab/Desktop/Hardware_Code/map_touchscreen.sh")
-                             
-        
-except ModuleNotFoundError:
-    input("ERROR: Cannot find hopper hardware! Check desktop.")
+        return PigpioBackend(pigpio, GPIO_nums)
+    
+    hardware_setup = startup.start_concurrently(
+        {"GPIO board": connect_GPIO_board,
+         "hopper values": lambda: read_hopper_values(hopper_vals_csv_path),
+         # Run the shell script that maps the touchscreen to operant box monitor
+         "touchscreen mapping": lambda: popen("sh /home/blaisdelllab/Desktop/Hardware_Code/map_touchscreen.sh")})
+
 
-# Below  is just a safety measure to prevent too many recursive loops). It
-# doesn't need to be changed.
-setrecursionlimit(5000)
+def finish_hardware_setup():
+    # Waits for the box's setup steps (if any) to finish, then hands the
+    # hopper values to the board
+    global hardware_backend
+    if hardware_setup is None:
+        return
+    try:
+        hardware_setup.join()
+    except ModuleNotFoundError:
+        input("ERROR: Cannot find hopper hardware! Check desktop.")
+    finally: # Even if another step failed, so that the board gets cleaned up
+        hardware_backend = hardware_setup.results.get("GPIO board")
+    if hardware_backend is not None:
+        hardware_backend.set_hopper_values(*hardware_setup.results["hopper values"])
 
 """
 The code below jumpstarts the loop by first building the hopper object and 
 making sure everything is turned off, then passes that object to the
-control_panel. The program is largely recursive and self-contained within each
-object, and a macro-level overview is:
+control_panel. The program is largely self-contained within each object (the
+trials themselves run as a state machine, see P039_TrialFSM.py), and a
+macro-level overview is:
     
     ControlPanel -----------> MainScreen ------------> PaintProgram
          |                        |                         |
@@ -174,6 +191,7 @@ class ExperimenterControlPanel(object):
     # The init function declares the inherent variables within that object
     # (meaning that they don't require any input).
     def __init__(self):
+        panel_start = perf_counter() # For the startup timing
         # Next up, we need to do a couple things that will be different based
         # on whether the program is being run in the operant boxes or on a 
         # personal computer. These include setting up the hopper object so it 
@@ -258,6 +276,19 @@ class ExperimenterControlPanel(object):
                                    text = 'Start program',
                                    bg = "green2",
                                    command = self.build_chamber_screen).pack()
+        # Resume button (carries on with the subject's interrupted session
+        # in the selected phase, see P039_Journal.py)
+        self.resume_button = Button(self.control_window,
+                                    text = 'Resume session',
+                                    command = self.resume_chamber_screen).pack()
+        # Live choice statistics of the running session (phase 2), so a
+        # side-biased bird can be spotted mid-session
+        self.session_stats_variable = StringVar(self.control_window)
+        Label(self.control_window,
+              textvariable = self.session_stats_variable,
+              justify = "left",
+              font = "Courier 11").pack()
+        
         # # Stop button 
         # self.stop_button = Button(self.control_window,
         #                            text = 'Stop program',
@@ -265,6 +296,14 @@ class ExperimenterControlPanel(object):
         #                            command = self.stop_program
         #                            ).pack()
         
+        startup.add("control panel", panel_start)
+        
+        # Before handing over to Tkinter, wait for the box's hardware (set
+        # up since launch) and print how long startup took
+        with startup.step("waiting for hardware"):
+            finish_hardware_setup()
+        print(startup.report())
+        
         # This makes sure that the control panel remains onscreen until exited
         self.control_window.mainloop() # This loops around the CP object
         
@@ -290,10 +329,11 @@ class ExperimenterControlPanel(object):
         print("Stop program button pressed.")
                 
                 
-    def build_chamber_screen(self):
+    def build_chamber_screen(self, resume_state = None):
         # Once the green "start program" button is pressed, then the mainscreen
         # object is created and pops up in a new window. It gets passed the
-        # important inputs from the control panel.
+        # important inputs from the control panel (and, when resuming, what
+        # was read back from the interrupted session's journal).
         # print(str(self.stimulus_set_variable.get())[0])
         if self.subject_ID_variable.get() in self.pigeon_name_list:
             print("Start Program Button Pressed") 
@@ -303,21 +343,52 @@ class ExperimenterControlPanel(object):
                 self.data_folder_directory, # directory for data folder
                 self.training_phase_variable.get(), # Which training phase
                 self.training_phase_name_list, # list of training phases
-                self.record_video_variable.get() # Record video
+                self.record_video_variable.get(), # Record video
+                status_display = self.session_stats_variable.set, # Live choice stats
+                resume_state = resume_state
                 )
         else:
             print("\n ERROR: Input Correct Pigeon ID Before Starting Session")
             
+    def resume_chamber_screen(self):
+        # Called by the "Resume session" button: finds the selected subject's
+        # last session in the selected phase and, if it didn't finish, starts
+        # the mainscreen from its journal
+        subject_ID = str(self.subject_ID_variable.get())
+        if subject_ID not in self.pigeon_name_list:
+            print("\n ERROR: Input Correct Pigeon ID Before Resuming Session")
+            return
+        resume_state = find_unfinished_journal(self.data_folder_directory, subject_ID,
+                                               self.training_phase_variable.get())
+        if resume_state is None:
+            print(f"\n ERROR: No interrupted Phase {self.training_phase_variable.get()} session for {subject_ID}")
+            return
+        print(f"Resuming {resume_state.session['data_file']}")
+        self.build_chamber_screen(resume_state)
+            
 
 # Then, setup the MainScreen object
 class MainScreen(object):
+    # Whether this MainScreen runs the operant box hardware (GPIO, fullscreen
+    # display, etc.). It is kept on the object so that a headless/simulated
+    # MainScreen (see P039_Simulation.py) can switch it off.
+    operant_box_version = operant_box_version
+    # Data writing options (the simulation turns these off for speed)
+    threaded_data_writer = True
+    threaded_hardware = True # Box commands are sent from their own thread
+    console_output = True
+    x_event_timestamps = True # Whether event.time comes from the X server
+    # Live status over HTTP (see P039_Telemetry.py); port None = off
+    telemetry_host = "127.0.0.1"
+    telemetry_port = DEFAULT_TELEMETRY_PORT
+    
     # First, we need to declare several functions that are 
     # called within the initial __init__() function that is 
     # run when the object is first built:
     
     def __init__(self, subject_ID, record_data, data_folder_directory,
                  training_phase, training_phase_name_list, 
-                 record_video):
+                 record_video, status_display = None, resume_state = None):
         ## Firstly, we need to set up all the variables passed from within
         # the control panel object to this MainScreen object. We do this 
         # by setting each argument as "self." objects to make them global
@@ -330,6 +401,11 @@ class MainScreen(object):
         self.training_phase = training_phase # the phase of training as a number (0-2)
         self.training_phase_name_list = training_phase_name_list 
         self.record_video = record_video # T/F
+        self.status_display = status_display # function(text) showing live stats on the control panel (or None)
+        self.resume_state = resume_state # JournalState of an interrupted session to carry on with (or None)
+        self.resume_event_pending = False # Write a SessionResumed event in the next ITI
+        if resume_state is not None:
+            self.record_data = True # A resumed session always carries on with its data file
         
         # In order to properly counter-balance the early order of probe
         # stimuli, we need to assign subjects to one of four groups. Each group 
@@ -343,24 +419,26 @@ class MainScreen(object):
         # G4 would recieve probe stimuli in the following order: P5-P1-P4-P3-P2
         
         # This counterbalancing schedule was maintained across multiple sessions
-        dict_of_subject_assignments = {
-            "TEST": 1,
-            "Jubilee": 1,
-            "Itzamna": 2,
-            "Hawthorne": 3,
-            "Hendrix": 4
-            }
+        # (the subject assignments and probe orders are listed in
+        # P039_SessionPlan.py, so that plans can be made ahead of time)
+        self.control_condition = SUBJECT_CONTROL_CONDITIONS[self.subject_ID]
+        self.probe_stimulus_order = list(PROBE_STIMULUS_ORDERS[self.control_condition])
         
-        self.control_condition = dict_of_subject_assignments[self.subject_ID]
-        
-        if self.control_condition       == 1:
-            self.probe_stimulus_order   = [1, 5, 2, 3, 4]
-        elif self.control_condition     == 2:
-            self.probe_stimulus_order   = [1, 5, 4, 3, 2]
-        elif self.control_condition     == 3:
-            self.probe_stimulus_order   = [5, 1, 2, 3, 4]
-        elif self.control_condition     == 4:
-            self.probe_stimulus_order   = [5, 1, 4, 3, 2]
+        # Everything random about the session (trial order, SBE colors,
+        # correct sides, ITI durations and ratio requirements) is taken from
+        # a seeded session plan. Plans are usually made ahead of time and
+        # waiting in the subject's data folder; if not, one is made (and
+        # saved, if data is being recorded) here.
+        # A resumed session carries on with its own plan (kept in its journal).
+        self.tenative_stimuli_identity_d_list = read_session_stimuli("P039a_Stimuli/P039a_stimuli_assignments.csv")
+        if resume_state is not None:
+            self.session_plan, self.session_plan_path = resume_state.session["plan"], None
+        else:
+            self.session_plan, self.session_plan_path = next_session_plan(self.data_folder_directory if self.record_data else None,
+                                                                          self.subject_ID,
+                                                                          self.training_phase,
+                                                                          self.tenative_stimuli_identity_d_list,
+                                                                          self.probe_stimulus_order)
             
         ## Define some other variables that will be important for the procedure
         self.autoshaping_RR = 5
@@ -368,6 +446,7 @@ class MainScreen(object):
         self.trial_num      = 0 # counter for current trial in session
         self.trial_stage    = 0 # Trial substage (we have 2: blank screen/stimulus presentation or choice trial/terminal link)
         self.image_diameter = 100
+        self.stimulus_cache = self.build_stimulus_cache() # Each stimulus image is only decoded once
 
          # Max number of trials within a session (three trials per stimulus), 
          # for pre-training it remains at 90 trials
@@ -389,7 +468,13 @@ class MainScreen(object):
         # Timing variables
         self.auto_reinforcer_timer = 30 * 1000 # Time (ms) before reinforcement for AS
         self.start_time = None # This will be reset once the session actually starts
-        self.trial_start = None # Duration into each trial as a second count, resets each trial
+        self.start_ns = None # Session clock (ns) at the start of the session
+        # Session clock times (ns) of the start of the current ITI, the start
+        # of the trial after it (None during the ITI), and the start of the
+        # current substage
+        self.ITI_start_ns = None
+        self.trial_begin_ns = None
+        self.substage_start_ns = None
         self.session_duration = datetime.now() + timedelta(minutes = 90) # Max session time is 90 min
         if self.training_phase in [0, 1]:
             self.ITI_duration = 10 * 1000 # duration of inter-trial interval (ms) is variable between 10 - 20 s
@@ -412,31 +497,82 @@ class MainScreen(object):
         self.brown_color = "#31131E"
         
         ## Setup data structure...
-        self.session_data_frame = [] #This where trial-by-trial data is stored
-        header_list = ["Subject", "Date", "ExpPhaseNum", "ExpPhaseName", 
-                       "SessionTime", "TrialNum", "TrialType", "EventType",
-                       "TrialSubStage", "TrialTime", "TrialSubStageTimer",
-                       "ITIDuration", "Xcord","Ycord", "CenterPythDist", 
-                       "LeftPythDist", "RightPythDist", "CenterStim",
-                       "LeftStim", "LeftStimTrainingSet", "LeftStimNumber", "LeftSBEColor",
-                       "RightStim", "RightStimTrainingSet", "RightStimNumber", "RightSBEColor",
-                       "SubPhase1RR", "SubPhase1LeftButtonPresses",
-                       "SubPhase1RightButtonPresses", "SubPhase2RR",
-                       "SubPhase2ButtonPresses", "CorrectionTrial",
-                       "CorrectChoice", "VideoRecorded",
-                       "TopVideoFileName", "SideVideoFileName"]
-        self.session_data_frame.append(header_list) # First row of matrix is the column headers
+        # This is where trial-by-trial data is stored. The columns (and how
+        # each one is stored in memory) are listed in P039_DataWriter.py. The
+        # first row of the matrix is the column headers.
+        self.session_data_frame = CompactEventStore(DATA_HEADER_LIST,
+                                                    DATA_COLUMN_KINDS)
         self.myFile_loc = 'FILL' # To be filled later on after Pig. ID is provided (in set vars func below)
+        self.data_writer = None # Streaming .csv writer, opened the first time data is written
+        self.journal = None # Crash recovery journal (see P039_Journal.py), opened when the session starts
+        # All data rows, .csv writes and event printouts are handled by a
+        # background thread so that pecks are never held up by the disk
+        self.io_writer = BackgroundDataWriter(self.format_data_row,
+                                              self.session_data_frame,
+                                              console_output = self.console_output,
+                                              threaded = self.threaded_data_writer)
+        self.io_writer.start()
+        self.peck_latency = PeckLatencyMonitor(use_event_time = self.x_event_timestamps) # Touch-to-handler timing of every peck
+        self.scene = None # Retained Canvas items, built when the session starts
+        self.background_event_type = "background_peck" # How pecks to the background are recorded
+        self.stage_change_started_ns = None
+        self.session_end_reason = None # e.g., "TrialsCompleted" (set on exit)
+        self.choice_stats = ChoiceStatistics() # Live side bias, accuracy, etc. (phase 2)
+        self.touch_geometry = None # Shapes of the keys, for working out what was pecked
+        self.current_touch = None # The peck being handled (see touch())
 
         ## Set up the visual Canvas
-        self.root = Toplevel()
-        self.root.title(f"P039: {self.training_phase_name_list[self.training_phase][3:]}") # this is the title of the windows
         self.mainscreen_height = 768 # height of the experimental canvas screen
         self.mainscreen_width = 1024 # width of the experimental canvas screen
+        self.build_window()
+        self.scheduler = self.build_scheduler() # All timers and timestamps go through this
+        self.timers = TimerRegistry(self.scheduler) # Every timer the session sets, by purpose
+        self.drift = DriftMonitor(self.scheduler.monotonic_ns) # Scheduled vs. actual delays
+        self.hardware = self.build_hardware().start() # Hopper, lights and LED strings
+        # The trials run as a state machine compiled for this phase (see
+        # P039_TrialFSM.py), with every transition timed. Timers the new
+        # state has no use for are cancelled whenever the state changes.
+        self.transition_times = TransitionTimes()
+        self.trial_fsm = TrialStateMachine(compile_trial_table(self.training_phase,
+                                                               self.record_video, self),
+                                           on_transition = self.transition_times.record,
+                                           on_state_change = self.cancel_stale_timers)
+        
+        # Live counters for the telemetry server, which reads them from its
+        # own thread whenever it is polled
+        self.peck_rate = PeckRate()
+        self.reinforcers_delivered = 0
+        self.reinforcement = None # Timing of the current reinforcer (see P039_Hardware.py)
+        self.telemetry = None
+        if self.telemetry_port is not None:
+            self.telemetry = start_telemetry_server(self.telemetry_status,
+                                                    self.telemetry_host,
+                                                    self.telemetry_port)
+            
+        # The video recording shell scripts are run in the background so that
+        # the Tkinter loop never waits on them. On computers without cameras,
+        # stand-in scripts are used instead.
+        if self.operant_box_version:
+            recording_script_folder = os_path.expanduser('~') + "/Desktop/Video_Recording_Software"
+        else:
+            recording_script_folder = os_path.join(os_path.dirname(os_path.abspath(__file__)),
+                                                   "Video_Recording_Stub")
+        self.video_recorder = AsyncVideoRecorder(f"{recording_script_folder}/start_recording.sh",
+                                                 f"{recording_script_folder}/stop_recording.sh",
+                                                 lambda delay_ms, callback: self.timers.after("video_poll", delay_ms, callback))
+        
+        ## Finally, start the recursive loop that runs the program:
+        self.place_birds_in_box()
+
+    def build_window(self):
+        # Sets up the Toplevel window (self.root) and the experimental Canvas
+        # (self.mastercanvas) the stimuli are drawn on
+        self.root = Toplevel()
+        self.root.title(f"P039: {self.training_phase_name_list[self.training_phase][3:]}") # this is the title of the windows
         self.root.bind("<Escape>", self.exit_program) # bind exit program to the "esc" key
         
         # If the version is the one running in the boxes, run some independent processes
-        if operant_box_version:
+        if self.operant_box_version:
             # Keybind relevant keys
             self.cursor_visible = True # Cursor starts on...
             self.change_cursor_state() # turn off cursor UNCOMMENT
@@ -459,9 +595,37 @@ class MainScreen(object):
                                    height=self.mainscreen_height,
                                    width = self.mainscreen_width)
             self.mastercanvas.pack()
-        
-        ## Finally, start the recursive loop that runs the program:
-        self.place_birds_in_box()
+
+    def build_scheduler(self):
+        # Timers run on Tkinter's real-time after() loop (see P039_Scheduler.py)
+        return TkScheduler(self.root)
+
+    def build_hardware(self):
+        # The box's GPIO board, or (when not in a box) a stand-in that only
+        # records the commands (see P039_Hardware.py)
+        if self.operant_box_version:
+            backend = hardware_backend
+        else:
+            backend = MockBackend()
+        return BoxHardware(backend, threaded = self.threaded_hardware,
+                           clock_ns = self.scheduler.monotonic_ns,
+                           on_reinforcer = self.peck_latency.record_reinforcer)
+
+    def build_stimulus_cache(self):
+        # Stimuli are loaded from a pre-rendered, memory-mapped bundle (built
+        # or rebuilt here if needed, before the bird is in the box) so no
+        # .jpgs need to be decoded once the session starts. Each image is
+        # then only made into a Tkinter image once (see P039_Stimuli.py).
+        self.stimulus_bundle = None
+        if self.training_phase in [1, 2]:
+            self.stimulus_bundle = load_stimulus_bundle("P039a_Stimuli",
+                                                        "P039a_Stimuli/P039a_stimuli_assignments.csv",
+                                                        self.image_diameter)
+        if self.stimulus_bundle is not None:
+            return StimulusCache("P039a_Stimuli",
+                                 image_factory = self.stimulus_bundle.make_photo_image)
+        else:
+            return StimulusCache("P039a_Stimuli")
 
     def place_birds_in_box(self):
         # This is the default screen run until the birds are placed into the
@@ -475,31 +639,24 @@ class MainScreen(object):
             # the first_ITI link, followed by a s pause before the first trial to 
             # let birds settle in and acclimate.
             print("Spacebar pressed -- SESSION STARTED") 
+            setup_timer_start = perf_counter() # Times the session setup below
             self.mastercanvas.delete("all")
+            self.scene = self.build_scene() # Every Canvas item for the session (hidden for now)
+            self.touch_geometry = self.build_touch_geometry()
+            self.mastercanvas.bind("<Button-1>", self.touch) # All pecks go through touch()
             self.root.unbind("<space>")
-            self.start_time = datetime.now() # Set start time
-            if operant_box_version:
-                rpi_board.write(string_LED_GPIO_num,
-                    True) # Turn on the LED strings
+            self.start_ns = self.scheduler.monotonic_ns() # Set start time
+            self.start_time = self.scheduler.wall_clock()
+            self.hardware.LED_strings(True) # Turn on the LED strings
             
-            # First set up the path to the stimulus identity .csv document
-            stimuli_csv_path = "P039a_Stimuli/P039a_stimuli_assignments.csv"
-                
-            # Import the used sample stimuli, their respective training set
-            # numbers (class) and stimulus numbers.
-            with open(stimuli_csv_path, 'r', encoding='utf-8-sig') as f:
-                dict_reader = DictReader(f) 
-                self.d_list = list(dict_reader)
-                
-            self.tenative_stimuli_identity_d_list = []
-            # Reduce our stimuli to StimulusNum 1 or 5
-            for d in self.d_list:
-                if d['StimulusNum'] in ['1', '5']:
-                    self.tenative_stimuli_identity_d_list.append(d)
-                                                                
-            # Once the list of dictionaries is written, we can use it to assign
-            # the stimuli to each trial of the session. We do this by writing
-            # each of the stimuli to a list.
+            # The stimuli for every trial (and all the other random draws of
+            # the session) come from the session plan that was loaded before
+            # the bird was placed in the box (see P039_SessionPlan.py). Now
+            # that the session has started, the plan is marked as used.
+            if self.session_plan_path is not None:
+                self.session_plan_path = mark_session_plan_used(self.session_plan_path)
+            print(f"Session plan seed: {self.session_plan['seed']}")
+            stimuli_by_name = {d["Name"]: d for d in self.tenative_stimuli_identity_d_list}
             self.trial_stimulus_order = []
             
             # For the first five trials of each session, birds were presented
@@ -507,56 +664,15 @@ class MainScreen(object):
             # pseudo-randomly selected without replacement from the 25 possible
             # training stimuli.
             if self.training_phase == 1:
-                # First 30 trials are set as 5 control, 1 probe, 5 control, 1 probe
-                while len(self.trial_stimulus_order) < 12:
-                    # First, select the first five stimuli
-                    five_classes = list(range(1, 6))
-                    shuffle(five_classes)
-                    # Next, selecting actual stimuli from classes
-                    for class_num in five_classes:
-                        options = [] # Possible stimuli
-                        for d in self.tenative_stimuli_identity_d_list: # Cycle through all stimuli...
-                            if d['TrainingSet'] == str(class_num): # ...until we find the matching class number
-                                if d not in self.trial_stimulus_order: # No repeats
-                                    options.append(d)
-
-                        # Chose stimuli from options
-                        chosen_stim = choice(options)
-                        self.trial_stimulus_order.append(chosen_stim)
-                            
-                    # Then, we select the relevant probe stimuli
-                    probe_trial_num = int((len(self.trial_stimulus_order) / 5) - 1) # Assumes 5 stimuli in between probes
-                    probe_stim_number = self.probe_stimulus_order[probe_trial_num]
-                    for d in self.tenative_stimuli_identity_d_list: # Cycle through all stimuli...
-                        if d['TrainingSet'] == "0": # Probe stimuli
-                            if d['StimulusNum'] == str(probe_stim_number):
-                                self.trial_stimulus_order.append(d)
-
-                # Add 72 more
-                for iteration in list(range(0,6)): # Run twice
-                    while True:
-                        bad_shuffle = False
-                        shuffle(self.tenative_stimuli_identity_d_list)
-                        for i in list(range(2, 12)): # Assumes len(self.tenative_stimuli_identity_d_list) == 30
-                            d1 = self.tenative_stimuli_identity_d_list[i]
-                            c1 = d1["TrainingSet"]
-                            d2 = self.tenative_stimuli_identity_d_list[i - 1]
-                            c2 = d2["TrainingSet"]
-                            d3 = self.tenative_stimuli_identity_d_list[i - 2]
-                            c3 = d3["TrainingSet"]
-                            if c1 == c2 == c3:
-                                bad_shuffle = True
-                        # Break if good shuffle
-                        if bad_shuffle == False:
-                            break
-
-                    # Once a good shuffle is established
-                    for d in self.tenative_stimuli_identity_d_list:
-                        self.trial_stimulus_order.append(d)
+                # First 12 trials are set as 5 control, 1 probe, 5 control, 1 probe
+                # (probes in the counterbalanced order), then six shuffles of
+                # all 12 stimuli in which no three trials in a row come from 
+                # the same training set (see P039_Schedule.py)
+                self.trial_stimulus_order = [stimuli_by_name[name] for name in self.session_plan["trials"]]
                 
                 # Finally, load the image files into the dictionary:
                 for i in self.trial_stimulus_order:
-                    i["img"] = ImageTk.PhotoImage(Image.open(f'P039a_Stimuli/{i["Name"]}').resize((self.image_diameter, self.image_diameter)))
+                    i["img"] = self.stimulus_cache.get(i["Name"], self.image_diameter)
                     if int(i["TrainingSet"]) == 0:
                         i["trial_type"] = "probe"
                     else:
@@ -564,179 +680,51 @@ class MainScreen(object):
             
             # For the binary choice task
             elif self.training_phase == 2:
-                # Compared one class of control stimuli to 
-                comparison_control_stimuli_class = 5
-                comparison_control_stimuli = [1, 5]
-                # Remove all non-relevant stimuli; utilize 4 total
-                self.utilized_trials = []
-                for d in self.tenative_stimuli_identity_d_list:
-                    if int(d["TrainingSet"]) in [0, comparison_control_stimuli_class]:
-                        if int(d["StimulusNum"]) in comparison_control_stimuli:
-                            self.utilized_trials.append(d)
-
-                # Once we collect our 4 choice types, then we need to create
-                # permuatations of each combination for trials. These will
-                # be every possible combination of Probe v. Probe, Probe v. 
-                # Control, and Control v. Control for a total of 6 trials.
-                # Furthermore, trials had to flip left/right orientation for 
-                # each combination for a total of 12 unique trials.
-                
-                permutations = []
-                for i in range(len(self.utilized_trials)):
-                    for j in range(len(self.utilized_trials)):
-                        if i != j:
-                            permutations.append((self.utilized_trials[i],
-                                                 self.utilized_trials[j]))
-                            
-                # Permutations is a list of 12 elements, each element contains
-                # two dictionaries. The first dictionary will be on the left,
-                # the second dictionary on the right. In order to make things 
-                # a bit more clear, we convert this permutations list to a 
-                # list of dictionaries, each one containing clear metadata for
-                # each trial including: left assignment, right assignment, 
-                # trial type ("PvP", "PvC", "CvC"), trial number...
-                # For example:
+                # The plan holds every left/right permutation of two probe and
+                # two control stimuli (PvP, PvC and CvC trials) in a random
+                # order, with side-bias elimination (SBE) trials between them.
+                # Each trial is converted to a dictionary of metadata, e.g.:
                 # {'left': {'Name': 'Probe1.jpg', 'TrainingSet': '0', 'StimulusNum': '1'},
                 #  'right': {'Name': 'Probe5.jpg', 'TrainingSet': '0', 'StimulusNum': '5'},
                 #  'trial_type': 'PvP'}
-                
-                self.trial_meta_data_list = []
-                for t in permutations:
-                    left = t[0]
-                    right = t[1]
-                    # Determine trial type
-                    if left['TrainingSet'] == '0' and right['TrainingSet'] == '0':
-                        trial_type = 'PvP'
-                    elif left['TrainingSet'] == right['TrainingSet']:
-                        trial_type = 'CvC'
+                # SBE trials have colors rather than stimuli on each side, e.g.:
+                # {'left': '#77FF00', 'right': '#FF8100', 'trial_type': 'SBE_trial'}
+                for left, right, trial_type in self.session_plan["trials"]:
+                    if trial_type == "SBE_trial":
+                        self.trial_stimulus_order.append({'left': left,
+                                                          'right': right,
+                                                          'trial_type': trial_type})
                     else:
-                        trial_type = 'PvC'
-                    # Load in image files
-                    # Assign metadata to new list
-                    e =  {'left': left,
-                          'right': right,
-                          'trial_type': trial_type}
-                    self.trial_meta_data_list.append(e)
-                    
-                # Shuffle order randomly 
-                shuffle(self.trial_meta_data_list)
-                self.probe_stimulus_order = self.trial_meta_data_list
-                
-                # # Quasi-randomly shuffle trials such that there are no repeats 
-                # # of stimuli
-                # while True:
-                #     bad_shuffle = False # Innocent until proven otherwise
-                #     list_of_trials = deepcopy(self.trial_meta_data_list) # Copy previous list so that we can remove/pop items
-                #     shuffle(list_of_trials)
-                #     rec_counter = 0
-                #     self.probe_stimulus_order = []
-                #     while True:
-                #         # Two end conditions
-                #         if len(list_of_trials) == 1:
-                #             self.probe_stimulus_order.append(list_of_trials[0])
-                #             break
-                        
-                #         if rec_counter > 20: # Start over if too many recursions
-                #             bad_shuffle = True
-                #             break
+                        e = {'left': stimuli_by_name[left],
+                             'right': stimuli_by_name[right],
+                             'trial_type': trial_type}
+                        # Load in image files
+                        e["left"]["img"] = self.stimulus_cache.get(left, self.image_diameter)
+                        e["right"]["img"] = self.stimulus_cache.get(right, self.image_diameter)
+                        self.trial_stimulus_order.append(e)
                         
-                #         l1 = list_of_trials[0]["left"]["Name"]
-                #         r1 = list_of_trials[0]["right"]["Name"]
-                #         l2 = list_of_trials[1]["left"]["Name"]
-                #         r2 = list_of_trials[1]["right"]["Name"]
-                        
-                #         # Check if repeats (sets contain unique vals)
-                #         if len([l1, r1, l2, r2]) != len(set([l1, r1, l2, r2])): 
-                #             i1 = list_of_trials.pop(0)
-                #             shuffle(list_of_trials)
-                #             list_of_trials.insert(0, i1)
-                #             rec_counter += 1
-                            
-                #         else: # If no matches, we can preserve the previous pair
-                #             self.probe_stimulus_order.append(list_of_trials.pop(0))
-                #             rec_counter = 0
-                            
-                #     # Break if good shuffle
-                #     if bad_shuffle == False:
-                #         break # Break while loop
-                        
-                # Finally, load the image files into the dictionary:
-                for i in self.probe_stimulus_order:
-                    i["left"]["img"] = ImageTk.PhotoImage(Image.open(f'P039a_Stimuli/{i["left"]["Name"]}').resize((self.image_diameter, self.image_diameter)))
-                    i["right"]["img"] = ImageTk.PhotoImage(Image.open(f'P039a_Stimuli/{i["right"]["Name"]}').resize((self.image_diameter, self.image_diameter)))
-            
-                # After all our experimental probe trials are compiled, we now
-                # insert our side-bias elimination (SBE) trials between them.
-                
-                size_of_SBE_gaps = [4, 5, 6, 7] * 3
-                shuffle(size_of_SBE_gaps)
-                size_of_SBE_gaps.append(2) # Three SBE trials after the last probe
-                
-                self.trial_stimulus_order = [] # Master list
-                for gap in size_of_SBE_gaps:
-                    g_counter = gap
-                    while g_counter > 0:
-                        # Insert specific SBE stimuli for this trial
-                        possible_SBE_stimuli = ["#77FF00", "#FF8100", "#D5869D",
-                                                "#902090", "#FF1100", "#6B4330"] 
-                        SBE_trial =  {'left': possible_SBE_stimuli.pop(choice(list(range(0, len(possible_SBE_stimuli))))), # Choose and remove a random color from the list
-                                      'right': possible_SBE_stimuli.pop(choice(list(range(0, len(possible_SBE_stimuli))))), # Choose and remove a random color from the list,
-                                      'trial_type': 'SBE_trial'}
-                        self.trial_stimulus_order.append(SBE_trial)
-                        g_counter -= 1
-                    # Once all SBE gaps are appended for this chunk...
-                    if len(self.probe_stimulus_order) > 0:
-                        self.trial_stimulus_order.append(self.probe_stimulus_order.pop(0))
-                        
-                # Create a list of left/right correct choices for SBE trials
-                
-                premade_list1 = ["left", "right", "left", "right", "right", "left", "left", "right", "right", "left",
-                                 "right", "left", "left", "right", "left", "right", "right", "left", "right", "left",
-                                 "left", "right", "left", "right", "left", "right", "left", "right", "right", "left",
-                                 "right", "left", "left", "right", "left", "right", "left", "right", "left", "right",
-                                 "right", "left", "left", "right", "right", "left", "left", "right", "left", "right",
-                                 "left", "right", "left", "left", "right", "right", "left", "right", "left", "right",
-                                 "left", "right", "left", "right", "left", "right", "left", "right"]
-                
-                premade_list2 = ["right", "left", "left", "right", "left", "right", "right", "left", "left", "right",
-                                 "right", "left", "right", "left", "right", "left", "left", "right", "left", "right",
-                                 "right", "left", "right", "left", "right", "left", "right", "left", "left", "right",
-                                 "left", "right", "right", "left", "right", "left", "left", "right", "left", "right",
-                                 "right", "left", "right", "left", "right", "left", "left", "right", "left", "right",
-                                 "right", "left", "left", "right", "left", "right", "right", "left", "right", "left",
-                                 "right", "left", "right", "left", "left", "right", "left", "right", "right", "left"]
-                
-                
-                premade_list3 = ["left", "left", "right", "left", "right", "right", "left", "right", "left", "left",
-                                 "right", "right", "left", "right", "right", "left", "left", "right", "left", "right",
-                                 "left", "right", "right", "left", "right", "left", "left", "right", "left", "right",
-                                 "right", "left", "right", "left", "left", "right", "right", "left", "left", "right",
-                                 "left", "right", "left", "right", "right", "left", "left", "right", "right", "left",
-                                 "right", "left", "right", "right", "left", "left", "right", "left", "right", "left",
-                                 "left", "right", "left", "right", "right", "left", "right", "left"]
-                
-                premade_list4 = ["right", "right", "left", "right", "left", "left", "right", "left", "right", "right",
-                                 "left", "right", "left", "left", "right", "left", "right", "right", "left", "right",
-                                 "left", "left", "right", "left", "right", "right", "left", "right", "left", "left",
-                                 "right", "left", "right", "right", "left", "right", "left", "left", "right", "left",
-                                 "right", "right", "left", "right", "left", "left", "right", "left", "right", "right",
-                                 "left", "right", "left", "left", "right", "left", "right", "right", "left", "right",
-                                 "left", "left", "right", "left", "right", "right", "left", "left"]
-                
-                premade_lists = [premade_list1, premade_list2, premade_list3, premade_list4]
-
-                # Directly choose one of the premade lists
-                self.correct_choice_list = choice(premade_lists)
+                # The left/right correct choices for SBE trials
+                self.correct_choice_list = self.session_plan["correct_choice_list"]
 
+            if self.training_phase in [1, 2]:
+                print(self.stimulus_cache.report())
+            # Lastly, start the session's journal (or pick up where the
+            # interrupted session left off)
+            if self.resume_state is not None:
+                self.resume_session()
+            elif self.record_data:
+                self.open_journal()
+            print(f"Session setup took {(perf_counter() - setup_timer_start)*1000:.1f} ms")
+            
             # After the order of stimuli per trial is determined, there are a 
             # couple other things that neeed to occur during the first ITI:
             if self.subject_ID == "TEST": # If test, don't worry about ITI delays
                 self.ITI_duration = 5 * 1000
                 self.hopper_duration = 2 * 1000
                 self.trial_delay_duration = 1 * 1000
-                self.root.after(1, lambda: self.ITI())
+                self.set_timer("session_start", 1, "start")
             else:
-                self.root.after(60000, lambda: self.ITI())
+                self.set_timer("session_start", 60000, "start")
                 
         ### hopper_light_GPIO_num
         if self.record_video:
@@ -745,50 +733,152 @@ class MainScreen(object):
             record_str = "OFF"
             
         self.root.bind("<space>", first_ITI) # bind cursor state to "space" key
+        resume_str = ""
+        if self.resume_state is not None:
+            resume_str = f"\n RESUMING from trial {self.resume_state.next_trial}"
         self.mastercanvas.create_text(512,374,
                                       fill="white",
                                       font="Times 25 italic bold",
-                                      text=f" Place bird in box, then press space\n\n Experiment: P039a  \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]} \n Cameras: {record_str}")
+                                      text=f" Place bird in box, then press space\n\n Experiment: P039a  \n Subject: {self.subject_ID} \n Training Phase {self.training_phase_name_list[self.training_phase]} \n Cameras: {record_str}{resume_str}")
+    
+    def data_file_path(self):
+        # The session's data .csv, named after the subject, start time and phase
+        return f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P034b_data-Phase{self.training_phase}.csv"
+    
+    def open_journal(self):
+        # Starts the session's journal next to the data .csv. Everything in
+        # it is written by the data writer thread, in order with the events.
+        self.myFile_loc = self.data_file_path()
+        self.journal = SessionJournal(journal_path(self.myFile_loc))
+        self.io_writer.journal = self.journal
+        self.journal_record("session", {"subject": self.subject_ID,
+                                        "phase": self.training_phase,
+                                        "data_file": self.myFile_loc,
+                                        "start_time": self.start_time.isoformat(),
+                                        "plan": self.session_plan})
+        
+    def journal_record(self, kind, value):
+        # Adds a record to the journal (if there is one), on the writer thread
+        if self.journal is not None:
+            self.io_writer.submit_task(lambda: self.journal.write(kind, value))
+            
+    def journal_resume_point(self, previous_choice_correct = None):
+        # Journals where to resume from if the session is interrupted: the
+        # state the next ITI starts from (see P039_Journal.py).
+        # previous_choice_correct is the outcome of the trial, if it is
+        # already known but not yet set.
+        if previous_choice_correct is None:
+            previous_choice_correct = self.previous_choice_correct
+        self.journal_record("trial", {"trial_num": self.trial_num,
+                                      "previous_choice_correct": previous_choice_correct,
+                                      "correction_trial": self.correction_trial,
+                                      "reinforcers": self.reinforcers_delivered})
+        
+    def close_journal(self):
+        # Runs on the writer thread, once the session's last rows are written
+        self.io_writer.journal = None
+        self.journal.close()
+        
+    def resume_session(self):
+        # Carries on with an interrupted session (see P039_Journal.py). The
+        # session keeps its start time (so SessionTime counts the time since
+        # the session first started) and its data file, which is first
+        # brought up to date with the rows that only made it into the journal.
+        state = self.resume_state
+        self.start_time = datetime.fromisoformat(state.session["start_time"])
+        elapsed_s = (self.scheduler.wall_clock() - self.start_time).total_seconds()
+        self.start_ns = self.scheduler.monotonic_ns() - int(elapsed_s * 1e9)
+        self.myFile_loc = state.session["data_file"]
+        recovered = recover_data_file(self.myFile_loc, DATA_HEADER_LIST, state.rows)
+        self.data_writer = StreamingSessionWriter(self.myFile_loc)
+        self.data_writer.rows_written = 1 # Append after what is already in the file
+        self.journal = SessionJournal(state.file_path)
+        self.io_writer.journal = self.journal
+        self.journal_record("resumed", self.scheduler.wall_clock().isoformat())
+        
+        # Back to the start of the ITI before the interrupted trial (the
+        # ITI picks the trial's stimuli, ITI and ratio requirement from the
+        # plan). If the last trial had already been reinforced (or its
+        # correction timeout had started), that is the ITI that follows it.
+        trial = state.trial or {}
+        self.trial_num = trial.get("trial_num", 0)
+        self.previous_choice_correct = trial.get("previous_choice_correct", True)
+        self.correction_trial = trial.get("correction_trial", False)
+        self.reinforcers_delivered = trial.get("reinforcers", 0)
+        if self.training_phase != 0 and self.trial_num > 0:
+            self.trial_info = self.trial_stimulus_order[self.trial_num - 1]
+            self.trial_type = self.trial_info['trial_type']
+            if self.trial_type == "SBE_trial":
+                self.correct_choice = self.correct_choice_list[self.trial_num - 1]
+        for choice in state.choices: # Live choice statistics (up to the interrupted trial)
+            if choice[0] <= self.trial_num:
+                self.choice_stats.record(*choice[1:])
+        self.resume_event_pending = True # Written once the ITI has set up the trial
+        print(f"Session resumed at trial {state.next_trial} ({len(state.rows)} events in the journal, "
+              f"{recovered} added to the data file)")
     
     ## Video recording functions to start and stop recording from both top and side both cameras
     
-    def start_recording_video(self):
-        try:
-            # First, we need to set up the save directories to organize video files
-            current_date = strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
-            file_parent_directory = f"Desktop/Videos/{self.subject_ID}/Phase{self.training_phase}/{self.subject_ID}_{current_date}"
-            # Make subject folder if it doesn't already exist
-            makedirs(f"{os_path.expanduser('~')}/{file_parent_directory}", exist_ok = True)
+    def start_recording_video(self, on_confirmed = None):
+        # Asks the cameras to start recording without waiting for them. Once
+        # the start script finishes, the start (or failure) is written to the
+        # data with its latency, and on_confirmed() is called if given.
+        # First, we need to set up the save directories to organize video files
+        current_date = self.scheduler.wall_clock().strftime("%Y-%m-%d")  # Format: YYYY-MM-DD
+        file_parent_directory = f"Desktop/Videos/{self.subject_ID}/Phase{self.training_phase}/{self.subject_ID}_{current_date}"
+        # Make subject folder if it doesn't already exist
+        makedirs(f"{os_path.expanduser('~')}/{file_parent_directory}", exist_ok = True)
 
-            # Then we can name files
-            base_filename = f"{self.subject_ID}_Phase{self.training_phase}_{current_date}_Trial{self.trial_num}-{self.trial_type}"
-            
-            # Differentiate top/side cam filenames
-            self.top_filename  = f"{base_filename}_TOPcam.mp4"
-            self.side_filename = f"{base_filename}_SIDEcam.mp4"
-            
-            #Start recording with the generated filenames by calling shell script
-            run([
-                str(os_path.expanduser('~')+"/Desktop/Video_Recording_Software/start_recording.sh"),
-                f"{file_parent_directory}/{self.top_filename}", # $1 .sh argument
-                f"{file_parent_directory}/{self.side_filename}" # $2 .sh argument
-            ])
-            
-            # Then set local .py variables and write data
-            self.currently_recording = True
-            self.write_data(None,"video_recording_started")
-        except FileNotFoundError:
-            print("ERROR starting video recording: Cannot find 'start_recording.sh' shell script")
+        # Then we can name files
+        base_filename = f"{self.subject_ID}_Phase{self.training_phase}_{current_date}_Trial{self.trial_num}-{self.trial_type}"
+        
+        # Differentiate top/side cam filenames
+        self.top_filename  = f"{base_filename}_TOPcam.mp4"
+        self.side_filename = f"{base_filename}_SIDEcam.mp4"
+        self.currently_recording = True # (So that it is stopped at the end of the trial)
+        
+        def recording_started(succeeded, latency_ms, message):
+            if succeeded:
+                self.write_data(None, "video_recording_started", latency_ms)
+            else:
+                print(f"ERROR starting video recording: {message}")
+                self.write_data(None, "video_recording_failed", latency_ms)
+            if on_confirmed is not None:
+                on_confirmed()
+        
+        #Start recording with the generated filenames by calling shell script
+        self.video_recorder.start(f"{file_parent_directory}/{self.top_filename}", # $1 .sh argument
+                                  f"{file_parent_directory}/{self.side_filename}", # $2 .sh argument
+                                  recording_started)
         
     
     def stop_recording_video(self):
-        run([
-            str(os_path.expanduser('~')+"/Desktop/Video_Recording_Software/stop_recording.sh"),
-            str(self.trial_num)
-        ])
+        # Asks the cameras to stop recording (without waiting for them)
+        def recording_stopped(succeeded, latency_ms, message):
+            if succeeded:
+                self.write_data(None, "video_recording_stopped", latency_ms)
+            else:
+                print(f"ERROR stopping video recording: {message}")
+                self.write_data(None, "video_recording_stop_failed", latency_ms)
+                
         self.currently_recording = False
-        self.write_data(None,"video_recording_stopped")
-    
+        self.video_recorder.stop(self.trial_num, recording_stopped)
+        
+    def set_timer(self, purpose, delay_ms, event):
+        # Fires a trial event (see P039_TrialFSM.py) after delay_ms. The
+        # timer is kept in the timer registry under purpose (see
+        # P039_Timers.py); returns the after ID.
+        return self.timers.after(purpose, delay_ms, lambda: self.trial_fsm.fire(event),
+                                 event)
+        
+    def cancel_stale_timers(self, state, next_state):
+        # Called by the trial state machine whenever the state changes
+        self.timers.cancel_stale(self.trial_fsm.handles)
+        
+    def start_trial_recording(self):
+        # Choice task: the cameras are started 3 s before the end of the ITI,
+        # and the trial waits for them to confirm
+        self.start_recording_video(on_confirmed = lambda: self.trial_fsm.fire("cameras_started"))
             
     
     ## %% ITI
@@ -800,21 +890,12 @@ class MainScreen(object):
     #   4) Moves on to the next trial after a delay
     # 
     def ITI (self):
-        # This function just clear the screen. It will be used a lot in the future, too.
-        self.clear_canvas()
-        
-        # Make sure pecks during ITI are saved
-        self.mastercanvas.create_rectangle(0,0,
-                                           self.mainscreen_width,
-                                           self.mainscreen_height,
-                                           fill = "black",
-                                           outline = "black",
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "ITI_peck": 
-                                       self.write_data(event, event_type))
+        # This function just clears the screen to black. Pecks during the
+        # ITI are still saved (on the black background).
+        self.background_event_type = "ITI_peck"
+        self.scene.show(["background"],
+                        {("background", "rect"): {"fill": "black",
+                                                  "outline": "black"}})
             
         # Stop recording if we were recording
         if self.currently_recording:
@@ -826,7 +907,7 @@ class MainScreen(object):
         # if the max time or reinforcers earned limits are reached).
         if self.trial_num >= self.max_number_of_reinforced_trials: 
             print("Trial max reached")
-            self.exit_program("TrialsCompleted")
+            self.trial_fsm.fire("trials_completed", "TrialsCompleted")
             
         # elif datetime.now() >= (self.session_duration):
         #    print("Time max reached")
@@ -837,26 +918,20 @@ class MainScreen(object):
         # within this function is still executed before moving on.
         else: 
             # Print text on screen if a test (should be black if an experimental trial)
-            if not operant_box_version or self.subject_ID == "TEST":
-                self.mastercanvas.create_text(512,374,
-                                              fill="white",
-                                              font="Times 25 italic bold",
-                                              text=f"ITI ({int(self.ITI_duration/1000)} sec.)")
+            if not self.operant_box_version or self.subject_ID == "TEST":
+                self.show_message(f"ITI ({int(self.ITI_duration/1000)} sec.)")
                 
             # This turns all the stimuli off from the previous trial (during the
             # ITI).
-            if operant_box_version:
-                rpi_board.write(hopper_light_GPIO_num,
-                                False) # Turn off the hopper light
-                rpi_board.set_servo_pulsewidth(servo_GPIO_num,
-                                               hopper_down_val) # Hopper down
-                rpi_board.write(house_light_GPIO_num, 
-                                False) # Turn off house light
-                # Stop recording
+            self.hardware.hopper_light(False) # Turn off the hopper light
+            self.hardware.hopper(False) # Hopper down
+            self.hardware.house_light(False) # Turn off house light
                 
             # Reset other variables for the following trial.
-            self.trial_start = time() # Set trial start time (note that it includes the ITI, which is subtracted later)
-            self.trial_substage_start_time = time() # Reset substage timer
+            self.ITI_start_ns = self.scheduler.monotonic_ns() # Set ITI start time (the trial begins once it is over)
+            self.trial_begin_ns = None
+            self.substage_start_ns = self.ITI_start_ns # Reset substage timer
+            self.journal_resume_point()
             self.write_comp_data(False) # update data .csv with trial data from the previous trial
             self.trial_stage = 1 # Reset trial substage
 
@@ -875,18 +950,19 @@ class MainScreen(object):
                     self.correction_trial = True
             except IndexError:
                 print("Trial max reached")
-                self.exit_program("TrialsCompleted")
+                self.trial_fsm.fire("trials_completed", "TrialsCompleted")
+                return # (the session ends as soon as the ITI has returned)
 
             
             # Setup variable ITI and RR
             if self.training_phase == 0:
-                self.ITI_duration    = choice(list(range(10,21))) * 1000
-                self.trial_RR        = choice(list(range(3, 8))) # RR5
+                self.ITI_duration    = self.session_plan["ITI_durations"][self.trial_num - 1] # 10-20 s
+                self.trial_RR        = self.session_plan["ratio_requirements"][self.trial_num - 1] # RR5
                 self.button_presses  = 0  
                 
             elif self.training_phase == 1: 
-                self.ITI_duration    = choice(list(range(10,21))) * 1000
-                self.trial_RR        = choice(list(range(7, 13))) # RR10
+                self.ITI_duration    = self.session_plan["ITI_durations"][self.trial_num - 1] # 10-20 s
+                self.trial_RR        = self.session_plan["ratio_requirements"][self.trial_num - 1] # RR10
                 self.button_presses  = 0
                 
             elif self.training_phase == 2:
@@ -898,21 +974,24 @@ class MainScreen(object):
                 
             if self.subject_ID == "TEST":
                 self.ITI_duration = 1 * 1000
-            
-            #Start recording function for choice task (during ITI)
-            def start_recording_ITI():
-                self.start_recording_video()
-                self.root.after(3*1000, self.sub_stage_one)
                 
-            # Next, set a delay timer to proceed to the next trial
+            if self.resume_event_pending:
+                self.resume_event_pending = False
+                self.write_data(None, "SessionResumed")
+            
+            # Next, set a delay timer to proceed to the next trial. For the
+            # choice task, recording is started 3 s before the end of the ITI
+            # and the trial only begins once the ITI is over and the cameras
+            # have confirmed they are recording (the state machine waits for
+            # both).
+            self.drift.start("ITI", self.ITI_duration, self.trial_num)
+            self.set_timer("ITI", self.ITI_duration, "ITI_elapsed")
             if self.record_video and self.training_phase == 2:
-                self.root.after((self.ITI_duration - 3*1000), start_recording_ITI)
-            else: 
-                self.root.after(self.ITI_duration, self.sub_stage_one)
+                self.set_timer("recording_start", self.ITI_duration - 3*1000, "recording_due")
                 
             # Finally, print terminal feedback "headers" for each event within the next trial
-            print(f"\n{'*'*30} Trial {self.trial_num} begins {'*'*30}") # Terminal feedback...
-            print(f"{'Event Type':>30} | Xcord.   Ycord. | Stage | Session Time")
+            self.io_writer.console(f"\n{'*'*30} Trial {self.trial_num} begins {'*'*30}") # Terminal feedback...
+            self.io_writer.console(f"{'Event Type':>30} | Xcord.   Ycord. | Stage | Session Time")
         
     #%%  Pre-choice loop 
     """
@@ -934,271 +1013,247 @@ class MainScreen(object):
 
     """
     def sub_stage_one(self):
-        self.clear_canvas()
-        self.trial_substage_start_time = time()
+        self.stage_change_started_ns = perf_counter_ns() # For the stimulus onset latency
+        self.substage_start_ns = self.scheduler.monotonic_ns()
+        if self.trial_begin_ns is None: # (not after a correction timeout)
+            self.trial_begin_ns = self.substage_start_ns # The ITI is over
+            self.drift.finish("ITI")
+        self.drift.finish("correction_timeout")
         self.trial_stage = 1
-        if operant_box_version:
-            rpi_board.write(house_light_GPIO_num,
-                            True) # Turn on the houselight
+        self.hardware.house_light(True) # Turn on the houselight
+        if self.operant_box_version:
             if self.record_video and self.training_phase in [0,1]:  # Video recording for 2 starts during ITI
                 self.start_recording_video()
         self.build_keys()
         if self.training_phase in [0,1]:
-            self.root.after(self.trial_delay_duration, self.sub_stage_two)
+            self.drift.start("trial_delay", self.trial_delay_duration, self.trial_num)
+            self.set_timer("trial_delay", self.trial_delay_duration, "delay_elapsed")
         
         
     def sub_stage_two(self):
-        self.trial_substage_start_time = time()
+        self.stage_change_started_ns = perf_counter_ns() # For the stimulus onset latency
+        self.substage_start_ns = self.scheduler.monotonic_ns()
+        self.drift.finish("trial_delay")
         self.trial_stage = 2
         self.build_keys()
         if self.training_phase in [0,1]:
-            self.auto_timer = self.root.after(self.auto_reinforcer_timer,
-                                              lambda: self.provide_food(False)) # False b/c non autoreinforced
+            self.drift.start("auto_reinforcer", self.auto_reinforcer_timer, self.trial_num)
+            self.set_timer("auto_reinforcer", self.auto_reinforcer_timer,
+                           "auto_timer_elapsed")
     
         
-    def build_keys(self):
-        # This is a function that builds the all the buttons on the Tkinter
-        # Canvas. The Tkinter code (and geometry) may appear a little dense
-        # here, but it follows many of the same rules. All keys will be built
-        # during non-ITI intervals, but they will only be filled in and active
-        # during specific times. However, pecks to keys will be differentiated
-        # regardless of activity.
+    def build_scene(self):
+        # Builds every item the session will show on the Canvas, once, at the
+        # start of the session. The items are hidden and grouped into layouts
+        # that build_keys() (and the ITI, correction timeout, etc.) show and
+        # hide as the trial moves along; only the images and colors that
+        # change between trials are updated then (see P039_Scene.py). The
+        # first tag of each item names the key it belongs to ("bkgrd",
+        # "left_stimulus_key", ...); that is what touch() passes on when it
+        # is pecked. The Tkinter code (and geometry) may appear a little dense
+        # here, but it follows many of the same rules.
+        scene = CanvasScene(self.mastercanvas,
+                            after_idle = lambda callback: self.timers.after_idle("stimulus_onset", callback),
+                            on_visible = self.peck_latency.record_onset)
+        receptive_field_scalar = 3.5
+        SBE_scalar = 2.7
+        if self.subject_ID == "TEST":
+            receptive_field_outline_color = "red"
+        else:
+            receptive_field_outline_color = "#7F7F7F" # grey
         
         # First, build the background. This basically builds a button the size of 
         # screen to track any pecks; buttons built on top of this button will
         # NOT count as background pecks but as key pecks, because the object is
         # covering that part of the background. Once a peck is made, an event line
-        # is appended to the data matrix.
-        
-        receptive_field_scalar = 3.5
-        SBE_scalar = 2.7
-        
-        self.mastercanvas.create_rectangle(0,0,
-                                           self.mainscreen_width,
-                                           self.mainscreen_height,
-                                           fill = "#7F7F7F", #"red", 
-                                           outline = "#7F7F7F",
-                                           tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "background_peck": 
-                                       self.write_data(event, event_type))
+        # is appended to the data matrix. Its color and event type (e.g., 
+        # "ITI_peck" or "background_peck") change with the stage.
+        scene.create("background", "rect", "rectangle",
+                     0, 0,
+                     self.mainscreen_width,
+                     self.mainscreen_height,
+                     fill = "#7F7F7F",
+                     outline = "#7F7F7F",
+                     tags = ("bkgrd",))
         # Pre-training
-        if self.training_phase == 0 and self.trial_stage == 2:
+        if self.training_phase == 0:
             # Build our pre-training stimulus, which is the same as SBE stimuli
-            self.mastercanvas.create_rectangle(392, 258, 609, 475,
-                                          fill = "#7F7F7F",
-                                          outline = "",
-                                          tag = "pretraining_key")
+            scene.create("pretraining", None, "rectangle", 392, 258, 609, 475,
+                         fill = "#7F7F7F",
+                         outline = "",
+                         tags = ("pretraining_key",))
+            scene.create("pretraining", None, "arc", 227, 273, 594, 615,
+                         fill      = "#2596be",
+                         outline   = "black",
+                         extent    = 70,
+                         tags      = ("pretraining_key",))
+            scene.create("pretraining", None, "oval", 502, 377, 504, 379,
+                         fill      = "black",
+                         outline   = "black",
+                         tags      = ("pretraining_key",))
             
-            self.mastercanvas.create_arc(227, 273, 594, 615,
-                                          fill      = "#2596be",
-                                          outline   = "black",
-                                          extent = 70,
-                                          tag       = "pretraining_key")
+        # Mixed-autoshaping
+        elif self.training_phase == 1:
+            # Receptive field should encompass all shapes
+            scene.create("stimulus", None, "oval", 189, 129, 832, 639,
+                         fill      = "#7F7F7F",
+                         outline   = "#7F7F7F",
+                         width     = 1, 
+                         tags      = ("stimulus_key",))
+            # The image on top of receptive field (set for each trial)
+            scene.create("stimulus", "image", "image", *self.image_center,
+                         anchor = 'center',
+                         image  = "",
+                         tags   = ("stimulus_key",))
             
-            self.mastercanvas.create_oval(502, 377, 504, 379,
-                                          fill      = "black",
-                                          outline   = "black",
-                                          tag       = "pretraining_key")
+        # Choice phase
+        elif self.training_phase == 2:
+            left_x, left_y = self.choice_key_coord_dict["left_choice"]
+            right_x, right_y = self.choice_key_coord_dict["right_choice"]
+            
+            # Side-bias elimination (SBE) trials: receptive fields (which
+            # manage the outcome) with colored arcs on top. The arc colors
+            # are set for each trial. We changed rectangles to some irregular
+            # and novel shape not used in any stimuli.
+            key_diameter = 50
+            scene.create("SBE_keys", None, "oval",
+                         left_x - key_diameter * receptive_field_scalar + 110,
+                         left_y - key_diameter * receptive_field_scalar + 330,
+                         left_x + key_diameter / receptive_field_scalar + 110,
+                         left_y + key_diameter / receptive_field_scalar + 330,
+                         outline = receptive_field_outline_color,
+                         fill    = "#7F7F7F", 
+                         tags    = ("left_stimulus_key",))
+            scene.create("SBE_keys", None, "oval",
+                         right_x - key_diameter * receptive_field_scalar + 30,
+                         right_y - key_diameter * receptive_field_scalar + 330,
+                         right_x + key_diameter / receptive_field_scalar + 30,
+                         right_y + key_diameter / receptive_field_scalar + 330,
+                         outline = receptive_field_outline_color,
+                         fill    = "#7F7F7F", 
+                         tags    = ("right_stimulus_key",))
+            scene.create("SBE_keys", "left_arc", "arc",
+                         left_x - key_diameter * SBE_scalar - 40,
+                         left_y - key_diameter * SBE_scalar + 300,
+                         left_x + key_diameter * SBE_scalar - 40,
+                         left_y + key_diameter * SBE_scalar + 300,
+                         extent  = 70,
+                         outline = "black",
+                         fill    = "#7F7F7F", 
+                         tags    = ("left_stimulus_key",))
+            scene.create("SBE_keys", "right_arc", "arc",
+                         right_x - key_diameter * SBE_scalar - 120,
+                         right_y - key_diameter * SBE_scalar + 300,
+                         right_x + key_diameter * SBE_scalar - 120,
+                         right_y + key_diameter * SBE_scalar + 300,
+                         extent  = 70,
+                         outline = "black",
+                         fill    = "#7F7F7F", 
+                         tags    = ("right_stimulus_key",))
+            
+            # Choice trials: receptive fields with the stimulus images on top
+            key_diameter = 65
+            scene.create("choice_keys", None, "oval",
+                         left_x - key_diameter * 3.5 + 95,
+                         left_y - key_diameter * 3.5 + 315,
+                         left_x + key_diameter / 3.5 + 95,
+                         left_y + key_diameter / 3.5 + 315,
+                         outline = receptive_field_outline_color,
+                         fill    = "#7F7F7F", 
+                         tags    = ("left_stimulus_key",))
+            scene.create("choice_keys", None, "oval",
+                         right_x - key_diameter * 3.5 + 68,
+                         right_y - key_diameter * 3.5 + 315,
+                         right_x + key_diameter / 3.5 + 68,
+                         right_y + key_diameter / 3.5 + 315,
+                         outline = receptive_field_outline_color,
+                         fill    = "#7F7F7F", 
+                         tags    = ("right_stimulus_key",))
+            scene.create("choice_keys", "left_image", "image",
+                         left_x, left_y + 210,
+                         anchor = 'center',
+                         image  = "",
+                         tags   = ("left_stimulus_key",))
+            scene.create("choice_keys", "right_image", "image",
+                         right_x, right_y + 210,
+                         anchor = 'center',
+                         image  = "",
+                         tags   = ("right_stimulus_key",))
             
-            self.mastercanvas.tag_bind("pretraining_key",
-                                       "<Button-1>",
-                                       lambda event,
-                                       ks = "pretraining_key": self.key_press(event,
-                                                                    ks))
+            # Our terminal link oval stimuli
+            scene.create("terminal_link", None, "oval", 392, 258, 609, 475,
+                         fill    = "#7F7F7F",
+                         outline = "",
+                         tags    = ("terminallink_key",))
+            scene.create("terminal_link", None, "oval", 417, 283, 584, 450,
+                         fill    = "#D5869D",
+                         outline = "black",
+                         tags    = ("terminallink_key",))
+            scene.create("terminal_link", None, "oval", 500, 365, 502, 367,
+                         fill    = "black",
+                         outline = "black",
+                         tags    = ("terminallink_key",))
+            
+        # Onscreen feedback text (only shown in the test version), on top
+        scene.create("message", "text", "text", 512, 374,
+                     fill = "white",
+                     font = "Times 25 italic bold",
+                     text = "")
+        return scene
+    
+    def build_touch_geometry(self):
+        # The shapes of every key in the scene, and the points that the
+        # distances in the data are measured from (the center stimulus, plus
+        # the left and right choice keys in the choice phase)
+        anchors = {"center": self.image_center}
+        if self.training_phase == 2:
+            anchors["left"] = self.choice_key_coord_dict["left_choice"]
+            anchors["right"] = self.choice_key_coord_dict["right_choice"]
+        return TouchGeometry(self.scene, anchors)
+    
+    def show_message(self, text):
+        # Puts a line of feedback text on top of whatever is on screen
+        self.scene.add("message", {("message", "text"): {"text": text}})
+        
+    def build_keys(self):
+        # Shows all the keys for the current phase, trial stage and trial
+        # on the Canvas. All keys were built at the start of the session
+        # (build_scene), so here they are only shown or hidden and given
+        # this trial's images or colors. Pecks to keys will be differentiated
+        # regardless of activity. The time from the start of the stage change
+        # until the keys are on screen is recorded (stimulus onset latency).
+        self.background_event_type = "background_peck"
+        layouts = ["background"]
+        configure = {("background", "rect"): {"fill": "#7F7F7F",
+                                              "outline": "#7F7F7F"}}
+        # Pre-training
+        if self.training_phase == 0 and self.trial_stage == 2:
+            layouts.append("pretraining")
         # Mixed-autoshaping
         if self.training_phase == 1 and self.trial_stage == 2:
-                # COMPLETED: Receptive field should encompass all shapes (350p diameter rn)
-                self.mastercanvas.create_oval(189, 129, 832, 639,
-                                              fill      = "#7F7F7F",
-                                              outline   = "#7F7F7F", #"#7F7F7F" Add grey...
-                                              width     = 1, 
-                                              tag       = "stimulus_key")
-                
-                #Build the image on top of receptive field
-                self.mastercanvas.create_image(*self.image_center,
-                                               anchor ='center',
-                                               image  = self.trial_info["img"],
-                                               tag    = "stimulus_key"
-                                               )
-                
-               
-                
-                self.mastercanvas.tag_bind("stimulus_key",
-                                           "<Button-1>",
-                                           lambda event,
-                                           ks = "stimulus_key": self.key_press(event,
-                                                                        ks))
+            layouts.append("stimulus")
+            configure[("stimulus", "image")] = {"image": self.trial_info["img"]}
         # Choice phase
         elif self.training_phase == 2:
             # Binary choice sub-phase 1
             if self.trial_stage == 1:
                 if self.trial_type == "SBE_trial":
-                    # Setup l/r coordinate and image info
-                    left_key_color = self.trial_info['left']
-                    right_key_color = self.trial_info['right']
-                    key_diameter = 50
-                    if self.subject_ID == "TEST":
-                        receptive_field_outline_color = "red"
-                    else:
-                        receptive_field_outline_color = "#7F7F7F" # grey
-                    
-                    # Left Receptive field
-                    self.mastercanvas.create_oval(self.choice_key_coord_dict["left_choice"][0] - key_diameter * receptive_field_scalar + 110,
-                                                       self.choice_key_coord_dict["left_choice"][1] - key_diameter * receptive_field_scalar + 330,
-                                                       self.choice_key_coord_dict["left_choice"][0] + key_diameter / receptive_field_scalar + 110,
-                                                       self.choice_key_coord_dict["left_choice"][1] + key_diameter / receptive_field_scalar + 330,
-                                                       outline = receptive_field_outline_color,
-                                                       fill = "#7F7F7F", 
-                                                       tag      = "left_stimulus_key" # Because receptive field will manage outcome
-                                                   )  
-                    
-                    # Right Receptive Field
-                    self.mastercanvas.create_oval(self.choice_key_coord_dict["right_choice"][0] - key_diameter * receptive_field_scalar + 30,
-                                                       self.choice_key_coord_dict["right_choice"][1] - key_diameter * receptive_field_scalar + 330,
-                                                       self.choice_key_coord_dict["right_choice"][0] + key_diameter / receptive_field_scalar + 30 ,
-                                                       self.choice_key_coord_dict["right_choice"][1] + key_diameter / receptive_field_scalar + 330,
-                                                       outline = receptive_field_outline_color,
-                                                       fill = "#7F7F7F", 
-                                                       tag      = "right_stimulus_key" # Because receptive field will manage outcome
-                                                   )
-                    
-                    # Change rectangles to some irregular and novel shape not used in any stimuli
-                    # Left image
-                    self.mastercanvas.create_arc(self.choice_key_coord_dict["left_choice"][0] - key_diameter * SBE_scalar - 40,
-                                                       self.choice_key_coord_dict["left_choice"][1] - key_diameter * SBE_scalar + 300,
-                                                       self.choice_key_coord_dict["left_choice"][0] + key_diameter * SBE_scalar - 40,
-                                                       self.choice_key_coord_dict["left_choice"][1] + key_diameter * SBE_scalar + 300,
-                                                       extent = 70,
-                                                       outline = "black",
-                                                       fill = left_key_color, 
-                                                       tag      = "left_stimulus_key" # Because receptive field will manage outcome
-                                                   )
-                    # Right image
-                    self.mastercanvas.create_arc(self.choice_key_coord_dict["right_choice"][0] - key_diameter * SBE_scalar - 120,
-                                                       self.choice_key_coord_dict["right_choice"][1] - key_diameter * SBE_scalar + 300,
-                                                       self.choice_key_coord_dict["right_choice"][0] + key_diameter * SBE_scalar - 120,
-                                                       self.choice_key_coord_dict["right_choice"][1] + key_diameter * SBE_scalar + 300,
-                                                       extent = 70,
-                                                       outline = "black",
-                                                       fill = right_key_color, 
-                                                       tag      = "right_stimulus_key" # Because receptive field will manage outcome
-                                                   )
-                    # Reset background
-                    self.mastercanvas.tag_bind("bkgrd",
-                                               "<Button-1>",
-                                               lambda event, 
-                                               event_type = "background_peck": 
-                                                   self.write_data(event, event_type))
-                        
-                    
-                    ## Setup tagged functions
-                    self.mastercanvas.tag_bind("left_stimulus_key",
-                                               "<Button-1>",
-                                               lambda event,
-                                               ks = "left_stimulus_key": self.key_press(event,
-                                                                            ks))
-                    
-                    self.mastercanvas.tag_bind("right_stimulus_key",
-                                               "<Button-1>",
-                                               lambda event,
-                                               ks = "right_stimulus_key": self.key_press(event,
-                                                                            ks))
-                    
+                    layouts.append("SBE_keys")
+                    configure[("SBE_keys", "left_arc")] = {"fill": self.trial_info['left']}
+                    configure[("SBE_keys", "right_arc")] = {"fill": self.trial_info['right']}
                 else:
-                    key_diameter = 65
-                    if self.subject_ID == "TEST":
-                        receptive_field_outline_color = "red"
-                    else:
-                        receptive_field_outline_color = "#7F7F7F" # grey
-
-                    # Left Receptive field
-                    self.mastercanvas.create_oval(self.choice_key_coord_dict["left_choice"][0] - key_diameter * 3.5 + 95,
-                                                       self.choice_key_coord_dict["left_choice"][1] - key_diameter * 3.5 + 315,
-                                                       self.choice_key_coord_dict["left_choice"][0] + key_diameter / 3.5 + 95,
-                                                       self.choice_key_coord_dict["left_choice"][1] + key_diameter / 3.5 + 315,
-                                                       outline = receptive_field_outline_color,
-                                                       fill = "#7F7F7F", 
-                                                       tag      = "left_stimulus_key" # Because receptive field will manage outcome
-                                                   )  
-                    
-                    # Right Receptive Field
-                    self.mastercanvas.create_oval(self.choice_key_coord_dict["right_choice"][0] - key_diameter * 3.5 + 68,
-                                                       self.choice_key_coord_dict["right_choice"][1] - key_diameter * 3.5 + 315,
-                                                       self.choice_key_coord_dict["right_choice"][0] + key_diameter / 3.5 + 68,
-                                                       self.choice_key_coord_dict["right_choice"][1] + key_diameter / 3.5 + 315,
-                                                       outline = receptive_field_outline_color,
-                                                       fill = "#7F7F7F", 
-                                                       tag      = "right_stimulus_key" # Because receptive field will manage outcome
-                                                   )
-
-                    # Setup l/r coordinate and image info
-                    left_key_data = self.trial_info['left']
-                    right_key_data = self.trial_info['right']
-                    
-                    # Left image
-                    self.mastercanvas.create_image(self.choice_key_coord_dict["left_choice"][0],
-                                                   self.choice_key_coord_dict["left_choice"][1] + 210,
-                                                   anchor   = 'center',
-                                                   image    = left_key_data["img"],
-                                                   tag      = "left_stimulus_key" # Because receptive field will manage outcome
-                                                   )
-                    # Right image
-                    self.mastercanvas.create_image(self.choice_key_coord_dict["right_choice"][0],
-                                                   self.choice_key_coord_dict["right_choice"][1] + 210,
-                                                   anchor   = 'center',
-                                                   image    = right_key_data["img"],
-                                                   tag      = "right_stimulus_key"
-                                                   )
-                    # Reset background
-                    self.mastercanvas.tag_bind("bkgrd",
-                                               "<Button-1>",
-                                               lambda event, 
-                                               event_type = "background_peck": 
-                                                   self.write_data(event, event_type))
-                        
-                    
-                    ## Setup tagged functions
-                    self.mastercanvas.tag_bind("left_stimulus_key",
-                                               "<Button-1>",
-                                               lambda event,
-                                               ks = "left_stimulus_key": self.key_press(event,
-                                                                            ks))
-                    
-                    self.mastercanvas.tag_bind("right_stimulus_key",
-                                               "<Button-1>",
-                                               lambda event,
-                                               ks = "right_stimulus_key": self.key_press(event,
-                                                                            ks))
-
-                
+                    layouts.append("choice_keys")
+                    configure[("choice_keys", "left_image")] = {"image": self.trial_info['left']["img"]}
+                    configure[("choice_keys", "right_image")] = {"image": self.trial_info['right']["img"]}
             if self.trial_stage == 2:
-                # Build our terminal link oval stimuli
-                self.mastercanvas.create_oval(392, 258, 609, 475,
-                                              fill = "#7F7F7F",
-                                              outline = "",
-                                              tag = "terminallink_key")
-                
-                self.mastercanvas.create_oval(417, 283, 584, 450,
-                                              fill = "#D5869D",
-                                              outline = "black",
-                                              tag = "terminallink_key")
-                
-                self.mastercanvas.create_oval(500, 365, 502, 367,
-                                              fill = "black",
-                                              outline = "black",
-                                              tag = "terminallink_key")
-                
-                self.mastercanvas.tag_bind("terminallink_key",
-                                           "<Button-1>",
-                                           lambda event,
-                                           ks = "terminallink_key": self.key_press(event,
-                                                                        ks))
+                layouts.append("terminal_link")
+        self.scene.show(layouts, configure,
+                        label = layouts[-1],
+                        started_ns = self.stage_change_started_ns)
             
     """ 
-    This key_press() function is responsible for registering pigeon inputs when
+    The count_peck() and count_choice_peck() functions are responsible for 
+    registering pigeon inputs when
     the "receptive fields" for each training phases is pecked on. For the 
     pre-training and mixed autoshaping-instrumental phases, the function would
     retreive the type of input (stimulus or background), and register the 
@@ -1207,84 +1262,115 @@ class MainScreen(object):
     reinforcement schedule. For the choice task, this logic was maintained, but
     the inputs were now registered as either "left_stimulus_key" or 
     "right_stimulus_key", and this reinforcement schedule was then applied once 
-    again. Succeeding this, the terminal link would appear on the screen and
-    the key_press() function would apply itself once again in order to ensure 
-    the correct reinforcement schedule for this terminal link subphase. 
+    again. Pecks to keys reach them as "key_peck" events of the trial state
+    machine (see P039_TrialFSM.py), which only passes them on while the keys
+    are on screen; once the ratio is met, they fire the event that moves the
+    trial on (reinforcement, a correction trial or the next ITI).
     
     """
     
-    def key_press(self, event, keytag):
+    def touch(self, event):
+        # The one handler for every peck on the Canvas. It finds the key (or
+        # background) under the peck, and its distances to the stimuli, from
+        # the session's touch geometry (see P039_HitTest.py), then records it
+        # or passes it on to the trial state machine. Every peck is timed on its way
+        # through the program, from the touchscreen event to the end of the
+        # handler (see P039_Latency.py).
+        if self.touch_geometry is None:
+            return # Session hasn't started
+        self.peck_latency.handler_entered(event, self.trial_num)
+        try:
+            self.peck_rate.peck(self.scheduler.monotonic())
+            self.current_touch = self.touch_geometry.locate(event.x, event.y)
+            keytag = self.current_touch.tag
+            if keytag == "bkgrd":
+                # Pecks to the background (or during the ITI/timeouts) are
+                # only recorded
+                self.write_data(event, self.background_event_type)
+            elif keytag is not None:
+                self.trial_fsm.fire("key_peck", event, keytag)
+        finally:
+            self.current_touch = None
+            self.peck_latency.handler_exited()
+    
+    def count_peck(self, event, keytag):
         # For pre-training and mixed autoshaping-instrumental
-        if self.training_phase in [0, 1]:
-            self.write_data(event, (f"{keytag}_peck"))
-            self.button_presses += 1 
-            if self.button_presses == self.trial_RR:
-                # Next, cancel the timer (if it exists)
-                try:
-                    self.root.after_cancel(self.auto_timer)
-                except AttributeError:
-                    pass
-                self.provide_food(True)
+        self.write_data(event, (f"{keytag}_peck"))
+        self.button_presses += 1 
+        if self.button_presses == self.trial_RR:
+            self.trial_fsm.fire("ratio_met")
+            
+    def reinforce_peck(self):
+        # (The auto-reinforcer timer was cancelled as the trial left the
+        # response state)
+        self.provide_food(True)
+        
+    def auto_reinforce(self):
+        self.provide_food(False) # False b/c non autoreinforced
 
-        # For binary choice trials 
-        elif self.training_phase == 2:
-            # Choice subphase 1
-            if self.trial_stage == 1:
-                self.write_data(event, (f"{keytag}_peck"))
-                if keytag == "left_stimulus_key":
-                    self.left_button_presses += 1
-                elif keytag == "right_stimulus_key":
-                    self.right_button_presses += 1
-                    
-                # Check if RR has been reached 
-                if self.left_button_presses == self.choice_trial_RR:
-                    self.write_data(event, ("left_stimulus_choice"))
-                    if self.trial_type != "SBE_trial":
-                        self.write_data(event, (f"{self.trial_info['left']['Name'].split('.')[0]}_choice"))
-                        self.ITI()
-                        self.previous_choice_correct = True
-                    else: # Check if choice is correct
-                        if self.correct_choice == "left":
-                            self.write_data(event, "correct_choice")
-                            self.provide_food(True)
-                            self.previous_choice_correct = True
-                        else:
-                            self.write_data(event, "incorrect_choice")
-                            self.previous_choice_correct = False
-                            self.correction_trial_TO()
-                elif self.right_button_presses == self.choice_trial_RR:
-                    self.write_data(event, ("right_stimulus_choice"))
-                    if self.trial_type != "SBE_trial":
-                        self.write_data(event, (f"{self.trial_info['left']['Name'].split('.')[0]}_choice"))
-                        self.ITI()
-                        self.previous_choice_correct = True
-                    else: # Check if choice is correct
-                        if self.correct_choice == "right":
-                            self.write_data(event, "correct_choice")
-                            self.provide_food(True)
-                            self.previous_choice_correct = True
-                        else:
-                            self.write_data(event, "incorrect_choice")
-                            self.previous_choice_correct = False
-                            self.correction_trial_TO()
+    def count_choice_peck(self, event, keytag):
+        # For binary choice trials (choice subphase 1)
+        self.write_data(event, (f"{keytag}_peck"))
+        if keytag == "left_stimulus_key":
+            self.left_button_presses += 1
+        elif keytag == "right_stimulus_key":
+            self.right_button_presses += 1
+            
+        # Check if RR has been reached 
+        if self.left_button_presses == self.choice_trial_RR:
+            side = "left"
+        elif self.right_button_presses == self.choice_trial_RR:
+            side = "right"
+        else:
+            return
+        self.record_choice(side)
+        self.write_data(event, (f"{side}_stimulus_choice"))
+        if self.trial_type != "SBE_trial":
+            self.write_data(event, (f"{self.trial_info['left']['Name'].split('.')[0]}_choice"))
+            self.previous_choice_correct = True # (free choices are never correction trials)
+            self.trial_fsm.fire("free_choice")
+        elif self.correct_choice == side: # Check if choice is correct
+            self.write_data(event, "correct_choice")
+            self.trial_fsm.fire("correct_choice")
+        else:
+            self.write_data(event, "incorrect_choice")
+            self.previous_choice_correct = False
+            self.trial_fsm.fire("incorrect_choice")
+            
+    def reward_correct_choice(self):
+        # The reinforcer's data is still marked as part of a correction trial
+        # (if it was one)
+        self.provide_food(True)
+        self.previous_choice_correct = True
+
+    def record_choice(self, side):
+        # Updates the live choice statistics (see P039_ChoiceStats.py) and
+        # shows them on the control panel. Called before the choice's
+        # outcome changes previous_choice_correct, so that still tells us
+        # whether this was a correction trial.
+        correct, probe_side = None, None
+        if self.trial_type == "SBE_trial":
+            correct = side == self.correct_choice
+        elif self.trial_type == "PvC":
+            probe_side = "left" if self.trial_info["left"]["TrainingSet"] == "0" else "right"
+        choice = [side, self.trial_type,
+                  (self.scheduler.monotonic_ns() - self.substage_start_ns) / 1e9,
+                  correct, not self.previous_choice_correct, probe_side]
+        self.choice_stats.record(*choice)
+        self.journal_record("choice", [self.trial_num] + choice)
+        if self.status_display is not None:
+            self.status_display(self.choice_stats.summary_text())
 
     # %% Post-choice contingencies: always either reinforcement (provide_food)
     # or correction trial TO (correction_trial_TO). Food leads back to the ITI,
     # thereby completing the loop.
 
     def correction_trial_TO(self):
-        # Build grey background
-        self.mastercanvas.create_rectangle(0,0,
-                                   self.mainscreen_width,
-                                   self.mainscreen_height,
-                                   fill = "grey", #"red", 
-                                   outline = "grey",
-                                   tag = "bkgrd")
-        self.mastercanvas.tag_bind("bkgrd",
-                                   "<Button-1>",
-                                   lambda event, 
-                                   event_type = "CP_background_peck": 
-                                       self.write_data(event, event_type))
+        # Grey screen (keys hidden)
+        self.background_event_type = "CP_background_peck"
+        self.scene.show(["background"],
+                        {("background", "rect"): {"fill": "grey",
+                                                  "outline": "grey"}})
 
         # Reset variables for next correction trial
         self.left_button_presses   = 0
@@ -1296,41 +1382,64 @@ class MainScreen(object):
             self.stop_recording_video()
 
         # Set timer
-        CP_timer = self.root.after(5000, lambda: self.sub_stage_one())
+        self.drift.start("correction_timeout", 5000, self.trial_num)
+        self.set_timer("correction_timeout", 5000, "timeout_elapsed")
+        self.journal_resume_point() # An interruption from here on resumes with the correction trial
 
 
     def provide_food(self, key_pecked):
         # This function is contingent upon correct and timely choice key
         # response. It opens the hopper and then leads to ITI after a preset
         # reinforcement interval (i.e., hopper down duration)
+        decision_ns = self.scheduler.monotonic_ns() # For the decision-to-servo latency
+        if key_pecked:
+            self.drift.cancel("auto_reinforcer")
+        else:
+            self.drift.finish("auto_reinforcer")
         self.clear_canvas()
         
         # If key is operantly reinforcedhopper_light_GPIO_num
         if key_pecked:
             self.write_data(None, "reinforcer_provided")
-            if not operant_box_version or self.subject_ID == "TEST":
-                self.mastercanvas.create_text(512,374,
-                                              fill="white",
-                                              font="Times 25 italic bold", 
-                                              text=f"Key Pecked \nFood accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
+            if not self.operant_box_version or self.subject_ID == "TEST":
+                self.show_message(f"Key Pecked \nFood accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
         else: # If auto-reinforced
             self.write_data(None, "auto_reinforcer_provided")
-            if not operant_box_version or self.subject_ID == "TEST":
-                    self.mastercanvas.create_text(512,374,
-                                  fill="White",
-                                  font="Times 25 italic bold", 
-                                  text=f"Auto-timer complete \nFood accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
+            if not self.operant_box_version or self.subject_ID == "TEST":
+                self.show_message(f"Auto-timer complete \nFood accessible ({int(self.hopper_duration/1000)} s)") # just onscreen feedback
 
-        # Next send output to the box's hardware
-        if operant_box_version:
-            rpi_board.write(house_light_GPIO_num,
-                            False) # Turn off the house light
-            rpi_board.write(hopper_light_GPIO_num,
-                            True) # Turn off the house light
-            rpi_board.set_servo_pulsewidth(servo_GPIO_num,
-                                           hopper_up_val) # Move hopper to up position
+        # Next send output to the box's hardware: house light off, hopper
+        # light on and hopper up. The hardware thread lowers the hopper again
+        # exactly hopper_duration later.
+        self.reinforcement = self.hardware.reinforce(self.trial_num, decision_ns,
+                                                     self.hopper_duration)
+        self.peck_latency.food_commands_issued() # (if reinforcing a peck)
+        self.reinforcers_delivered += 1
+        # The trial is complete: an interruption from here on resumes with
+        # the next trial, so this one isn't run (and reinforced) again
+        self.journal_resume_point(previous_choice_correct = True)
             
-        ITI_timer = self.root.after(self.hopper_duration, lambda: self.ITI())
+        self.set_timer("hopper", self.hopper_duration, "hopper_timer_elapsed")
+        
+    def check_hopper(self):
+        # Once hopper_duration is up, checks every ms until the hopper is down
+        if self.hardware.finish_reinforcement(self.reinforcement):
+            self.trial_fsm.fire("hopper_down")
+        else:
+            self.set_timer("hopper", 1, "hopper_timer_elapsed") # Not down yet
+        
+    def end_reinforcement(self):
+        # Once the hopper is down, its actual up/down times are recorded
+        # (hopper_up with the decision-to-servo latency, hopper_down with how
+        # far the time it was up was from hopper_duration) and the ITI starts
+        reinforcement = self.reinforcement
+        self.write_data(None, "hopper_up", round(reinforcement.decision_to_servo_ms, 3),
+                        event_ns = reinforcement.up_ns)
+        self.write_data(None, "hopper_down", round(reinforcement.deviation_ms, 3),
+                        event_ns = reinforcement.down_ns)
+        self.drift.add("hopper", reinforcement.trial_num, reinforcement.target_ms,
+                       reinforcement.actual_ms)
+        self.ITI()
         
 
     # %% Outside of the main loop functions, there are several additional
@@ -1350,16 +1459,15 @@ class MainScreen(object):
             self.cursor_visible = True
     
     def clear_canvas(self):
-         # This is by far the most called function across the program. It
-         # deletes all the objects currently on the Canvas. A finer point to 
-         # note here is that objects still exist onscreen if they are covered
-         # up (rendering them invisible and inaccessible); if too many objects
-         # are stacked upon each other, it can may be too difficult to track/
-         # project at once (especially if many of the objects have functions 
-         # tied to them. Therefore, its important to frequently clean up the 
-         # Canvas by literally deleting every element.
+         # Blanks the Canvas. Once the session's scene has been built, its
+         # items are only hidden (they are reused for the following trials);
+         # before that (e.g., the "place bird in box" text), every item is 
+         # deleted.
         try:
-            self.mastercanvas.delete("all")
+            if self.scene is not None:
+                self.scene.hide_all()
+            else:
+                self.mastercanvas.delete("all")
         except TclError:
             print("No screen to exit")
         
@@ -1374,40 +1482,25 @@ class MainScreen(object):
         #   2) Turn cursor back on
         #   3) Writes compiled data matrix to a .csv file 
         #   4) Build a black screen until manually exited
+        if self.session_end_reason is None: # Kept for the session catalog
+            self.session_end_reason = event if isinstance(event, str) else "ManualExit"
+        self.trial_fsm.fire("exit") # No more trial events (and no trial timers)
+        
         def other_exit_funcs():
-            if operant_box_version:
-                rpi_board.write(hopper_light_GPIO_num,
-                                False) # turn off hopper light
-                rpi_board.write(house_light_GPIO_num,
-                                False) # Turn off the house light
-                rpi_board.write(string_LED_GPIO_num,
-                                False) # Turn off the LED lights
-                rpi_board.set_servo_pulsewidth(servo_GPIO_num,
-                                               hopper_down_val) # set hopper to down state
-                sleep(1) # Sleep for 1 s
-                rpi_board.set_PWM_dutycycle(servo_GPIO_num,
-                                            False)
-                rpi_board.set_PWM_frequency(servo_GPIO_num,
-                                            False)
-                rpi_board.stop() # Kill RPi board
-                
-                # Next, cancel the timers (if tjey exists)
-                try:
-                    self.root.after_cancel(self.auto_timer)
-                except AttributeError:
-                    pass
-                    
-                try:
-                    self.root.after_cancel(self.ITI_timer)
-                except AttributeError:
-                    pass
-
+            # Lights off and hopper down, then (after 1 s for the hopper to
+            # get down) the servo off and the board disconnected
+            self.hardware.all_off()
+            self.hardware.close(settle_s = 1 if self.operant_box_version else 0)
+            if self.operant_box_version:
+                # (The trial timers were cancelled as the trial state
+                # machine ended)
                 if not self.cursor_visible:
                     	self.change_cursor_state() # turn cursor back on, if applicable
                         
                 if self.record_video and self.currently_recording:
                     self.stop_recording_video()
                     
+            self.video_recorder.wait_until_idle() # Make sure the cameras have stopped
             self.write_comp_data(True) # write data for end of session
             
             if event not in ["TrialsCompleted", "TimeCompleted"]: # If not, black screen by default
@@ -1420,28 +1513,141 @@ class MainScreen(object):
                 other_exit_funcs()
         except AttributeError:
                 print("\n Error exiting experimental mainscreen.")
+        finally:
+            # Make sure every queued event has been written before we go
+            self.io_writer.close()
+            if self.telemetry is not None:
+                self.telemetry.stop()
+                self.telemetry = None
+            stats = self.io_writer.stats()
+            print(f"\n Data writer: {stats['events_written']} events written, "
+                  f"max queue depth {stats['max_queue_depth']}, "
+                  f"{stats['console_lines_dropped']} console lines dropped, "
+                  f"{stats['blocked_puts']} blocked puts")
+            print(self.peck_latency.report())
+            print(self.hardware.hopper_timing_report())
+            print(self.drift.report(self.scheduler.system_clock_drift_ms()))
+            print(self.transition_times.report())
+            print(self.timers.report())
+            if self.training_phase == 2:
+                print(f"Choice summary:\n{self.choice_stats.summary_text()}")
         print("\n You may now exit the terminal and operater windows now.")
         
     
-    def write_data(self, event, outcome):
+    def telemetry_status(self):
+        # The live status served by the telemetry server. This runs on the
+        # server's thread, so it only reads variables and copies counters.
+        now = self.scheduler.monotonic()
+        session_minutes = None
+        if self.start_time is not None:
+            session_minutes = (self.scheduler.wall_clock() - self.start_time).total_seconds() / 60
+        latency = {}
+        for metric, (n, p50, p95, p99, maximum) in self.peck_latency.snapshot().summary().items():
+            latency[metric] = {"n": n, "p50": p50, "p95": p95, "p99": p99, "max": maximum}
+            for key, value in latency[metric].items():
+                if value != value: # NaN isn't valid JSON
+                    latency[metric][key] = None
+                elif key != "n":
+                    latency[metric][key] = round(value, 3)
+        writer_stats = self.io_writer.stats()
+        return {
+            "subject": self.subject_ID,
+            "phase": self.training_phase,
+            "session_started": self.start_time,
+            "session_minutes": session_minutes,
+            "trial_num": self.trial_num,
+            "trial_type": self.trial_type,
+            "trial_stage": self.trial_stage,
+            "trial_state": self.trial_fsm.state,
+            "reinforcers": self.reinforcers_delivered,
+            "pecks": self.peck_rate.total,
+            "pecks_per_minute": self.peck_rate.per_minute(now),
+            "session_pecks_per_minute": self.peck_rate.total / session_minutes if session_minutes else None,
+            "peck_latency_ms": latency,
+            "data_queue_depth": writer_stats["queue_depth"],
+            "data_max_queue_depth": writer_stats["max_queue_depth"],
+            "data_writer_errors": writer_stats["errors"],
+            "hardware_commands_pending": self.hardware.pending,
+            "timers_pending": self.timers.pending,
+            "video_commands_pending": len(self.video_recorder.pending) +
+                                      (self.video_recorder.active is not None),
+            "end_reason": self.session_end_reason,
+            }
+    
+    def write_data(self, event, outcome, latency_ms = "NA", event_ns = None):
         # This function writes a new data line after EVERY peck. Data is
         # organized into a matrix (just a list/vector with two dimensions,
         # similar to a table). This matrix is appended to throughout the 
-        # session, then written to a .csv once at the end of the session.
+        # session, and new rows are written to the .csv after every trial.
+        # Some events (e.g., video recording starting) also record how long
+        # they took, in ms (latency_ms). Every event is timed on the session
+        # clock (the scheduler's monotonic_ns()); events that happened a
+        # moment ago rather than now (e.g., the hopper going down, on the
+        # hardware thread) give their own time (event_ns).
         
-        # First generate spatial info
+        # Because this is called from within the Tkinter loop (e.g., on every
+        # peck), it only takes a quick snapshot of the trial variables at the
+        # time of the event. The data row itself is built (format_data_row), 
+        # printed and saved by the background data writer thread.
         if event != None: 
             x, y = event.x, event.y
-            # Distance from center of stimuli
-            if self.training_phase in [0,1]:
-                center_pyth_distance  = ((x - self.image_center[0]) ** 2 + (y - self.image_center[1]) ** 2) ** 0.5
-                left_pyth_dist, right_pyth_dist = "NA", "NA"
-            elif self.training_phase == 2:
-                center_pyth_distance   = ((x - self.image_center[0]) ** 2 + (y - self.image_center[1]) ** 2) ** 0.5
-                left_pyth_dist         = ((x - self.choice_key_coord_dict["left_choice"][0]) ** 2 + (y - self.choice_key_coord_dict["left_choice"][1]) ** 2) ** 0.5       
-                right_pyth_dist        = ((x - self.choice_key_coord_dict["right_choice"][0]) ** 2 + (y - self.choice_key_coord_dict["right_choice"][1]) ** 2) ** 0.5   
+            # The distances were worked out with the key that was pecked
+            touch = self.current_touch
+            if touch is None or (touch.x, touch.y) != (x, y):
+                touch = self.touch_geometry.locate(x, y)
+            distances = touch.distances()
         else: # There are certain data events that are not pecks.
-            x, y, center_pyth_distance, left_pyth_dist, right_pyth_dist = "NA", "NA", "NA", "NA", "NA"
+            x, y = "NA", "NA"
+            distances = ("NA", "NA", "NA")
+        
+        if self.training_phase == 0:
+            trial_info = None
+            press_counts = (self.trial_RR, self.button_presses)
+        elif self.training_phase == 1:
+            trial_info = self.trial_info
+            press_counts = (self.trial_RR, self.button_presses)
+        elif self.training_phase == 2:
+            trial_info = self.trial_info
+            press_counts = (self.choice_trial_RR, self.left_button_presses,
+                            self.right_button_presses)
+            
+        if event_ns is None:
+            event_ns = self.scheduler.monotonic_ns()
+            
+        self.io_writer.submit_event((
+            event_ns, # Session clock time of the event
+            outcome,
+            x, y,
+            distances,
+            self.trial_num,
+            self.trial_stage,
+            self.ITI_start_ns,
+            self.trial_begin_ns,
+            self.substage_start_ns,
+            self.ITI_duration,
+            trial_info,
+            press_counts,
+            self.previous_choice_correct,
+            self.correct_choice,
+            self.record_video,
+            self.top_filename,
+            self.side_filename,
+            latency_ms
+            ))
+        
+    def format_data_row(self, snapshot):
+        # Builds the full data row (and the terminal feedback line) from an
+        # event snapshot taken by write_data(). This runs on the data writer
+        # thread, so it should only read variables that are fixed for the
+        # session; everything that changes trial-to-trial is in the snapshot.
+        (now_ns, outcome, x, y, distances, trial_num, trial_stage, ITI_start_ns,
+         trial_begin_ns, substage_start_ns, ITI_duration, trial_info, press_counts,
+         previous_choice_correct, correct_choice_side, record_video,
+         top_filename, side_filename, latency_ms) = snapshot
+        
+        # Distances of the peck from the center stimulus and the left/right
+        # choice keys (worked out in write_data; "NA" if not a peck)
+        center_pyth_distance, left_pyth_dist, right_pyth_dist = distances
         
         # Next document stimuli used 
         if self.training_phase == 0:
@@ -1450,83 +1656,88 @@ class MainScreen(object):
             left_stim, left_stim_training_set, left_stim_num = "NA", "NA", "NA"
             right_stim, right_stim_training_set, right_stim_num = "NA", "NA", "NA"
             subphase1_RR, subphase1_left_button_presses, subphase1_right_button_presses = "NA", "NA", "NA"
-            subphase2_RR = self.trial_RR 
-            subphase2_button_presses = self.button_presses
+            subphase2_RR, subphase2_button_presses = press_counts
             correct_choice = "NA"
             left_key_color = "NA"
             right_key_color = "NA"
             
         elif self.training_phase == 1:
-            trial_type      = self.trial_info['trial_type']
-            center_stimulus = self.trial_info["Name"].split(".")[0]
+            trial_type      = trial_info['trial_type']
+            center_stimulus = trial_info["Name"].split(".")[0]
             left_stim, left_stim_training_set, left_stim_num = "NA", "NA", "NA"
             right_stim, right_stim_training_set, right_stim_num = "NA", "NA", "NA"
             subphase1_RR, subphase1_left_button_presses, subphase1_right_button_presses = "NA", "NA", "NA"
-            subphase2_RR = self.trial_RR 
-            subphase2_button_presses = self.button_presses
+            subphase2_RR, subphase2_button_presses = press_counts
             correct_choice = "NA"
             left_key_color = "NA"
             right_key_color = "NA"
                 
         elif self.training_phase == 2:
-            if self.trial_info['trial_type'] != "SBE_trial":
-                left_stim               = self.trial_info["left"]["Name"].split(".")[0]
-                left_stim_training_set  = self.trial_info["left"]["TrainingSet"]
-                left_stim_num           = self.trial_info["left"]["StimulusNum"]
-                right_stim              = self.trial_info["right"]["Name"].split(".")[0]
-                right_stim_training_set = self.trial_info["right"]["TrainingSet"]
-                right_stim_num          = self.trial_info["right"]["StimulusNum"]
+            if trial_info['trial_type'] != "SBE_trial":
+                left_stim               = trial_info["left"]["Name"].split(".")[0]
+                left_stim_training_set  = trial_info["left"]["TrainingSet"]
+                left_stim_num           = trial_info["left"]["StimulusNum"]
+                right_stim              = trial_info["right"]["Name"].split(".")[0]
+                right_stim_training_set = trial_info["right"]["TrainingSet"]
+                right_stim_num          = trial_info["right"]["StimulusNum"]
                 correct_choice          = "NA"
                 left_key_color = "NA"
                 right_key_color = "NA"
             else: # SBE trials
-                left_stim               = f'{self.trial_info["left"]}_SBE'
+                left_stim               = f'{trial_info["left"]}_SBE'
                 left_stim_training_set  = "NA"
                 left_stim_num           = "NA"
-                right_stim              = f'{self.trial_info["right"]}_SBE'
+                right_stim              = f'{trial_info["right"]}_SBE'
                 right_stim_training_set = "NA"
                 right_stim_num          = "NA"
-                correct_choice          = self.correct_choice
-                left_key_color = self.trial_info['left']
-                right_key_color = self.trial_info['right']
+                correct_choice          = correct_choice_side
+                left_key_color = trial_info['left']
+                right_key_color = trial_info['right']
                 
             # Stimuli
-            trial_type              = self.trial_info['trial_type']
+            trial_type              = trial_info['trial_type']
             center_stimulus         = "NA"
             # Button presses
-            subphase1_RR = self.choice_trial_RR
-            subphase1_left_button_presses = self.left_button_presses
-            subphase1_right_button_presses = self.right_button_presses
+            subphase1_RR, subphase1_left_button_presses, subphase1_right_button_presses = press_counts
             subphase2_RR = "NA"
             subphase2_button_presses = "NA"
             
-        if self.previous_choice_correct:
+        if previous_choice_correct:
             correction_trial = 0
         else:
             correction_trial = 1
             
-        # Print terminal feedback
-        print(f"{outcome:>30} | x: {x: ^4} y: {y:^4} | {self.trial_stage:^5} | {str(datetime.now() - self.start_time)}")
+        session_time = timedelta(microseconds = (now_ns - self.start_ns) // 1000)
         
-        self.session_data_frame.append([
+        # Time into the trial, from the end of its actual ITI. During the
+        # ITI, it is (negative) time until the scheduled end of the ITI.
+        if trial_begin_ns is not None:
+            trial_time = (now_ns - trial_begin_ns) / 1e9
+        else:
+            trial_time = (now_ns - ITI_start_ns) / 1e9 - ITI_duration / 1000
+        
+        # Terminal feedback
+        console_line = f"{outcome:>30} | x: {x: ^4} y: {y:^4} | {trial_stage:^5} | {str(session_time)}"
+        
+        row = [
             
             # First data that allows us to ID the file
             self.subject_ID, # Name of subject (same across datasheet)
-            date.today(), # Today's date as "MM-DD-YYYY"
+            (self.start_time + session_time).date(), # Today's date as "MM-DD-YYYY"
             self.training_phase, # the phase of training as a number (0-2)
             self.training_phase_name_list[self.training_phase].split(": ")[1], # Training phase name 
             
             # Then important within-session data
-            str(datetime.now() - self.start_time), # SessionTime as datetime object
-            self.trial_num, # Trial count within session (1 - max # trials)
+            session_time, # SessionTime as timedelta object (written as H:MM:SS.ffffff)
+            trial_num, # Trial count within session (1 - max # trials)
             trial_type, # Trial type
             outcome, # Type of event (e.g., background peck, target presentation, session end, etc.)
             
             # Temporal info
-            self.trial_stage, # Substage within each trial (1-2)
-            round((time() - self.trial_start - (self.ITI_duration/1000)), 5), # Time into this trial minus ITI (if session ends during ITI, will be negative)
-            round((time() - self.trial_substage_start_time), 5), # Trial substage timer
-            self.ITI_duration,  # ITI differs 
+            trial_stage, # Substage within each trial (1-2)
+            round(trial_time, 5), # Time into this trial (if session ends during ITI, will be negative)
+            round((now_ns - substage_start_ns) / 1e9, 5), # Trial substage timer
+            ITI_duration,  # ITI differs 
             
             # Spatial peck info 
             x, # X coordinate of a peck
@@ -1558,44 +1769,73 @@ class MainScreen(object):
             correct_choice,
             
             # Video info
-            self.record_video, # Video recording 0/1
-            self.top_filename, # Recording file name
-            self.side_filename # Recording file name
-            ])
-        
-        # Repeated here to double-check
-        header_list = ["Subject", "Date", "ExpPhaseNum", "ExpPhaseName", 
-                       "SessionTime", "TrialNum", "TrialType", "EventType",
-                       "TrialSubStage", "TrialTime", "TrialSubStageTimer",
-                       "ITIDuration", "Xcord","Ycord", "CenterPythDist", 
-                       "LeftPythDist", "RightPythDist", "CenterStim",
-                       "LeftStim", "LeftStimTrainingSet", "LeftStimNumber", "LeftSBEColor",
-                       "RightStim", "RightStimTrainingSet", "RightStimNumber", "RightSBEColor",
-                       "SubPhase1RR", "SubPhase1LeftButtonPresses",
-                       "SubPhase1RightButtonPresses", "SubPhase2RR",
-                       "SubPhase2ButtonPresses", "CorrectionTrial",
-                       "CorrectChoice", "VideoRecorded",
-                       "TopVideoFileName", "SideVideoFileName"]
+            record_video, # Video recording 0/1
+            top_filename, # Recording file name
+            side_filename, # Recording file name
+            
+            # Timing info for events that take time (e.g., video recording)
+            latency_ms,
+            
+            # Seed of the session plan (trial order, ITIs, etc.) used
+            self.session_plan["seed"],
+            
+            # Session clock time of the event (ns since the session started)
+            now_ns - self.start_ns
+            ]
+        return row, console_line
 
         
     def write_comp_data(self, SessionEnded):
-        # The following function creates a .csv data document. It is either 
-        # called after each trial during the ITI (SessionEnded ==False) or 
-        # one the session finishes (SessionEnded). If the first time the 
+        # The following function writes the data matrix to a .csv document. It
+        # is either called after each trial during the ITI (SessionEnded == False)
+        # or once the session finishes (SessionEnded). The first time the 
         # function is called, it will produce a new .csv out of the
         # session_data_matrix variable, named after the subject, date, and
-        # training phase. Consecutive iterations of the function will simply
-        # write over the existing document.
+        # training phase. Consecutive iterations of the function only append
+        # the rows added since the last call (rather than rewriting the whole
+        # file) and force the file to disk once per trial.
         if SessionEnded:
             self.write_data(None, "SessionEnds") # Writes end of session to df
         if self.record_data : # If experimenter has choosen to automatically record data in seperate sheet:
-            myFile_loc = f"{self.data_folder_directory}/{self.subject_ID}/{self.subject_ID}_{self.start_time.strftime('%Y-%m-%d_%H.%M.%S')}_P034b_data-Phase{self.training_phase}.csv" # location of written .csv
-            # This loop writes the data in the matrix to the .csv              
-            edit_myFile = open(myFile_loc, 'w', newline='')
-            with edit_myFile as myFile:
-                w = writer(myFile, quoting=QUOTE_MINIMAL)
-                w.writerows(self.session_data_frame) # Write all event/trial data 
-            print(f"\n- Data file written to {myFile_loc}")
+            if self.data_writer is None:
+                self.myFile_loc = self.data_file_path() # location of written .csv
+                self.data_writer = StreamingSessionWriter(self.myFile_loc)
+            # This appends the new rows in the matrix to the .csv (on the
+            # data writer thread, after any events still in its queue)
+            self.io_writer.submit_flush(self.data_writer,
+                                        close = SessionEnded,
+                                        message = f"\n- Data file written to {self.myFile_loc}")
+            if SessionEnded:
+                # Peck latency percentiles/histograms go next to the .csv
+                latency_snapshot = self.peck_latency.snapshot()
+                latency_base_path = self.myFile_loc[:-len(".csv")]
+                self.io_writer.submit_task(lambda: write_latency_report(latency_snapshot,
+                                                                        latency_base_path))
+                if self.training_phase == 2: # Choice summary too
+                    choice_rows = self.choice_stats.summary_rows()
+                    self.io_writer.submit_task(lambda: write_choice_summary(choice_rows,
+                                                                            latency_base_path))
+                hardware_log = self.hardware.log_rows() # Every command sent to the box
+                hopper_timing = self.hardware.hopper_timing_rows()
+                self.io_writer.submit_task(lambda: write_hardware_log(hardware_log,
+                                                                      latency_base_path))
+                self.io_writer.submit_task(lambda: write_hopper_timing(hopper_timing,
+                                                                       latency_base_path))
+                drift_rows = self.drift.rows() # Scheduled vs. actual delays
+                anchor = (self.scheduler.anchor_wall_clock, self.scheduler.anchor_ns)
+                self.io_writer.submit_task(lambda: write_drift_report(drift_rows, *anchor,
+                                                                      latency_base_path))
+                # Lastly, add the closed data file to the data folder's
+                # session catalog (see P039_Catalog.py; imported here, as
+                # sqlite3 isn't needed before the end of the session)
+                from P039_Catalog import catalog_session
+                data_file, end_reason = self.myFile_loc, self.session_end_reason
+                self.io_writer.submit_task(lambda: catalog_session(self.data_folder_directory,
+                                                                   data_file, end_reason))
+                # The session is over, so there is nothing left to resume
+                if self.journal is not None:
+                    self.journal_record("end", end_reason)
+                    self.io_writer.submit_task(self.close_journal)
                 
 #%% Finally, this is the code that actually runs:
 try:   
@@ -1603,12 +1843,8 @@ try:
         cp = ExperimenterControlPanel()
 except:
     # If an unexpected error, make sure to clean up the GPIO board
-    if operant_box_version:
-        rpi_board.set_PWM_dutycycle(servo_GPIO_num,
-                                    False)
-        rpi_board.set_PWM_frequency(servo_GPIO_num,
-                                    False)
-        rpi_board.stop()
+    if hardware_backend is not None:
+        hardware_backend.close(settle_s = 0)
             
             
 
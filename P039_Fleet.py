@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Simulated session fleet
+
+Runs the full protocol headless (see P039_Simulation.py) for every subject
+in SUBJECT_CONTROL_CONDITIONS, every training phase and many seeds, spread
+over a process pool, and collects the results into one report. Use it to
+check a protocol change against thousands of sessions before it ever
+reaches a pigeon.
+
+For each session it records the end reason, trial count, session duration
+(virtual minutes), pecks, reinforcers (by peck and by the auto-timer), and
+the number of places where the session's trial order breaks the schedule
+constraints:
+    phase 1 -> more than two stimuli in a row from one training set
+               (P039_Schedule.run_violations)
+    phase 2 -> a probe trial not preceded by 4-7 SBE trials
+               (P039_SessionPlan.SBE_gap_violations)
+
+Usage (from this folder):
+
+    python P039_Fleet.py --seeds 200 --agents random side_biased --processes 8
+                         [--subjects Itzamna Hendrix] [--phases 1 2]
+                         [--output P039_fleet] [--strict]
+
+Each session runs on its own seed (SessionSeed), derived from its subject,
+phase, agent and seed number (session_seed), so that every subject's
+sessions (and every agent's) make different draws.
+
+Writes <output>_sessions.csv (one row per session) and <output>_summary.csv
+(one row per subject, phase and agent, with the seeds its sessions ran
+on), and prints the summary. With
+--strict, exits with an error code if any session stalled, hit the time
+limit or broke a schedule constraint.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from csv import writer
+from itertools import product
+from os import chdir, devnull, path as os_path
+from random import Random
+from statistics import mean
+from sys import exit
+from time import perf_counter
+
+from P039_Simulation import HeadlessSession, AGENTS
+from P039_Schedule import run_violations
+from P039_SessionPlan import SUBJECT_CONTROL_CONDITIONS, SBE_gap_violations
+
+SESSION_COLUMNS = ["Subject", "Phase", "Agent", "Seed", "SessionSeed", "EndReason", "Trials",
+                   "VirtualMinutes", "Pecks", "Events", "PeckReinforcers",
+                   "AutoReinforcers", "ReinforcersPerTrial",
+                   "ScheduleViolations", "RunSeconds"]
+
+SUMMARY_COLUMNS = ["Subject", "Phase", "Agent", "Sessions", "EndReasons",
+                   "TrialsMean", "TrialsMin", "TrialsMax",
+                   "MinutesMean", "MinutesMin", "MinutesMax",
+                   "ReinforcersPerTrialMean", "AutoReinforcedShare",
+                   "SessionsWithViolations", "ScheduleViolations", "SessionSeeds"]
+
+# Counts, written as integers
+INTEGER_COLUMNS = ["Phase", "Seed", "SessionSeed", "Trials", "Pecks", "Events",
+                   "PeckReinforcers", "AutoReinforcers", "ScheduleViolations",
+                   "Sessions", "TrialsMin", "TrialsMax", "SessionsWithViolations"]
+
+# End reasons that mean the session finished as designed
+COMPLETED_END_REASONS = ["TrialsCompleted", "TimeCompleted"]
+
+
+def schedule_violations(screen):
+    # Number of schedule constraint violations in a session's trial order
+    if screen.training_phase == 1:
+        return len(run_violations(screen.trial_stimulus_order))
+    if screen.training_phase == 2:
+        return len(SBE_gap_violations(screen.session_plan["trials"]))
+    return 0
+
+
+def session_seed(subject_ID, training_phase, agent_name, seed):
+    # The seed a fleet session runs on. Random() seeds from a string's
+    # SHA-512, so this is the same in every process and every run.
+    return Random(f"{subject_ID}/{training_phase}/{agent_name}/{seed}").randrange(2**32)
+
+
+def run_fleet_session(job):
+    # Runs one headless session (in a worker process) and returns its row
+    subject_ID, training_phase, agent_name, seed, data_folder, max_minutes = job
+    own_seed = session_seed(subject_ID, training_phase, agent_name, seed)
+    t0 = perf_counter()
+    with open(devnull, "w") as hidden, redirect_stdout(hidden):
+        session = HeadlessSession(AGENTS[agent_name](), subject_ID, training_phase,
+                                  own_seed, data_folder, max_minutes)
+        result = session.run()
+    events = result["event_counts"]
+    peck_reinforcers = events["reinforcer_provided"]
+    auto_reinforcers = events["auto_reinforcer_provided"]
+    trials = result["trials"]
+    return {"Subject": subject_ID,
+            "Phase": training_phase,
+            "Agent": agent_name,
+            "Seed": seed,
+            "SessionSeed": own_seed,
+            "EndReason": result["end_reason"],
+            "Trials": trials,
+            "VirtualMinutes": round(result["virtual_minutes"], 3),
+            "Pecks": result["pecks"],
+            "Events": result["events"],
+            "PeckReinforcers": peck_reinforcers,
+            "AutoReinforcers": auto_reinforcers,
+            "ReinforcersPerTrial": round((peck_reinforcers + auto_reinforcers) / trials, 4) if trials else 0,
+            "ScheduleViolations": schedule_violations(session.screen),
+            "RunSeconds": round(perf_counter() - t0, 3)}
+
+
+def set_up_worker(folder):
+    chdir(folder) # Stimuli paths are relative to this folder
+
+
+def run_fleet(subjects, phases, agents, seeds, processes = None,
+              data_folder = None, max_minutes = 240):
+    # Runs every combination in a process pool; returns the session rows
+    jobs = [(subject_ID, phase, agent, seed, data_folder, max_minutes)
+            for subject_ID, phase, agent, seed in product(subjects, phases, agents, seeds)]
+    folder = os_path.dirname(os_path.abspath(__file__))
+    with ProcessPoolExecutor(max_workers = processes, initializer = set_up_worker,
+                             initargs = (folder,)) as pool:
+        return list(pool.map(run_fleet_session, jobs,
+                             chunksize = max(1, len(jobs) // 256)))
+
+
+def summarize_fleet(rows):
+    # One summary row per subject, phase and agent
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["Subject"], row["Phase"], row["Agent"]), []).append(row)
+    summary = []
+    for (subject_ID, phase, agent), group in sorted(groups.items()):
+        trials = [r["Trials"] for r in group]
+        minutes = [r["VirtualMinutes"] for r in group]
+        peck = sum(r["PeckReinforcers"] for r in group)
+        auto = sum(r["AutoReinforcers"] for r in group)
+        end_reasons = Counter(r["EndReason"] for r in group)
+        summary.append({"Subject": subject_ID,
+                        "Phase": phase,
+                        "Agent": agent,
+                        "Sessions": len(group),
+                        "EndReasons": "; ".join(f"{k}: {v}" for k, v in sorted(end_reasons.items())),
+                        "TrialsMean": round(mean(trials), 2),
+                        "TrialsMin": min(trials),
+                        "TrialsMax": max(trials),
+                        "MinutesMean": round(mean(minutes), 2),
+                        "MinutesMin": min(minutes),
+                        "MinutesMax": max(minutes),
+                        "ReinforcersPerTrialMean": round(mean(r["ReinforcersPerTrial"] for r in group), 4),
+                        "AutoReinforcedShare": round(auto / (peck + auto), 4) if peck + auto else "NA",
+                        "SessionsWithViolations": sum(1 for r in group if r["ScheduleViolations"]),
+                        "ScheduleViolations": sum(r["ScheduleViolations"] for r in group),
+                        "SessionSeeds": " ".join(str(r["SessionSeed"]) for r in group)})
+    return summary
+
+
+def write_rows(rows, columns, file_path):
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(columns)
+        for row in rows:
+            w.writerow([int(row[c]) if c in INTEGER_COLUMNS else row[c]
+                        for c in columns])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Run simulated P039 sessions for every subject and phase")
+    parser.add_argument("--subjects", nargs="*", default=sorted(SUBJECT_CONTROL_CONDITIONS))
+    parser.add_argument("--phases", nargs="*", type=int, default=[0, 1, 2])
+    parser.add_argument("--agents", nargs="*", choices=sorted(AGENTS), default=["random"])
+    parser.add_argument("--seeds", type=int, default=20, help="Sessions per subject, phase and agent")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None, help="Default: one per CPU")
+    parser.add_argument("--max-minutes", type=float, default=240,
+                        help="Virtual session time limit")
+    parser.add_argument("--data-folder", default=None,
+                        help="Also write each session's data files into this folder")
+    parser.add_argument("--output", default="P039_fleet")
+    parser.add_argument("--strict", action="store_true",
+                        help="Exit with an error if any session didn't complete or broke a constraint")
+    args = parser.parse_args()
+
+    t0 = perf_counter()
+    rows = run_fleet(args.subjects, args.phases, args.agents,
+                     range(args.first_seed, args.first_seed + args.seeds),
+                     args.processes, args.data_folder, args.max_minutes)
+    elapsed = perf_counter() - t0
+    summary = summarize_fleet(rows)
+    write_rows(rows, SESSION_COLUMNS, f"{args.output}_sessions.csv")
+    write_rows(summary, SUMMARY_COLUMNS, f"{args.output}_summary.csv")
+
+    print(f"{len(rows)} sessions in {elapsed:.1f} s ({len(rows) / elapsed * 60:.0f} sessions/min)")
+    print(f"{'Subject':>10} | Phase | {'Agent':>12} |    n | Trials (min-max) | "
+          f"Minutes (min-max)     | Food/trial | Auto | Violations | End reasons")
+    for s in summary:
+        print(f"{s['Subject']:>10} | {s['Phase']:^5} | {s['Agent']:>12} | {s['Sessions']:4d} | "
+              f"{s['TrialsMean']:6.1f} ({s['TrialsMin']}-{s['TrialsMax']}) | "
+              f"{s['MinutesMean']:6.1f} ({s['MinutesMin']:.0f}-{s['MinutesMax']:.0f}) | "
+              f"{s['ReinforcersPerTrialMean']:10.3f} | {s['AutoReinforcedShare']!s:>4} | "
+              f"{s['ScheduleViolations']:10d} | {s['EndReasons']}")
+    print(f"Reports: {args.output}_sessions.csv, {args.output}_summary.csv")
+
+    problems = [r for r in rows if r["ScheduleViolations"] or
+                r["EndReason"] not in COMPLETED_END_REASONS]
+    if args.strict and problems:
+        print(f"{len(problems)} sessions didn't complete or broke a schedule constraint")
+        exit(1)
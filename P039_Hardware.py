@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Operant box hardware
+
+Everything the program does to the box (other than the screen) goes through
+a BoxHardware object:
+
+    hopper(up)          -> servo to the hopper's up/down pulse width
+    house_light(on)     -> house light LED
+    hopper_light(on)    -> hopper light LED
+    LED_strings(on)     -> LED strings (only wired in box 1)
+
+The commands are put in a queue and sent to the board by a dedicated thread,
+so the Tkinter thread never waits on the pigpio daemon's socket. They are
+sent in the order they were asked for. Two backends do the actual work:
+
+    PigpioBackend -> the Raspberry Pi's GPIO pins through pigpio (the boxes)
+    MockBackend   -> nothing is switched; every command is kept in memory with
+                     its time stamp (computers without the hardware, and the
+                     simulation, see P039_Simulation.py)
+
+Food access is timed on the same thread (reinforce()): the hopper is raised,
+held up for exactly the hopper duration on the monotonic_ns clock (sleeping
+until the last millisecond, then spinning), and lowered again. This no longer
+depends on the Tkinter loop, which may be busy redrawing or writing data when
+the hopper is due to go down; the MainScreen just waits for the hopper to be
+down before starting the ITI. While the hopper is up, any other commands
+wait for it to go down. (The thread still needs Python's GIL to wake up, so
+if the Tkinter thread is busy with Python code right then, the hopper can go
+down up to the interpreter's switch interval, 5 ms, late.)
+
+For every reinforcer, the time from the decision to reinforce (the start of
+provide_food) until the servo command had been sent is measured
+("decision_to_servo"), along with when the hopper actually went up and down
+and how far the time it was up was from the target. The MainScreen writes
+these as hopper_up/hopper_down data events. Every command (with its queueing
+delay and, for the hopper, the decision_to_servo latency) is written to
+..._hardware_log.csv next to the data .csv, and every reinforcer's timing to
+..._hopper_timing.csv.
+"""
+
+from array import array
+from csv import reader, writer
+from queue import Queue
+from statistics import mean, stdev
+from threading import Event, Thread
+from time import monotonic_ns, sleep
+
+HARDWARE_OUTPUTS = ["house_light", "hopper_light", "LED_strings"]
+
+HARDWARE_LOG_HEADER = ["Command", "Value", "TrialNum", "RequestedMs",
+                       "IssuedMs", "QueueMs", "DecisionToServoMs"]
+
+HOPPER_TIMING_HEADER = ["TrialNum", "UpMs", "DownMs", "TargetMs", "ActualMs",
+                        "DeviationMs", "DecisionToServoMs"]
+
+
+def read_hopper_values(csv_path):
+    # The servo pulse widths (up, down) of a box's hopper, from row 2 of
+    # ~/Desktop/Box_Info/Hopper_vals.csv
+    with open(csv_path) as f:
+        up_down_table = list(reader(f))
+    return up_down_table[1][0], up_down_table[1][1]
+
+
+class PigpioBackend(object):
+    # The GPIO board of an operant box. GPIO_nums maps "servo" and each of
+    # HARDWARE_OUTPUTS to its GPIO number (NOT pin number). The hopper
+    # values can also be given after connecting (set_hopper_values), so that
+    # they can be read while the board is being set up.
+    def __init__(self, pigpio, GPIO_nums, hopper_up_val = None,
+                 hopper_down_val = None, servo_frequency = 50):
+        self.GPIO_nums = GPIO_nums
+        self.hopper_up_val = hopper_up_val
+        self.hopper_down_val = hopper_down_val
+        self.board = pigpio.pi() # Connects to the pigpio daemon
+        # Set each pin to output...
+        for GPIO_num in GPIO_nums.values():
+            self.board.set_mode(GPIO_num, pigpio.OUTPUT)
+        # ...and set up the servo motor (default frequency is 50 Hz)
+        self.board.set_PWM_frequency(GPIO_nums["servo"], servo_frequency)
+
+    def set_hopper_values(self, hopper_up_val, hopper_down_val):
+        self.hopper_up_val = hopper_up_val
+        self.hopper_down_val = hopper_down_val
+
+    def write(self, output, on):
+        self.board.write(self.GPIO_nums[output], on)
+
+    def hopper(self, up):
+        self.board.set_servo_pulsewidth(self.GPIO_nums["servo"],
+                                        self.hopper_up_val if up else self.hopper_down_val)
+
+    def close(self, settle_s = 1):
+        # Gives the hopper settle_s to get down, then turns the servo off
+        # and disconnects from the board
+        if self.board is None:
+            return
+        sleep(settle_s)
+        self.board.set_PWM_dutycycle(self.GPIO_nums["servo"], False)
+        self.board.set_PWM_frequency(self.GPIO_nums["servo"], False)
+        self.board.stop()
+        self.board = None
+
+
+class MockBackend(object):
+    # Stands in for the board: keeps the state of each output and a list of
+    # every command as (monotonic ns, command, value)
+    def __init__(self, clock_ns = monotonic_ns):
+        self.clock_ns = clock_ns
+        self.commands = []
+        self.state = dict.fromkeys(["hopper"] + HARDWARE_OUTPUTS, False)
+
+    def write(self, output, on):
+        self.state[output] = bool(on)
+        self.commands.append((self.clock_ns(), output, bool(on)))
+
+    def hopper(self, up):
+        self.state["hopper"] = bool(up)
+        self.commands.append((self.clock_ns(), "hopper", "up" if up else "down"))
+
+    def close(self, settle_s = 1):
+        self.commands.append((self.clock_ns(), "close", None))
+
+
+class Reinforcement(object):
+    # The timing of one reinforcer. The ns times are on the hardware clock
+    # and stay None until the hopper has gone up/down.
+    __slots__ = ["trial_num", "target_ms", "decision_ns", "up_ns", "down_ns"]
+
+    def __init__(self, trial_num, target_ms, decision_ns):
+        self.trial_num = trial_num
+        self.target_ms = target_ms
+        self.decision_ns = decision_ns
+        self.up_ns = None
+        self.down_ns = None
+
+    @property
+    def actual_ms(self):
+        # How long the hopper was up
+        return (self.down_ns - self.up_ns) / 1e6
+
+    @property
+    def deviation_ms(self):
+        # Actual minus target hopper duration
+        return self.actual_ms - self.target_ms
+
+    @property
+    def decision_to_servo_ms(self):
+        return (self.up_ns - self.decision_ns) / 1e6
+
+
+class BoxHardware(object):
+    # The box's outputs, sent to backend from a command thread (or inline
+    # when threaded = False or once closed). on_reinforcer(ms) is called on
+    # the command thread with each reinforcer's decision-to-servo latency.
+    # spin_ns: how long before the hopper is due down to stop sleeping and
+    # watch the clock instead.
+    STOP = None
+
+    def __init__(self, backend, threaded = True, clock_ns = monotonic_ns,
+                 on_reinforcer = None, spin_ns = 1000000):
+        self.backend = backend
+        self.threaded = threaded
+        self.clock_ns = clock_ns
+        self.on_reinforcer = on_reinforcer
+        self.spin_ns = spin_ns
+        self.command_queue = Queue()
+        self.thread = None
+        self.running = False
+        self.abort = Event() # Set on close(), to lower a held hopper straight away
+        self.start_ns = clock_ns()
+        # One entry per command sent:
+        # (command, value, trial, requested ns, issued ns, decision ns)
+        self.log = []
+        self.reinforcer_latencies = array('d') # Decision-to-servo (ms)
+        self.reinforcements = [] # Reinforcement of every reinforcer
+        self.errors = 0
+
+    def start(self):
+        if self.threaded and not self.running:
+            self.running = True
+            self.thread = Thread(target = self.run,
+                                 name = "P039-hardware",
+                                 daemon = True)
+            self.thread.start()
+        return self
+
+    @property
+    def pending(self):
+        # Commands waiting to be sent
+        return self.command_queue.qsize()
+
+    def submit(self, command, value, trial_num = None, decision_ns = None):
+        item = (command, value, trial_num, self.clock_ns(), decision_ns)
+        if self.running:
+            self.command_queue.put(item)
+        else:
+            self.execute(item)
+
+    def hopper(self, up, trial_num = None, decision_ns = None):
+        # decision_ns: when it was decided to raise the hopper (for the
+        # decision-to-servo latency)
+        self.submit("hopper", "up" if up else "down", trial_num, decision_ns)
+
+    def house_light(self, on):
+        self.submit("house_light", bool(on))
+
+    def hopper_light(self, on):
+        self.submit("hopper_light", bool(on))
+
+    def LED_strings(self, on):
+        self.submit("LED_strings", bool(on))
+
+    def reinforce(self, trial_num, decision_ns, duration_ms):
+        # House light off, hopper light on, and the hopper up for
+        # duration_ms. Returns the Reinforcement, to pass to
+        # finish_reinforcement() once duration_ms has passed.
+        reinforcement = Reinforcement(trial_num, duration_ms, decision_ns)
+        self.reinforcements.append(reinforcement)
+        self.house_light(False)
+        self.hopper_light(True)
+        self.submit("timed_hopper", reinforcement, trial_num)
+        return reinforcement
+
+    def finish_reinforcement(self, reinforcement):
+        # True once the hopper is down again. Without the command thread,
+        # nothing can hold the hopper up, so it is lowered here.
+        if reinforcement.down_ns is None and not self.running:
+            self.lower_hopper(reinforcement)
+        return reinforcement.down_ns is not None
+
+    def all_off(self):
+        # Lights off and hopper down (e.g., at the end of a session)
+        self.hopper_light(False)
+        self.house_light(False)
+        self.LED_strings(False)
+        self.hopper(False)
+
+    def run(self):
+        # The command thread's loop; runs until STOP is received
+        while True:
+            item = self.command_queue.get()
+            if item is self.STOP:
+                break
+            self.execute(item)
+
+    def execute(self, item):
+        if item[0] == "timed_hopper":
+            self.hold_hopper(item[1], item[3])
+        else:
+            self.send(*item)
+
+    def hold_hopper(self, reinforcement, requested_ns):
+        # Raises the hopper and (on the command thread) lowers it again
+        # target_ms later
+        reinforcement.up_ns = self.send("hopper", "up", reinforcement.trial_num,
+                                        requested_ns, reinforcement.decision_ns)
+        if not self.running:
+            return # See finish_reinforcement()
+        self.wait_until(reinforcement.up_ns + int(reinforcement.target_ms * 1000000))
+        self.lower_hopper(reinforcement)
+
+    def lower_hopper(self, reinforcement):
+        reinforcement.down_ns = self.send("hopper", "down", reinforcement.trial_num,
+                                          self.clock_ns(), None)
+
+    def wait_until(self, target_ns):
+        # Sleeps until spin_ns before target_ns, then watches the clock (which
+        # is far more precise than waking up from a sleep). Returns early if
+        # the hardware is being closed.
+        remaining_ns = target_ns - self.clock_ns()
+        if remaining_ns > self.spin_ns:
+            if self.abort.wait((remaining_ns - self.spin_ns) / 1e9):
+                return
+        while self.clock_ns() < target_ns and not self.abort.is_set():
+            sleep(0) # Lets the Tkinter thread run while we wait
+
+    def send(self, command, value, trial_num, requested_ns, decision_ns):
+        # Sends one command to the backend; returns when it was sent (ns).
+        # A command that fails is counted and printed, and its time is
+        # still returned so that the session can go on.
+        try:
+            if command == "hopper":
+                self.backend.hopper(value == "up")
+            else:
+                self.backend.write(command, value)
+        except Exception as e: # A failed command shouldn't stop the session
+            self.errors += 1
+            print(f"ERROR sending {command} = {value} to the box: {e!r}")
+            return self.clock_ns()
+        issued_ns = self.clock_ns()
+        self.log.append((command, value, trial_num, requested_ns, issued_ns, decision_ns))
+        if decision_ns is not None:
+            latency_ms = (issued_ns - decision_ns) / 1e6
+            self.reinforcer_latencies.append(latency_ms)
+            if self.on_reinforcer is not None:
+                self.on_reinforcer(latency_ms)
+        return issued_ns
+
+    def close(self, settle_s = 1, timeout_s = 10):
+        # Sends every command still waiting (lowering a held hopper straight
+        # away), stops the command thread, then closes the backend (after
+        # settle_s for the hopper to get down)
+        if self.running:
+            self.abort.set()
+            self.command_queue.put(self.STOP)
+            self.thread.join(timeout_s)
+            if self.thread.is_alive():
+                print("WARNING: hardware commands still waiting at exit")
+            self.running = False
+        self.backend.close(settle_s)
+
+    def log_rows(self):
+        # The command log as rows of HARDWARE_LOG_HEADER (ms since start)
+        rows = []
+        for command, value, trial_num, requested_ns, issued_ns, decision_ns in list(self.log):
+            rows.append([command, value, "NA" if trial_num is None else trial_num,
+                         round((requested_ns - self.start_ns) / 1e6, 3),
+                         round((issued_ns - self.start_ns) / 1e6, 3),
+                         round((issued_ns - requested_ns) / 1e6, 3),
+                         "NA" if decision_ns is None else round((issued_ns - decision_ns) / 1e6, 3)])
+        return rows
+
+
+    def hopper_timing_rows(self):
+        # One row of HOPPER_TIMING_HEADER per reinforcer whose hopper has
+        # gone up and down (times in ms since start)
+        rows = []
+        for r in list(self.reinforcements):
+            if r.up_ns is None or r.down_ns is None:
+                continue
+            rows.append([r.trial_num,
+                         round((r.up_ns - self.start_ns) / 1e6, 3),
+                         round((r.down_ns - self.start_ns) / 1e6, 3),
+                         r.target_ms, round(r.actual_ms, 3),
+                         round(r.deviation_ms, 3),
+                         round(r.decision_to_servo_ms, 3)])
+        return rows
+
+    def hopper_timing_report(self):
+        # Jitter of the food access durations, for the terminal
+        deviations = [row[5] for row in self.hopper_timing_rows()]
+        if not deviations:
+            return "Hopper timing: no reinforcers"
+        sd = stdev(deviations) if len(deviations) > 1 else 0
+        return (f"Hopper timing ({len(deviations)} reinforcers): deviation from "
+                f"target mean {mean(deviations):.3f} ms, SD {sd:.3f} ms, "
+                f"min {min(deviations):.3f} ms, max {max(deviations):.3f} ms")
+
+
+def write_hardware_log(rows, base_path):
+    # Writes <base_path>_hardware_log.csv from BoxHardware.log_rows()
+    file_path = f"{base_path}_hardware_log.csv"
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(HARDWARE_LOG_HEADER)
+        w.writerows(rows)
+    return file_path
+
+
+def write_hopper_timing(rows, base_path):
+    # Writes <base_path>_hopper_timing.csv from BoxHardware.hopper_timing_rows()
+    file_path = f"{base_path}_hopper_timing.csv"
+    with open(file_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(HOPPER_TIMING_HEADER)
+        w.writerows(rows)
+    return file_path
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Touch geometry
+
+Pecks used to be routed by Tk: every key was made of several overlapping
+tagged items ("bkgrd", "left_stimulus_key", "terminallink_key", ...), each
+tag had its own <Button-1> binding, and Tk worked out which item was on top
+under the touch. write_data() then worked out the distances from the peck to
+the stimulus centers separately.
+
+The TouchGeometry instead keeps a table of the shapes of every item in the
+CanvasScene (see P039_Scene.py), worked out once when the session starts:
+center and radii for ovals and arcs, bounds for rectangles and images, the
+start/extent angles of arcs. The MainScreen binds a single handler to the
+whole Canvas, which calls locate(x, y) to find the key under the touch and
+every distance written to the data, in one pass.
+
+The key is picked the way Tk picks the item whose bindings get a click:
+the topmost visible item within the Canvas's closeenough (1 px by default)
+of the touch, with each item's outline (1 px unless outline = "") counted
+as part of it. The distances follow Tk's own (TkOvalToPoint for ovals and
+the round part of arcs, the distance to the two straight edges of an arc,
+to the box of a rectangle grown by half its outline, and to the box of an
+image), so a touch on the ring just outside a key still counts for the
+key.
+
+Text items (the onscreen feedback in the test version) are hit on the
+bounding box of the text they show, which the canvas works out from the
+font (plus closeenough). As with Tk's tag bindings, a peck on the text is
+a peck on the text's own item (which has no key tag), not on whatever is
+underneath. Tk only counts the extent of each line, so a touch next to a
+short line of a multi-line, centred text can differ.
+
+To check that locate() gives the same keys as Tk's tag bindings on a dense
+grid of touches (and how long each takes), run:
+
+    python P039_Benchmarks.py hit_test
+"""
+
+from math import atan2, cos, degrees, hypot, inf, radians, sin
+
+
+class Touch(object):
+    # Where a touch landed: the key tag (None if on no item) and its
+    # distances (px) to the center stimulus and the left/right choice keys
+    # ("NA" where they don't apply in this phase)
+    __slots__ = ["x", "y", "tag", "center_dist", "left_dist", "right_dist"]
+
+    def __init__(self, x, y, tag, center_dist, left_dist, right_dist):
+        self.x = x
+        self.y = y
+        self.tag = tag
+        self.center_dist = center_dist
+        self.left_dist = left_dist
+        self.right_dist = right_dist
+
+    def distances(self):
+        return self.center_dist, self.left_dist, self.right_dist
+
+
+def oval_distance(x, y, cx, cy, rx, ry, width, filled = True):
+    # Tk's TkOvalToPoint: the distance (towards the center) to the oval grown
+    # by half its outline width; inside, 0 if filled, otherwise the distance
+    # to the inner edge of the outline
+    ax, ay = rx + width / 2, ry + width / 2
+    if ax <= 0 or ay <= 0:
+        return inf
+    dx, dy = x - cx, y - cy
+    scaled = hypot(dx / ax, dy / ay)
+    if scaled < 1:
+        if filled:
+            return 0.0
+        if scaled > 1e-10:
+            return max(0.0, hypot(dx, dy) / scaled * (1 - scaled) - width)
+        return max(0.0, min(ax, ay) - width)
+    return hypot(dx, dy) * (scaled - 1) / scaled
+
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    # Distance from (x, y) to the line segment (x1, y1)-(x2, y2)
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    return hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def box_distance(x, y, x1, y1, x2, y2):
+    # Distance from (x, y) to the box (0 inside)
+    dx = x1 - x if x < x1 else (x - x2 if x > x2 else 0.0)
+    dy = y1 - y if y < y1 else (y - y2 if y > y2 else 0.0)
+    return hypot(dx, dy)
+
+
+def rectangle_distance(x, y, x1, y1, x2, y2, width, filled):
+    # Tk's distance to a rectangle, grown by half its outline width
+    half = width / 2
+    x1, y1, x2, y2 = x1 - half, y1 - half, x2 + half, y2 + half
+    if not filled and x1 <= x < x2 and y1 <= y < y2:
+        # Unfilled rectangles can only be hit on their outline
+        return max(0.0, min(x - x1, x2 - x, y - y1, y2 - y) - width)
+    return box_distance(x, y, x1, y1, x2, y2)
+
+
+def arc_distance(x, y, cx, cy, rx, ry, start, extent, width, filled = True):
+    # Tk's distance to a "pieslice" arc: the round part counts where the
+    # touch is within the arc's angles (taken on the oval scaled to a
+    # circle, counter-clockwise from 3 o'clock), the two straight edges
+    # everywhere. Tk measures outlines thicker than 1 px on their outline
+    # polygon; here they are taken as lines grown by half their width.
+    dx = (x - cx) / rx if rx else 0.0
+    dy = (y - cy) / ry if ry else 0.0
+    angle = 0.0 if dx == dy == 0 else -degrees(atan2(dy, dx))
+    diff = (angle - start) % 360
+    distance = inf
+    for edge_angle in [start, start + extent]:
+        end_x = cx + rx * cos(radians(-edge_angle))
+        end_y = cy + ry * sin(radians(-edge_angle))
+        distance = min(distance, segment_distance(x, y, cx, cy, end_x, end_y))
+    if width > 1:
+        distance = max(0.0, distance - width / 2)
+    if diff <= extent or (extent < 0 and diff - 360 >= extent):
+        distance = min(distance, oval_distance(x, y, cx, cy, rx, ry, width, filled))
+    return distance
+
+
+def outline_style(options):
+    # (outline width, filled) as Tk measures an item: a 1 px outline unless
+    # it is turned off, in which case the item counts as filled
+    if options.get("outline") == "":
+        return 0.0, True
+    return float(options.get("width", 1)), bool(options.get("fill"))
+
+
+def image_box(x, y, width, height):
+    # The box Tk gives an image item (anchor = "center"): the position is
+    # rounded to whole pixels first
+    x = int(x + 0.5) if x >= 0 else int(x - 0.5)
+    y = int(y + 0.5) if y >= 0 else int(y - 0.5)
+    x1, y1 = x - width // 2, y - height // 2
+    return x1, y1, x1 + width, y1 + height
+
+
+class TouchGeometry(object):
+    # scene is the session's CanvasScene. anchors is {"center": (x, y),
+    # "left": (x, y), "right": (x, y)}; missing anchors give "NA" distances.
+    # text_bbox(item ID) gives the bounds of a text item (default: the
+    # scene's canvas.bbox). close_enough: the Canvas's closeenough.
+    def __init__(self, scene, anchors, text_bbox = None, close_enough = 1.0):
+        self.scene = scene
+        self.anchors = [anchors.get(name) for name in ["center", "left", "right"]]
+        self.text_bbox = scene.canvas.bbox if text_bbox is None else text_bbox
+        self.close_enough = close_enough
+        # One row per hit-testable item, topmost first:
+        # (layout, tag, kind, item ID, x1, y1, x2, y2, cx, cy, rx, ry, start,
+        #  extent, outline width, filled)
+        self.shapes = []
+        for item_id in reversed(scene.order):
+            layout, kind, coords, options = scene.specs[item_id]
+            tags = options.get("tag", options.get("tags", ()))
+            tag = tags if isinstance(tags, str) else (tags[0] if tags else None)
+            if kind in ["image", "text"]:
+                # Only the position; the size comes from the image or text
+                # shown (see locate and text_bbox)
+                x1, y1 = (float(c) for c in coords)
+                x2, y2 = x1, y1
+            else:
+                x1, y1, x2, y2 = (float(c) for c in coords)
+                x1, x2 = min(x1, x2), max(x1, x2)
+                y1, y2 = min(y1, y2), max(y1, y2)
+            self.shapes.append((layout, tag, kind, item_id, x1, y1, x2, y2,
+                                (x1 + x2) / 2, (y1 + y2) / 2,
+                                (x2 - x1) / 2, (y2 - y1) / 2,
+                                float(options.get("start", 0)),
+                                float(options.get("extent", 90)),
+                                *outline_style(options)))
+
+    def distance(self, shape, x, y):
+        # How far (x, y) is from an item, the way Tk measures it for picking
+        (layout, tag, kind, item_id, x1, y1, x2, y2,
+         cx, cy, rx, ry, start, extent, width, filled) = shape
+        if kind == "image":
+            image = self.scene.applied[item_id].get("image")
+            if not image:
+                return inf # Shows nothing
+            return box_distance(x, y, *image_box(x1, y1, image.width(), image.height()))
+        if kind == "text":
+            bounds = self.text_bbox(item_id)
+            return box_distance(x, y, *bounds) if bounds else inf
+        if kind == "rectangle":
+            return rectangle_distance(x, y, x1, y1, x2, y2, width, filled)
+        if kind == "oval":
+            return oval_distance(x, y, cx, cy, rx, ry, width, filled)
+        return arc_distance(x, y, cx, cy, rx, ry, start, extent, width, filled)
+
+    def locate(self, x, y):
+        # Returns the Touch at (x, y)
+        visible = self.scene.visible
+        close_enough = self.close_enough
+        tag = None
+        for shape in self.shapes:
+            if shape[0] not in visible:
+                continue
+            if shape[2] not in ["image", "text"]:
+                # Quick check against the item's box (plus the outline and
+                # closeenough) before measuring
+                reach = shape[14] + close_enough
+                if (x < shape[4] - reach or x > shape[6] + reach or
+                        y < shape[5] - reach or y > shape[7] + reach):
+                    continue
+            if self.distance(shape, x, y) <= close_enough:
+                tag = shape[1]
+                break
+
+        distances = []
+        for anchor in self.anchors:
+            if anchor is None:
+                distances.append("NA")
+            else:
+                distances.append(((x - anchor[0]) ** 2 + (y - anchor[1]) ** 2) ** 0.5)
+        return Touch(x, y, tag, *distances)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Session journal (crash recovery)
+
+While a session runs, every data row and the state needed to carry on with
+the session are also appended to a journal next to the data .csv
+(..._journal.jsonl). The journal is written by the data writer thread (see
+P039_DataWriter.py), one compact JSON list per line:
+
+    ["session", {...}]          -> subject, phase, data file, start time and
+                                   the whole session plan (first line)
+    ["event", [row]]            -> a data row, exactly as in the .csv
+    ["trial", {...}]            -> where to resume from: the state the next
+                                   ITI starts from (trial number, correction
+                                   trial state, counters), written at the
+                                   start of each ITI and as soon as a trial
+                                   is reinforced or its correction timeout
+                                   starts
+    ["choice", [...]]           -> a choice (phase 2, with its trial number), for
+                                   the live statistics
+    ["resumed", "<time>"]       -> the session was resumed from here
+    ["end", "<reason>"]         -> the session finished (nothing to resume)
+
+Each line is flushed to the operating system as it is written, so nothing is
+lost if the program (or Tkinter) crashes, and the journal is forced to disk
+(fsync) with the .csv once per trial, which also covers a power cut up to
+the last trial.
+
+If a session was interrupted, "Resume session" on the control panel finds
+the subject's latest unfinished journal for the phase (find_unfinished_journal)
+and starts a MainScreen from it: the .csv is topped up with any rows that
+only made it into the journal, and the session carries on with the same plan
+from the last "trial" record, with the trial number, correction trial state,
+reinforcer count and choice statistics it had. A trial that was interrupted
+before its outcome is run again from its start; one that had already been
+reinforced is not (the session carries on with the next trial), and one
+whose correction timeout had started carries on with its correction trial.
+New rows are appended to the same .csv (after a SessionResumed event).
+"""
+
+from csv import writer
+from glob import glob
+from json import dumps, loads
+from os import fsync, path as os_path
+
+
+class SessionJournal(object):
+    # Appends records to a session's journal. Only used from the data writer
+    # thread.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.journal_file = open(file_path, 'a')
+
+    def write(self, kind, value):
+        self.journal_file.write(dumps([kind, value], separators = (",", ":"),
+                                      default = str) + "\n")
+        self.journal_file.flush()
+
+    def event(self, row):
+        self.write("event", row)
+
+    def sync(self):
+        # Forces the journal to disk (once per trial)
+        if self.journal_file is not None:
+            self.journal_file.flush()
+            fsync(self.journal_file.fileno())
+
+    def close(self):
+        if self.journal_file is not None:
+            self.sync()
+            self.journal_file.close()
+            self.journal_file = None
+
+
+class JournalState(object):
+    # Everything read back from a journal (see load_journal)
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.session = None # The "session" record
+        self.rows = [] # Every data row
+        self.trial = None # The last "trial" record (None if no ITI yet)
+        self.choices = [] # Every "choice" record
+        self.resumes = 0
+        self.end_reason = None
+
+    @property
+    def finished(self):
+        return self.end_reason is not None
+
+    @property
+    def next_trial(self):
+        # The trial the session carries on with
+        trial = self.trial or {}
+        return trial.get("trial_num", 0) + (1 if trial.get("previous_choice_correct", True) else 0)
+
+
+def load_journal(file_path):
+    # Reads a journal back. A last line that was only partly written (the
+    # program stopped mid-write) is ignored.
+    state = JournalState(file_path)
+    with open(file_path) as f:
+        for line in f:
+            try:
+                kind, value = loads(line)
+            except ValueError:
+                break
+            if kind == "event":
+                state.rows.append(value)
+            elif kind == "trial":
+                state.trial = value
+            elif kind == "choice":
+                state.choices.append(value)
+            elif kind == "session":
+                state.session = value
+            elif kind == "resumed":
+                state.resumes += 1
+            elif kind == "end":
+                state.end_reason = value
+    if state.session is None:
+        raise ValueError(f"Not a session journal: {file_path}")
+    return state
+
+
+def journal_path(data_file_path):
+    # The journal that goes with a data .csv
+    return data_file_path[:-len(".csv")] + "_journal.jsonl"
+
+
+def find_unfinished_journal(data_folder_directory, subject_ID, training_phase):
+    # The subject's most recent journal for the phase, if that session
+    # didn't finish (otherwise None)
+    file_paths = sorted(glob(os_path.join(data_folder_directory, subject_ID,
+                                          f"{subject_ID}_*_data-Phase{training_phase}_journal.jsonl")))
+    if not file_paths:
+        return None
+    state = load_journal(file_paths[-1])
+    return None if state.finished else state
+
+
+def recover_data_file(data_file_path, header, rows):
+    # Brings the .csv up to date with the journal's rows: a last row that
+    # was only partly written is cut off, then the rows that never made it
+    # into the file are appended (the file is made, with the header, if the
+    # session stopped before it was first written). Returns the number of
+    # rows appended.
+    if not os_path.exists(data_file_path):
+        with open(data_file_path, 'w', newline='') as f:
+            writer(f).writerow(header)
+    with open(data_file_path, 'rb+') as f:
+        content = f.read()
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            f.truncate(len(complete))
+    rows_in_file = max(0, complete.count(b"\n") - 1) # Minus the header
+    missing = rows[rows_in_file:]
+    with open(data_file_path, 'a', newline='') as f:
+        writer(f).writerows(missing)
+        f.flush()
+        fsync(f.fileno())
+    return len(missing)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Peck latency instrumentation
+
+Times every peck on its way through the program:
+
+    touch_to_handler  -> from the touchscreen event (the X server's event.time)
+                         until the MainScreen's handler starts running
+    handler_duration  -> how long the handler took to record the peck and
+                         decide what happens next (reinforcement, ITI, ...)
+    handler_to_food   -> from the start of the handler until the hopper GPIO
+                         commands had been sent (reinforced pecks only)
+    touch_to_food     -> touch_to_handler + handler_to_food
+
+It also keeps the stimulus onset latency of every stage change: the time from
+the start of the stage change until the new keys/stimuli had been drawn on
+screen (see P039_Scene.py), by what was shown (e.g., "stimulus_onset_SBE_keys"),
+and the decision_to_servo latency of every reinforcer: from the decision to
+reinforce until the hopper's servo command had been sent (see P039_Hardware.py).
+
+Handler times come from a monotonic clock (time.monotonic_ns). The X
+server's event.time is in ms on its own clock, which on Linux (Xorg) is the
+same CLOCK_MONOTONIC clock cut down to 32 bits. touch_to_handler is only
+recorded when the two line up to a plausible value (0 - 10 s); otherwise
+(e.g., another display server, or the simulation) it is left out.
+
+At the end of a session, two files are written next to the data .csv:
+    ..._latency_summary.csv   -> count, p50, p95, p99 and max of each metric
+                                 for the whole session and for each trial
+    ..._latency_histogram.csv -> the number of pecks in each latency bin
+"""
+
+from array import array
+from csv import writer
+from math import isnan, nan
+from time import monotonic_ns
+
+LATENCY_METRICS = ["touch_to_handler", "handler_duration",
+                   "handler_to_food", "touch_to_food"]
+
+# Upper edges (ms) of the histogram bins; the last bin holds everything above
+HISTOGRAM_BIN_EDGES_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+def percentile(sorted_values, p):
+    # Linearly interpolated percentile (p = 0-100) of an already sorted list
+    if not sorted_values:
+        return nan
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize_latencies(values):
+    # (count, p50, p95, p99, max) of a list of latencies, ignoring NaNs
+    values = sorted(v for v in values if not isnan(v))
+    if not values:
+        return (0, nan, nan, nan, nan)
+    return (len(values), percentile(values, 50), percentile(values, 95),
+            percentile(values, 99), values[-1])
+
+
+class PeckLatencyMonitor(object):
+    # Collects the latencies of every peck handled during a session. The
+    # MainScreen calls handler_entered() first thing in a peck handler,
+    # food_commands_issued() once the hopper has been sent up, and
+    # handler_exited() on the way out. Latencies are kept in typed arrays
+    # (ms, NaN = not applicable) with the trial number of each peck.
+    def __init__(self, clock_ns = monotonic_ns, max_event_lag_ms = 10000,
+                 use_event_time = True):
+        self.clock_ns = clock_ns
+        self.max_event_lag_ms = max_event_lag_ms
+        self.use_event_time = use_event_time # False if event.time isn't from the X server
+        self.trial_nums = array('i')
+        self.latencies = {metric: array('d') for metric in LATENCY_METRICS}
+        self.current = None # [event.time, entry ns, food ns, trial] of the peck being handled
+        self.onset_latencies = {} # "stimulus_onset_<layout>" -> array of ms
+        self.reinforcer_latencies = array('d') # decision_to_servo (ms)
+
+    def __len__(self):
+        return len(self.trial_nums)
+
+    def handler_entered(self, event, trial_num):
+        entry_ns = self.clock_ns()
+        self.current = [getattr(event, "time", None), entry_ns, None, trial_num]
+
+    def food_commands_issued(self):
+        # Only counts if it happens while a peck is being handled (i.e., not
+        # for auto-reinforcement)
+        if self.current is not None and self.current[2] is None:
+            self.current[2] = self.clock_ns()
+
+    def handler_exited(self):
+        exit_ns = self.clock_ns()
+        if self.current is None:
+            return
+        event_time, entry_ns, food_ns, trial_num = self.current
+        self.current = None
+        touch_to_handler = nan
+        if self.use_event_time and isinstance(event_time, int):
+            # Both clocks in ms, wrapped to 32 bits like the X server's
+            lag_ms = (entry_ns / 1e6 - event_time) % 2**32
+            if lag_ms <= self.max_event_lag_ms:
+                touch_to_handler = lag_ms
+        handler_to_food = nan if food_ns is None else (food_ns - entry_ns) / 1e6
+        self.trial_nums.append(trial_num)
+        self.latencies["touch_to_handler"].append(touch_to_handler)
+        self.latencies["handler_duration"].append((exit_ns - entry_ns) / 1e6)
+        self.latencies["handler_to_food"].append(handler_to_food)
+        self.latencies["touch_to_food"].append(touch_to_handler + handler_to_food)
+
+    def record_onset(self, label, ms):
+        # Stimulus onset latency (ms) of a stage change that showed label
+        self.onset_latencies.setdefault(f"stimulus_onset_{label}", array('d')).append(ms)
+
+    def record_reinforcer(self, ms):
+        # Decision-to-servo latency of a reinforcer (called from the
+        # hardware command thread; one array append)
+        self.reinforcer_latencies.append(ms)
+
+    def snapshot(self):
+        # A copy of the collected latencies (for writing on another thread)
+        copy = PeckLatencyMonitor(self.clock_ns, self.max_event_lag_ms,
+                                  self.use_event_time)
+        copy.trial_nums = array('i', self.trial_nums)
+        copy.latencies = {metric: array('d', values)
+                          for metric, values in self.latencies.items()}
+        copy.onset_latencies = {metric: array('d', values)
+                                for metric, values in self.onset_latencies.items()}
+        copy.reinforcer_latencies = array('d', self.reinforcer_latencies)
+        return copy
+
+    def summary(self):
+        # {metric: (count, p50, p95, p99, max)} for the whole session
+        # (peck latencies, reinforcer latencies, then the stimulus onset
+        # latencies)
+        summary = {metric: summarize_latencies(values)
+                   for metric, values in self.latencies.items()}
+        if self.reinforcer_latencies:
+            summary["decision_to_servo"] = summarize_latencies(self.reinforcer_latencies)
+        for metric, values in sorted(self.onset_latencies.items()):
+            summary[metric] = summarize_latencies(values)
+        return summary
+
+    def trial_summaries(self):
+        # {trial number: {metric: (count, p50, p95, p99, max)}}
+        by_trial = {}
+        for i, trial_num in enumerate(self.trial_nums):
+            trial = by_trial.setdefault(trial_num, {metric: [] for metric in LATENCY_METRICS})
+            for metric, values in self.latencies.items():
+                trial[metric].append(values[i])
+        return {trial_num: {metric: summarize_latencies(values)
+                            for metric, values in trial.items()}
+                for trial_num, trial in by_trial.items()}
+
+    def histogram(self, metric):
+        # Number of latencies in each bin of HISTOGRAM_BIN_EDGES_MS
+        counts = [0] * (len(HISTOGRAM_BIN_EDGES_MS) + 1)
+        values = self.latencies.get(metric)
+        if values is None and metric == "decision_to_servo":
+            values = self.reinforcer_latencies
+        if values is None:
+            values = self.onset_latencies.get(metric, [])
+        for value in values:
+            if isnan(value):
+                continue
+            b = 0
+            while b < len(HISTOGRAM_BIN_EDGES_MS) and value > HISTOGRAM_BIN_EDGES_MS[b]:
+                b += 1
+            counts[b] += 1
+        return counts
+
+    def report(self):
+        # A short summary for the terminal
+        lines = [f"Peck latencies ({len(self)} pecks):",
+                 f"{'Metric':>30} |     n |   p50 ms |   p95 ms |   p99 ms |   max ms"]
+        for metric, (n, p50, p95, p99, maximum) in self.summary().items():
+            lines.append(f"{metric:>30} | {n:5d} | {p50:8.3f} | {p95:8.3f} | "
+                         f"{p99:8.3f} | {maximum:8.3f}")
+        return "\n".join(lines)
+
+
+def format_ms(value):
+    return "NA" if isnan(value) else round(value, 4)
+
+
+def write_latency_report(monitor, base_path):
+    # Writes <base_path>_latency_summary.csv and <base_path>_latency_histogram.csv
+    summary_path = f"{base_path}_latency_summary.csv"
+    with open(summary_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(["Scope", "TrialNum", "Metric", "Count",
+                    "P50Ms", "P95Ms", "P99Ms", "MaxMs"])
+        for metric, stats in monitor.summary().items():
+            w.writerow(["session", "NA", metric, stats[0]] +
+                       [format_ms(v) for v in stats[1:]])
+        for trial_num, trial in sorted(monitor.trial_summaries().items()):
+            for metric, stats in trial.items():
+                if stats[0] > 0:
+                    w.writerow(["trial", trial_num, metric, stats[0]] +
+                               [format_ms(v) for v in stats[1:]])
+
+    histogram_path = f"{base_path}_latency_histogram.csv"
+    with open(histogram_path, 'w', newline='') as f:
+        w = writer(f)
+        w.writerow(["Metric", "BinLowerMs", "BinUpperMs", "Count"])
+        edges = [0] + HISTOGRAM_BIN_EDGES_MS + ["inf"]
+        for metric in LATENCY_METRICS + ["decision_to_servo"] + sorted(monitor.onset_latencies):
+            for b, count in enumerate(monitor.histogram(metric)):
+                w.writerow([metric, edges[b], edges[b + 1], count])
+    return summary_path, histogram_path
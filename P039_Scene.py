@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Retained canvas scene
+
+The MainScreen used to delete every item on the Canvas at each stage change
+and then draw the background, receptive fields, arcs and images again (and
+rebind all their tags). The CanvasScene instead keeps every item the session
+will ever show on the Canvas from the start, hidden, grouped into named
+"layouts" (e.g., the background, the SBE keys, the choice stimuli). A stage
+change then only shows/hides whole layouts and swaps the images or colors
+that differ from trial to trial (with itemconfigure). Tag bindings are made
+once, when the items are created.
+
+Hidden items are never drawn and can't be pecked (Tk ignores them when
+working out which item is under a touch), so the screen looks and behaves
+the same as when only the current items existed.
+
+The time from the start of a stage change until Tk has redrawn the screen
+(its next idle moment, which is when the Canvas redraws) is measured for
+every shown layout and passed to on_visible(label, ms).
+"""
+
+from time import perf_counter_ns
+
+
+class CanvasScene(object):
+    # canvas is the Tkinter Canvas (or a stand-in with the same functions).
+    # after_idle(callback) runs callback once Tk has caught up with drawing
+    # (see the schedulers in P039_Scheduler.py).
+    def __init__(self, canvas, after_idle = None, on_visible = None):
+        self.canvas = canvas
+        self.after_idle = after_idle
+        self.on_visible = on_visible # function(label, ms)
+        self.layouts = {} # layout name -> [item IDs]
+        self.items = {} # (layout name, item name) -> item ID
+        self.applied = {} # item ID -> options last given with itemconfigure
+        self.visible = set() # Names of the layouts currently shown
+        self.order = [] # Item IDs in stacking order (bottom first)
+        self.specs = {} # item ID -> (layout, kind, coords, options) it was created with
+
+    def create(self, layout, item_name, kind, *coords, **options):
+        # Creates a hidden item (kind: "rectangle", "oval", "arc", "image" or
+        # "text") in a layout. Items are stacked in the order they are made.
+        item_id = getattr(self.canvas, f"create_{kind}")(*coords, state = "hidden",
+                                                          **options)
+        self.layouts.setdefault(layout, []).append(item_id)
+        if item_name is not None:
+            self.items[(layout, item_name)] = item_id
+        self.applied[item_id] = {}
+        self.order.append(item_id)
+        self.specs[item_id] = (layout, kind, coords, options)
+        return item_id
+
+    def configure(self, configure):
+        # configure: {(layout, item name): {option: value}}. Options that are
+        # already set to the same value are skipped.
+        for key, options in configure.items():
+            item_id = self.items[key]
+            applied = self.applied[item_id]
+            changed = {option: value for option, value in options.items()
+                       if applied.get(option, self) != value}
+            if changed:
+                self.canvas.itemconfigure(item_id, **changed)
+                applied.update(changed)
+
+    def set_state(self, layout, state):
+        for item_id in self.layouts[layout]:
+            self.canvas.itemconfigure(item_id, state = state)
+
+    def show(self, layouts, configure = None, label = None, started_ns = None):
+        # Makes exactly these layouts visible (after applying configure; see
+        # configure()). If label is given, the time from started_ns (or now)
+        # until the screen has been redrawn is passed to on_visible().
+        if started_ns is None:
+            started_ns = perf_counter_ns()
+        layouts = set(layouts)
+        for layout in self.visible - layouts:
+            self.set_state(layout, "hidden")
+        if configure:
+            self.configure(configure)
+        for layout in layouts - self.visible:
+            self.set_state(layout, "normal")
+        self.visible = layouts
+        if label is not None and self.after_idle is not None and self.on_visible is not None:
+            self.after_idle(lambda: self.on_visible(label, (perf_counter_ns() - started_ns) / 1e6))
+
+    def add(self, layout, configure = None):
+        # Shows one more layout on top of what is already visible
+        self.show(self.visible | {layout}, configure)
+
+    def hide_all(self):
+        self.show([])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Phase 1 trial schedule generator
+
+The phase 1 (autoshaping/instrumental) session is laid out as:
+
+    1) Warm-up blocks. Each one shows one stimulus from every training set
+       (in a random set order, never reusing a stimulus from an earlier
+       warm-up block), followed by a probe stimulus. The probes are taken in
+       the subject's counterbalanced probe_stimulus_order.
+    2) Main blocks. Each one shows every stimulus exactly once, in a random
+       order in which no more than max_run (2) stimuli in a row come from
+       the same training set (probes count as training set 0).
+
+The original code built the main blocks by shuffling the whole block and
+starting over until the shuffle happened to pass. That only ever checked the
+first 12 positions of a block, never looked across block boundaries, and
+with larger or uneven training sets it can reject almost every shuffle (or
+never finish, if no valid order exists). Here each block is built one trial
+at a time instead: at every position, only training sets that can still lead
+to a valid block are allowed, and a stimulus is drawn from them with each
+remaining stimulus equally likely. A small backtracking search covers
+anything the check misses, with a hard limit on the number of steps, so the
+generator always finishes quickly or raises a ScheduleError saying why.
+
+Usage (from the MainScreen):
+
+    trial_stimulus_order = build_phase1_schedule(stimuli, probe_stimulus_order)
+"""
+
+import random
+
+
+class ScheduleError(ValueError):
+    # Raised when no schedule can meet the constraints
+    pass
+
+
+def group_by_training_set(stimuli):
+    # Returns {TrainingSet: [stimuli]} (keeping the order they were given in)
+    groups = {}
+    for d in stimuli:
+        groups.setdefault(d["TrainingSet"], []).append(d)
+    return groups
+
+
+def block_is_feasible(counts, last_set, last_run, max_run):
+    # True if the remaining stimuli (counts = {TrainingSet: number left}) can
+    # be put in some order with no more than max_run of a set in a row,
+    # given that the schedule so far ends in last_run stimuli of last_set.
+    # Each set's stimuli have to be split into runs separated by the other
+    # stimuli, so a set with c stimuli needs c <= max_run * (others + 1);
+    # the set the schedule currently ends in loses the part of its first run
+    # that has already been used.
+    total = sum(counts.values())
+    for training_set, c in counts.items():
+        capacity = max_run * (total - c + 1)
+        if training_set == last_set:
+            capacity -= last_run
+        if c > capacity:
+            return False
+    return True
+
+
+def build_constrained_block(stimuli, max_run = 2, last_set = None, last_run = 0,
+                            rng = random, max_steps = 100000):
+    # Returns the stimuli in a random order with no more than max_run in a
+    # row from the same training set, following on from a schedule that ends
+    # in last_run stimuli from last_set
+    groups = group_by_training_set(stimuli)
+    counts = {training_set: len(group) for training_set, group in groups.items()}
+    if not block_is_feasible(counts, last_set, last_run, max_run):
+        raise ScheduleError(f"No order of {len(stimuli)} stimuli in training sets "
+                            f"{counts} has at most {max_run} of a set in a row")
+
+    # Depth-first search over training sets; the stimuli within each set
+    # are shuffled once and handed out in that order afterwards.
+    order = [] # Training set at each position
+    options = [] # Sets still to try at each position
+    run = [] # (set, run length) at each position
+    steps = 0
+    while len(order) < len(stimuli):
+        if len(options) == len(order):
+            # New position: list the sets that can still lead to a valid block
+            prev_set, prev_run = run[-1] if run else (last_set, last_run)
+            allowed = []
+            for training_set, c in counts.items():
+                if c == 0:
+                    continue
+                new_run = prev_run + 1 if training_set == prev_set else 1
+                if new_run > max_run:
+                    continue
+                counts[training_set] -= 1
+                if block_is_feasible(counts, training_set, new_run, max_run):
+                    allowed.append(training_set)
+                counts[training_set] += 1
+            options.append(allowed)
+        steps += 1
+        if steps > max_steps:
+            raise ScheduleError(f"Gave up after {max_steps} steps")
+        allowed = options[-1]
+        if not allowed:
+            # Dead end: undo the previous position and try another set there
+            options.pop()
+            if not order:
+                raise ScheduleError("No valid order found")
+            counts[order.pop()] += 1
+            run.pop()
+            continue
+        # Each remaining stimulus is equally likely, so weight sets by count
+        weights = [counts[training_set] for training_set in allowed]
+        training_set = rng.choices(allowed, weights)[0]
+        allowed.remove(training_set)
+        prev_set, prev_run = run[-1] if run else (last_set, last_run)
+        run.append((training_set, prev_run + 1 if training_set == prev_set else 1))
+        order.append(training_set)
+        counts[training_set] -= 1
+
+    shuffled = {training_set: rng.sample(group, len(group))
+                for training_set, group in groups.items()}
+    return [shuffled[training_set].pop() for training_set in order]
+
+
+def build_warm_up_blocks(stimuli, probe_stimulus_order, n_blocks = 2, rng = random):
+    # One unused stimulus from each control training set (in a random set
+    # order), then the probe with the next StimulusNum in probe_stimulus_order
+    groups = group_by_training_set(stimuli)
+    probes = {d["StimulusNum"]: d for d in groups.pop("0", [])}
+    if len(probe_stimulus_order) < n_blocks:
+        raise ScheduleError(f"{n_blocks} warm-up blocks need {n_blocks} probes in "
+                            f"the probe order (got {probe_stimulus_order})")
+    unused = {training_set: rng.sample(group, len(group))
+              for training_set, group in groups.items()}
+    schedule = []
+    for block in range(n_blocks):
+        training_sets = sorted(unused, key = int)
+        rng.shuffle(training_sets)
+        for training_set in training_sets:
+            if not unused[training_set]:
+                raise ScheduleError(f"Training set {training_set} has too few "
+                                    f"stimuli for {n_blocks} warm-up blocks")
+            schedule.append(unused[training_set].pop())
+        probe_num = str(probe_stimulus_order[block])
+        if probe_num not in probes:
+            raise ScheduleError(f"No probe stimulus with StimulusNum {probe_num}")
+        schedule.append(probes[probe_num])
+    return schedule
+
+
+def build_phase1_schedule(stimuli, probe_stimulus_order, n_warm_up_blocks = 2,
+                          n_blocks = 6, max_run = 2, rng = random):
+    # Builds the full phase 1 trial order (warm-up blocks, then n_blocks
+    # constrained shuffles of all the stimuli). rng defaults to the global
+    # random module (so random.seed() makes the schedule reproducible).
+    schedule = build_warm_up_blocks(stimuli, probe_stimulus_order,
+                                    n_warm_up_blocks, rng)
+    for block in range(n_blocks):
+        last_set, last_run = trailing_run(schedule)
+        schedule.extend(build_constrained_block(stimuli, max_run, last_set,
+                                                last_run, rng))
+    return schedule
+
+
+def trailing_run(schedule):
+    # Returns (training set, run length) of the stimuli at the end of schedule
+    if not schedule:
+        return None, 0
+    last_set = schedule[-1]["TrainingSet"]
+    run = 0
+    for d in reversed(schedule):
+        if d["TrainingSet"] != last_set:
+            break
+        run += 1
+    return last_set, run
+
+
+def run_violations(schedule, max_run = 2):
+    # Returns the positions at which more than max_run stimuli in a row come
+    # from the same training set (an empty list means the schedule is valid)
+    violations = []
+    run = 0
+    for i, d in enumerate(schedule):
+        if i > 0 and d["TrainingSet"] == schedule[i - 1]["TrainingSet"]:
+            run += 1
+        else:
+            run = 1
+        if run > max_run:
+            violations.append(i)
+    return violations
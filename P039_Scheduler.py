@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Schedulers
+
+Every timer in the MainScreen (ITI, trial delay, auto-reinforcer, hopper
+duration, correction timeout, ...) and every timestamp written to the data
+goes through a scheduler, so the same trial logic can run on two clocks:
+
+    TkScheduler           -> real time. Timers are Tkinter after() calls and
+                             timestamps come from time.perf_counter_ns. This
+                             is what runs in the operant boxes.
+    VirtualClockScheduler -> simulated time. Timers are kept in a queue and
+                             run one after another as fast as possible, with
+                             the clock jumping straight to each timer's due
+                             time. A 90 minute session runs in a fraction of
+                             a second, and because the clock starts at a
+                             fixed date and only moves when a timer fires,
+                             the timestamps in the data are exactly the same
+                             every time the session is rerun.
+
+A scheduler has seven functions:
+    after(delay_ms, callback) -> timer ID   (run callback in delay_ms ms)
+    after_idle(callback)      -> timer ID   (run callback once the screen is redrawn)
+    cancel(timer ID)                        (no error if already run/cancelled)
+    monotonic_ns() -> nanoseconds           (the session clock)
+    monotonic()    -> seconds               (the session clock, in seconds)
+    wall_clock()   -> datetime              (the date and time of day)
+    system_clock_drift_ms() -> ms           (see below)
+
+There is only one clock: wall_clock() is the session clock added to the date
+and time it was anchored to (once, when the scheduler was made), so the
+time of day in the data can't jump if the computer's clock is changed (e.g.,
+by NTP) during a session. system_clock_drift_ms() says how far the
+computer's clock has moved against the session clock since then.
+"""
+
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from time import perf_counter_ns
+
+
+class TkScheduler(object):
+    # Real-time scheduler built on a Tkinter widget's after() timers
+    def __init__(self, root):
+        self.root = root
+        # The session clock's anchor
+        self.anchor_ns = perf_counter_ns()
+        self.anchor_wall_clock = datetime.now()
+
+    def after(self, delay_ms, callback):
+        return self.root.after(delay_ms, callback)
+
+    def after_idle(self, callback):
+        # Tk redraws the Canvas when it is next idle, so this runs just
+        # after the pending changes have been drawn
+        return self.root.after_idle(callback)
+
+    def cancel(self, timer_id):
+        self.root.after_cancel(timer_id)
+
+    def monotonic_ns(self):
+        return perf_counter_ns()
+
+    def monotonic(self):
+        return perf_counter_ns() / 1e9
+
+    def wall_clock(self):
+        return self.anchor_wall_clock + timedelta(microseconds = (perf_counter_ns() - self.anchor_ns) // 1000)
+
+    def system_clock_drift_ms(self):
+        return (datetime.now() - self.wall_clock()).total_seconds() * 1000
+
+
+class VirtualClockScheduler(object):
+    # Discrete-event scheduler: timers are run in order of their due time
+    # (and, for timers due at the same time, in the order they were set,
+    # as Tkinter does), and the clock jumps to each one as it runs.
+    def __init__(self, start = datetime(2024, 1, 1, 9, 0, 0)):
+        self.start = start # Wall clock time at virtual time 0
+        self.anchor_ns = 0
+        self.anchor_wall_clock = start
+        self.now_ms = 0 # Virtual time (ms) since the scheduler was made
+        self.timer_queue = [] # heap of (due time, order, timer ID)
+        self.callbacks = {} # timer ID -> callback (removed when run or cancelled)
+        self.timer_counter = 0
+
+    def after(self, delay_ms, callback):
+        self.timer_counter += 1
+        timer_id = f"after#{self.timer_counter}"
+        self.callbacks[timer_id] = callback
+        heappush(self.timer_queue, (self.now_ms + max(0, int(delay_ms)),
+                                    self.timer_counter, timer_id))
+        return timer_id
+
+    def after_idle(self, callback):
+        # Nothing is drawn, so idle callbacks are just due straight away
+        return self.after(0, callback)
+
+    def cancel(self, timer_id):
+        self.callbacks.pop(timer_id, None)
+
+    def monotonic_ns(self):
+        return self.now_ms * 1000000
+
+    def monotonic(self):
+        return self.now_ms / 1000
+
+    def wall_clock(self):
+        return self.start + timedelta(milliseconds = self.now_ms)
+
+    def system_clock_drift_ms(self):
+        return 0.0 # There is no other clock
+
+    @property
+    def pending(self):
+        return len(self.callbacks)
+
+    def run_next(self):
+        # Runs the next due timer, advancing the clock to its due time.
+        # Returns False if there are no timers left.
+        while self.timer_queue:
+            due_ms, order, timer_id = heappop(self.timer_queue)
+            callback = self.callbacks.pop(timer_id, None)
+            if callback is not None:
+                self.now_ms = due_ms
+                callback()
+                return True
+        return False
+
+    def run(self, until_ms = None):
+        # Runs timers until none are left (or, if until_ms is given, until
+        # the next one is due after until_ms, leaving the clock at until_ms)
+        while self.timer_queue:
+            if self.timer_queue[0][2] not in self.callbacks:
+                heappop(self.timer_queue) # Cancelled
+                continue
+            if until_ms is not None and self.timer_queue[0][0] > until_ms:
+                self.now_ms = max(self.now_ms, until_ms)
+                return
+            self.run_next()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Session plans
+
+Everything random about a session is decided ahead of time and saved as a
+"session plan": a small .json file in the subject's data folder. A plan
+holds:
+    - the trial order (phase 1: the stimulus of each trial; phase 2: the
+      left/right stimuli or SBE colors and trial type of each trial)
+    - the correct side of every SBE trial (correct_choice_list; phase 2)
+    - the ITI duration and ratio requirement of every trial (phases 0/1)
+    - the seed it was generated from
+
+A plan is fully determined by its seed (plus the stimulus list and the
+subject's probe counterbalancing), so any session can be regenerated and
+audited later, and the seed is written on every row of the session's data
+file (SessionPlanSeed column).
+
+Plans can be made in advance, e.g. for the next ten phase 2 sessions:
+
+    python P039_SessionPlan.py prepare --subject Itzamna --phase 2 --sessions 10
+
+which writes them to <data folder>/<subject>/session_plans/. When a session
+starts, the MainScreen takes the oldest unused plan for that subject and
+phase (and makes a new one on the spot if there are none). Once the bird is
+in the box and the session starts, the plan is moved into the used/
+subfolder so it is never run twice.
+"""
+
+from argparse import ArgumentParser
+from csv import DictReader
+from datetime import datetime
+from json import dump, load
+from os import listdir, makedirs, replace, getcwd, path as os_path
+import random
+
+from P039_Schedule import build_phase1_schedule
+
+PLAN_FORMAT_VERSION = 1
+
+# To counter-balance the early order of probe stimuli, subjects are assigned
+# to one of four groups (control conditions), each of which receives the
+# probe stimuli in a different order (e.g., group 1: P1-P5-P2-P3-P4)
+SUBJECT_CONTROL_CONDITIONS = {
+    "TEST": 1,
+    "Jubilee": 1,
+    "Itzamna": 2,
+    "Hawthorne": 3,
+    "Hendrix": 4
+    }
+
+PROBE_STIMULUS_ORDERS = {
+    1: [1, 5, 2, 3, 4],
+    2: [1, 5, 4, 3, 2],
+    3: [5, 1, 2, 3, 4],
+    4: [5, 1, 4, 3, 2]
+    }
+
+# Highest number of trials in a session of each phase (also the number of
+# ITI/ratio requirement draws made for phases 0 and 1)
+MAX_TRIALS = {0: 90, 1: 84, 2: 84}
+
+# Range of ITI durations (s) and ratio requirements drawn for each trial
+ITI_DURATION_RANGE = {0: range(10, 21), 1: range(10, 21)}
+RATIO_REQUIREMENT_RANGE = {0: range(3, 8), # RR5
+                           1: range(7, 13)} # RR10
+
+# Colors used for the side-bias elimination (SBE) trials of phase 2
+SBE_COLORS = ["#77FF00", "#FF8100", "#D5869D",
+              "#902090", "#FF1100", "#6B4330"]
+
+# Correct sides of the SBE trials of phase 2; one of these lists is used
+# for each session.
+CORRECT_CHOICE_LISTS = [
+    ["left", "right", "left", "right", "right", "left", "left", "right", "right", "left",
+     "right", "left", "left", "right", "left", "right", "right", "left", "right", "left",
+     "left", "right", "left", "right", "left", "right", "left", "right", "right", "left",
+     "right", "left", "left", "right", "left", "right", "left", "right", "left", "right",
+     "right", "left", "left", "right", "right", "left", "left", "right", "left", "right",
+     "left", "right", "left", "left", "right", "right", "left", "right", "left", "right",
+     "left", "right", "left", "right", "left", "right", "left", "right"],
+
+    ["right", "left", "left", "right", "left", "right", "right", "left", "left", "right",
+     "right", "left", "right", "left", "right", "left", "left", "right", "left", "right",
+     "right", "left", "right", "left", "right", "left", "right", "left", "left", "right",
+     "left", "right", "right", "left", "right", "left", "left", "right", "left", "right",
+     "right", "left", "right", "left", "right", "left", "left", "right", "left", "right",
+     "right", "left", "left", "right", "left", "right", "right", "left", "right", "left",
+     "right", "left", "right", "left", "left", "right", "left", "right", "right", "left"],
+
+    ["left", "left", "right", "left", "right", "right", "left", "right", "left", "left",
+     "right", "right", "left", "right", "right", "left", "left", "right", "left", "right",
+     "left", "right", "right", "left", "right", "left", "left", "right", "left", "right",
+     "right", "left", "right", "left", "left", "right", "right", "left", "left", "right",
+     "left", "right", "left", "right", "right", "left", "left", "right", "right", "left",
+     "right", "left", "right", "right", "left", "left", "right", "left", "right", "left",
+     "left", "right", "left", "right", "right", "left", "right", "left"],
+
+    ["right", "right", "left", "right", "left", "left", "right", "left", "right", "right",
+     "left", "right", "left", "left", "right", "left", "right", "right", "left", "right",
+     "left", "left", "right", "left", "right", "right", "left", "right", "left", "left",
+     "right", "left", "right", "right", "left", "right", "left", "left", "right", "left",
+     "right", "right", "left", "right", "left", "left", "right", "left", "right", "right",
+     "left", "right", "left", "left", "right", "left", "right", "right", "left", "right",
+     "left", "left", "right", "left", "right", "right", "left", "left"]
+    ]
+
+
+def read_session_stimuli(stimuli_csv_path):
+    # Returns the stimulus dictionaries used in phases 1 and 2 (StimulusNum 1
+    # or 5) from the stimulus assignments .csv
+    with open(stimuli_csv_path, 'r', encoding='utf-8-sig') as f:
+        return [d for d in DictReader(f) if d['StimulusNum'] in ['1', '5']]
+
+
+def new_seed():
+    # Seeds are drawn from the global random module, so seeding it (as the
+    # simulation does) makes the plans reproducible too
+    return random.randrange(2**32)
+
+
+def choice_task_trials(stimuli, rng, comparison_control_stimuli_class = 5,
+                       comparison_control_stimuli = [1, 5]):
+    # The phase 2 trial order: every left/right permutation of the two probe
+    # and two control stimuli (12 trials) in random order, with 4-7 SBE
+    # trials in front of each one and two at the end
+    utilized_trials = [d for d in stimuli
+                       if int(d["TrainingSet"]) in [0, comparison_control_stimuli_class]
+                       and int(d["StimulusNum"]) in comparison_control_stimuli]
+    probe_trials = []
+    for left in utilized_trials:
+        for right in utilized_trials:
+            if left is right:
+                continue
+            if left['TrainingSet'] == '0' and right['TrainingSet'] == '0':
+                trial_type = 'PvP'
+            elif left['TrainingSet'] == right['TrainingSet']:
+                trial_type = 'CvC'
+            else:
+                trial_type = 'PvC'
+            probe_trials.append([left["Name"], right["Name"], trial_type])
+    rng.shuffle(probe_trials)
+
+    size_of_SBE_gaps = [4, 5, 6, 7] * 3
+    rng.shuffle(size_of_SBE_gaps)
+    size_of_SBE_gaps.append(2) # Two SBE trials after the last probe
+    trials = []
+    for gap in size_of_SBE_gaps:
+        for g in range(gap):
+            left_color, right_color = rng.sample(SBE_COLORS, 2)
+            trials.append([left_color, right_color, "SBE_trial"])
+        if probe_trials:
+            trials.append(probe_trials.pop(0))
+    return trials
+
+
+def SBE_gap_violations(trials, min_gap = 4, max_gap = 7):
+    # Returns the positions of the probe trials in a phase 2 trial list
+    # that don't follow min_gap - max_gap SBE trials in a row (an empty
+    # list means the trial order is valid)
+    violations = []
+    gap = 0
+    for i, trial in enumerate(trials):
+        if trial[2] == "SBE_trial":
+            gap += 1
+            continue
+        if not min_gap <= gap <= max_gap:
+            violations.append(i)
+        gap = 0
+    return violations
+
+
+def generate_session_plan(subject_ID, training_phase, seed, stimuli,
+                          probe_stimulus_order):
+    # Builds the plan for one session from its seed. stimuli is the list
+    # returned by read_session_stimuli().
+    rng = random.Random(seed)
+    plan = {"format": PLAN_FORMAT_VERSION,
+            "subject": subject_ID,
+            "phase": training_phase,
+            "seed": seed,
+            "created": datetime.now().isoformat(timespec = "seconds"),
+            "probe_stimulus_order": list(probe_stimulus_order)}
+    if training_phase == 1:
+        plan["trials"] = [d["Name"] for d in build_phase1_schedule(stimuli,
+                                                                   probe_stimulus_order,
+                                                                   rng = rng)]
+    elif training_phase == 2:
+        plan["trials"] = choice_task_trials(stimuli, rng)
+        plan["correct_choice_list_num"] = rng.randrange(len(CORRECT_CHOICE_LISTS))
+        plan["correct_choice_list"] = CORRECT_CHOICE_LISTS[plan["correct_choice_list_num"]]
+    if training_phase in ITI_DURATION_RANGE:
+        n = MAX_TRIALS[training_phase]
+        plan["ITI_durations"] = [rng.choice(ITI_DURATION_RANGE[training_phase]) * 1000
+                                 for t in range(n)]
+        plan["ratio_requirements"] = [rng.choice(RATIO_REQUIREMENT_RANGE[training_phase])
+                                      for t in range(n)]
+    return plan
+
+
+def check_session_plan(plan, subject_ID, training_phase, stimuli,
+                       probe_stimulus_order):
+    # Raises ValueError if the plan can't be used for this session
+    if plan.get("format") != PLAN_FORMAT_VERSION:
+        raise ValueError(f"unknown plan format {plan.get('format')}")
+    if plan["subject"] != subject_ID or plan["phase"] != training_phase:
+        raise ValueError(f"plan is for {plan['subject']} phase {plan['phase']}")
+    if plan["probe_stimulus_order"] != list(probe_stimulus_order):
+        raise ValueError("plan has a different probe stimulus order")
+    names = {d["Name"] for d in stimuli}
+    for trial in plan.get("trials", []):
+        for name in ([trial] if training_phase == 1 else trial[:2]):
+            if name not in names and name not in SBE_COLORS:
+                raise ValueError(f"plan uses unknown stimulus {name}")
+
+
+## Plan files
+
+def plan_folder(data_folder_directory, subject_ID):
+    return os_path.join(data_folder_directory, subject_ID, "session_plans")
+
+
+def pending_plan_paths(data_folder_directory, subject_ID, training_phase):
+    # Unused plan files for this subject and phase, oldest first
+    folder = plan_folder(data_folder_directory, subject_ID)
+    if not os_path.isdir(folder):
+        return []
+    prefix = f"{subject_ID}_Phase{training_phase}_plan"
+    return [os_path.join(folder, f) for f in sorted(listdir(folder))
+            if f.startswith(prefix) and f.endswith(".json")]
+
+
+def save_session_plan(plan, folder):
+    # Writes the plan as <subject>_Phase<n>_plan<number>_seed<seed>.json,
+    # numbered after any plans (used or not) already in the folder
+    makedirs(os_path.join(folder, "used"), exist_ok = True)
+    prefix = f"{plan['subject']}_Phase{plan['phase']}_plan"
+    existing = [f for sub in [folder, os_path.join(folder, "used")]
+                for f in listdir(sub) if f.startswith(prefix)]
+    number = 1 + max([int(f[len(prefix):].split("_")[0]) for f in existing], default = 0)
+    file_path = os_path.join(folder, f"{prefix}{number:04d}_seed{plan['seed']}.json")
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w') as f:
+        dump(plan, f, separators = (",", ":"))
+    replace(temp_path, file_path)
+    return file_path
+
+
+def load_session_plan(file_path):
+    with open(file_path, 'r') as f:
+        return load(f)
+
+
+def mark_session_plan_used(file_path):
+    # Moves a plan into the used/ subfolder once its session has started
+    used_folder = os_path.join(os_path.dirname(file_path), "used")
+    makedirs(used_folder, exist_ok = True)
+    used_path = os_path.join(used_folder, os_path.basename(file_path))
+    replace(file_path, used_path)
+    return used_path
+
+
+def prepare_session_plans(data_folder_directory, subject_ID, training_phase,
+                          n_sessions, stimuli, probe_stimulus_order, first_seed = None):
+    # Generates and saves plans for the next n_sessions sessions. Seeds are
+    # first_seed, first_seed + 1, ... (or new random seeds if not given).
+    folder = plan_folder(data_folder_directory, subject_ID)
+    makedirs(folder, exist_ok = True)
+    file_paths = []
+    for s in range(n_sessions):
+        seed = new_seed() if first_seed is None else first_seed + s
+        plan = generate_session_plan(subject_ID, training_phase, seed, stimuli,
+                                     probe_stimulus_order)
+        file_paths.append(save_session_plan(plan, folder))
+    return file_paths
+
+
+def next_session_plan(data_folder_directory, subject_ID, training_phase, stimuli,
+                      probe_stimulus_order):
+    # Returns (plan, file path) for the next session: the oldest usable plan
+    # waiting in the subject's folder, or a newly generated one. The file
+    # path is None if data_folder_directory is None (plan kept in memory).
+    if data_folder_directory is not None:
+        for file_path in pending_plan_paths(data_folder_directory, subject_ID,
+                                            training_phase):
+            try:
+                plan = load_session_plan(file_path)
+                check_session_plan(plan, subject_ID, training_phase, stimuli,
+                                   probe_stimulus_order)
+                return plan, file_path
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping session plan {os_path.basename(file_path)} ({e})")
+    plan = generate_session_plan(subject_ID, training_phase, new_seed(), stimuli,
+                                 probe_stimulus_order)
+    if data_folder_directory is None:
+        return plan, None
+    return plan, save_session_plan(plan, plan_folder(data_folder_directory, subject_ID))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Prepare or inspect P039 session plans")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, description in [("prepare", "Generate plans for upcoming sessions"),
+                              ("list", "List the plans waiting to be used")]:
+        p = subparsers.add_parser(name, help=description)
+        p.add_argument("--subject", required=True)
+        p.add_argument("--phase", type=int, choices=[0, 1, 2], required=True)
+        p.add_argument("--data-folder", default=getcwd() + "/data")
+        if name == "prepare":
+            p.add_argument("--sessions", type=int, default=1)
+            p.add_argument("--seed", type=int, default=None, help="Seed of the first plan")
+            p.add_argument("--csv", default="P039a_Stimuli/P039a_stimuli_assignments.csv")
+    args = parser.parse_args()
+
+    if args.command == "prepare":
+        probe_stimulus_order = PROBE_STIMULUS_ORDERS[SUBJECT_CONTROL_CONDITIONS[args.subject]]
+        for file_path in prepare_session_plans(args.data_folder, args.subject, args.phase,
+                                               args.sessions, read_session_stimuli(args.csv),
+                                               probe_stimulus_order, args.seed):
+            print(f"Wrote {file_path}")
+    elif args.command == "list":
+        for file_path in pending_plan_paths(args.data_folder, args.subject, args.phase):
+            plan = load_session_plan(file_path)
+            print(f"{os_path.basename(file_path)} | seed {plan['seed']} | "
+                  f"{len(plan.get('trials', []))} trials | created {plan['created']}")
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Headless simulation
+
+Runs the real MainScreen trial logic (the trial state machine and its
+actions: ITI, sub_stage_one, count_peck, provide_food, ...) with no display and no
+GPIO, with a synthetic "pigeon" doing the pecking. This lets us check the
+whole protocol for every phase, and catch regressions, without sitting in
+front of the touchscreen.
+
+Three pieces stand in for the real thing:
+    HeadlessRoot   -> the Tkinter Toplevel. Its after() timers (and every
+                      timestamp in the data) run on the virtual clock of a
+                      VirtualClockScheduler (see P039_Scheduler.py), so a 90
+                      minute session takes only as long as the computer
+                      needs to run its events, and the same seed gives the
+                      same data file down to the microsecond.
+    HeadlessCanvas -> the Tkinter Canvas. It keeps track of the items drawn
+                      on it and its bindings, and works out which item a
+                      peck at (x, y) lands on the same way Tk does.
+    SyntheticPigeon (and subclasses) -> decides when and where to peck,
+                      based on what is currently on the screen.
+
+Usage (from this folder):
+
+    python P039_Simulation.py --phase 2 --agent side_biased --sessions 200
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from math import atan2, cos, sin, radians, degrees, inf
+from os import chdir, devnull, makedirs, path as os_path
+from random import Random, seed as seed_global_random
+from time import perf_counter
+
+from P039_ExpProgram import MainScreen
+from P039_HitTest import (arc_distance, box_distance, image_box, outline_style,
+                          oval_distance, rectangle_distance)
+from P039_Stimuli import StimulusCache
+from P039_Scheduler import VirtualClockScheduler
+
+
+TRAINING_PHASE_NAME_LIST = ["0: Pre-training",
+                            "1: Autoshaping/Instrumental",
+                            "2: Choice Task"]
+
+
+#%% Stand-ins for the Tkinter window, canvas and images
+
+class HeadlessImage(object):
+    # Stands in for an ImageTk.PhotoImage (only its size is needed)
+    def __init__(self, width, height):
+        self.image_width = width
+        self.image_height = height
+
+    def width(self):
+        return self.image_width
+
+    def height(self):
+        return self.image_height
+
+
+class HeadlessEvent(object):
+    # Stands in for the Tkinter event passed to a binding
+    def __init__(self, x, y, time_ms):
+        self.x = x
+        self.y = y
+        self.time = time_ms # Like the X server's event timestamp (ms)
+
+
+class HeadlessRoot(object):
+    # Stands in for the Tkinter Toplevel. Its after() timers run on the
+    # virtual clock of a VirtualClockScheduler.
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.bindings = {}
+        self.destroyed = False
+
+    def after(self, ms, func):
+        return self.scheduler.after(ms, func)
+
+    def after_cancel(self, after_id):
+        self.scheduler.cancel(after_id)
+
+    def bind(self, sequence, func):
+        self.bindings[sequence] = func
+
+    def unbind(self, sequence):
+        self.bindings.pop(sequence, None)
+
+    def press_key(self, sequence):
+        # Simulates a key press bound with bind() (e.g., "<space>")
+        self.bindings[sequence](HeadlessEvent(0, 0, self.scheduler.now_ms))
+
+    def destroy(self):
+        self.destroyed = True
+
+    # Window manager calls that don't mean anything without a display
+    def title(self, *args): pass
+    def geometry(self, *args): pass
+    def attributes(self, *args): pass
+    def config(self, **kwargs): pass
+
+
+class HeadlessCanvasItem(object):
+    __slots__ = ["item_id", "kind", "coords", "options", "tags"]
+
+    def __init__(self, item_id, kind, coords, options):
+        self.item_id = item_id
+        self.kind = kind
+        self.coords = [float(c) for c in coords]
+        self.options = options
+        tags = options.get("tag", options.get("tags", ()))
+        self.tags = (tags,) if isinstance(tags, str) else tuple(tags)
+
+    def bbox(self):
+        if self.kind == "text":
+            # Without a display there are no font metrics: each character is
+            # taken as 0.55 and each line as 1.2 times the font size
+            # (anchor = "center"). None if there is no text.
+            lines = str(self.options.get("text", "")).split("\n")
+            if not any(lines):
+                return None
+            font = str(self.options.get("font", "")).split()
+            size = int(font[1]) if len(font) > 1 and font[1].isdigit() else 12
+            w, h = 0.55 * size * max(len(line) for line in lines), 1.2 * size * len(lines)
+            x, y = self.coords
+            return [x - w / 2, y - h / 2, x + w / 2, y + h / 2]
+        if self.kind == "image":
+            image = self.options["image"]
+            w, h = image.width(), image.height()
+            x, y = self.coords
+            return [x - w / 2, y - h / 2, x + w / 2, y + h / 2] # anchor = "center"
+        x1, y1, x2, y2 = self.coords
+        return [min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)]
+
+    @property
+    def visible(self):
+        # Hidden items (and images without an image) aren't drawn or pecked
+        if self.options.get("state") == "hidden":
+            return False
+        return self.kind != "image" or bool(self.options.get("image"))
+
+    def distance(self, x, y):
+        # How far (x, y) is from the item, the way Tk measures it when
+        # working out which item a touch is on (see P039_HitTest.py; text
+        # on its estimated bounding box, see bbox())
+        if self.kind == "image":
+            image = self.options["image"]
+            return box_distance(x, y, *image_box(*self.coords, image.width(), image.height()))
+        if self.kind == "text":
+            bounds = self.bbox()
+            return inf if bounds is None else box_distance(x, y, *bounds)
+        x1, y1, x2, y2 = self.bbox()
+        width, filled = outline_style(self.options)
+        if self.kind == "rectangle":
+            return rectangle_distance(x, y, x1, y1, x2, y2, width, filled)
+        cx, cy, rx, ry = (x1 + x2) / 2, (y1 + y2) / 2, (x2 - x1) / 2, (y2 - y1) / 2
+        if self.kind == "oval":
+            return oval_distance(x, y, cx, cy, rx, ry, width, filled)
+        return arc_distance(x, y, cx, cy, rx, ry, float(self.options.get("start", 0)),
+                            float(self.options.get("extent", 90)), width, filled)
+
+    def target_point(self):
+        # Where a pigeon aiming at this item would peck
+        x1, y1, x2, y2 = self.bbox()
+        if self.kind == "arc":
+            mid = radians(float(self.options.get("start", 0)) +
+                          float(self.options.get("extent", 90)) / 2)
+            return ((x1 + x2) / 2 + 0.6 * (x2 - x1) / 2 * cos(mid),
+                    (y1 + y2) / 2 - 0.6 * (y2 - y1) / 2 * sin(mid))
+        return ((x1 + x2) / 2, (y1 + y2) / 2)
+
+
+class HeadlessCanvas(object):
+    # Stands in for the Tkinter Canvas. Items are kept in stacking order
+    # (last created is on top). Like Tk, tag bindings belong to the canvas
+    # and stay in place when the items themselves are deleted.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.items = {} # item ID -> HeadlessCanvasItem (in stacking order)
+        self.item_counter = 0
+        self.tag_bindings = {} # tag -> {sequence: callback}
+        self.bindings = {} # sequence -> callback (for the canvas itself)
+        self.on_change = None # Called whenever items are added, changed or deleted
+
+    def create(self, kind, coords, options):
+        self.item_counter += 1
+        self.items[self.item_counter] = HeadlessCanvasItem(self.item_counter, kind,
+                                                           coords, options)
+        if self.on_change is not None:
+            self.on_change()
+        return self.item_counter
+
+    def create_rectangle(self, *coords, **options):
+        return self.create("rectangle", coords, options)
+
+    def create_oval(self, *coords, **options):
+        return self.create("oval", coords, options)
+
+    def create_arc(self, *coords, **options):
+        return self.create("arc", coords, options)
+
+    def create_image(self, *coords, **options):
+        return self.create("image", coords, options)
+
+    def create_text(self, *coords, **options):
+        return self.create("text", coords, options)
+
+    def delete(self, tag_or_id):
+        if tag_or_id == "all":
+            self.items.clear()
+        else:
+            for item_id in self.find_withtag(tag_or_id):
+                del self.items[item_id]
+        if self.on_change is not None:
+            self.on_change()
+
+    def itemconfigure(self, tag_or_id, **options):
+        for item_id in self.find_withtag(tag_or_id):
+            self.items[item_id].options.update(options)
+        if self.on_change is not None:
+            self.on_change()
+
+    def find_withtag(self, tag_or_id):
+        if tag_or_id == "all":
+            return list(self.items)
+        if isinstance(tag_or_id, int):
+            return [tag_or_id] if tag_or_id in self.items else []
+        return [i for i, item in self.items.items() if tag_or_id in item.tags]
+
+    def tag_bind(self, tag, sequence, func):
+        self.tag_bindings.setdefault(tag, {})[sequence] = func
+
+    def bind(self, sequence, func):
+        self.bindings[sequence] = func
+
+    def pack(self, **kwargs):
+        pass
+
+    def bbox(self, item_id):
+        # Like Tk's canvas.bbox() for a single item
+        item = self.items.get(item_id)
+        return None if item is None else item.bbox()
+
+    def find_topmost(self, x, y, close_enough = 1.0):
+        # The item a peck at (x, y) lands on ("current" item in Tk terms):
+        # the topmost visible one within close_enough of it
+        for item in reversed(list(self.items.values())):
+            if item.visible and item.distance(x, y) <= close_enough:
+                return item
+        return None
+
+    def click(self, x, y, time_ms):
+        # Delivers a <Button-1> at (x, y) to the bindings of every tag of the
+        # item under that point, then to the canvas's own binding, as Tk
+        # does. Returns the item (or None).
+        item = self.find_topmost(x, y)
+        event = HeadlessEvent(x, y, time_ms)
+        if item is not None:
+            for tag in item.tags:
+                callback = self.tag_bindings.get(tag, {}).get("<Button-1>")
+                if callback is not None:
+                    callback(event)
+        callback = self.bindings.get("<Button-1>")
+        if callback is not None:
+            callback(event)
+        return item
+
+    def visible_keys(self):
+        # Returns {tag: topmost item} for every "..._key" tag on the canvas;
+        # the topmost item of a key is its visible stimulus (the receptive
+        # field is drawn underneath it).
+        keys = {}
+        for item in self.items.values():
+            if not item.visible:
+                continue
+            for tag in item.tags:
+                if tag.endswith("_key"):
+                    keys[tag] = item
+        return keys
+
+
+class HeadlessMainScreen(MainScreen):
+    # The real MainScreen, with the Tkinter window, stimulus images and
+    # GPIO hardware swapped out, and data handled inline (no writer thread
+    # and no terminal output).
+    operant_box_version = False
+    threaded_data_writer = False
+    threaded_hardware = False # Box commands (to a MockBackend) are sent inline
+    console_output = False
+    x_event_timestamps = False # Peck event times are on the virtual clock
+    telemetry_port = None # No live telemetry server
+    end_reason = None # Set when exit_program() is first called
+    virtual_start = datetime(2024, 1, 1, 9, 0, 0) # Session "starts" at this date and time
+
+    def build_window(self):
+        self.root = HeadlessRoot(VirtualClockScheduler(self.virtual_start))
+        self.mastercanvas = HeadlessCanvas(self.mainscreen_width,
+                                           self.mainscreen_height)
+
+    def build_scheduler(self):
+        return self.root.scheduler
+
+    def build_stimulus_cache(self):
+        self.stimulus_bundle = None
+        return StimulusCache("P039a_Stimuli",
+                             image_factory = lambda file_path, size: HeadlessImage(size, size))
+
+    def exit_program(self, event):
+        if self.end_reason is None:
+            self.end_reason = event
+        super().exit_program(event)
+
+
+#%% Synthetic pigeons
+
+class SyntheticPigeon(object):
+    # The base agent pecks at whatever keys are on the screen at a steady
+    # average rate (exponentially distributed gaps between pecks), with a
+    # little scatter around the stimulus, plus the occasional peck at an
+    # empty part of the screen.
+    name = "random"
+
+    def __init__(self, peck_rate = 1.0, background_peck_prob = 0.05,
+                 ITI_peck_rate = 0.02, aim_sd = 20):
+        self.peck_rate = peck_rate # Pecks/s while keys are on screen
+        self.background_peck_prob = background_peck_prob
+        self.ITI_peck_rate = ITI_peck_rate # Pecks/s when no keys are on screen
+        self.aim_sd = aim_sd # Scatter (px) around the aimed-at point
+
+    def first_peck_latency_ms(self, rng):
+        # Delay before the first peck once new keys appear
+        return self.peck_interval_ms(rng)
+
+    def peck_interval_ms(self, rng):
+        return rng.expovariate(self.peck_rate) * 1000
+
+    def choose_key(self, rng, key_tags):
+        return rng.choice(key_tags)
+
+    def next_peck(self, rng, keys, width, height, onset):
+        # Returns (delay ms, x, y) for the next peck, or None for no peck
+        # until the screen changes. keys is {tag: topmost canvas item}.
+        if not keys:
+            if self.ITI_peck_rate <= 0:
+                return None
+            return (rng.expovariate(self.ITI_peck_rate) * 1000,
+                    rng.uniform(0, width), rng.uniform(0, height))
+        if onset:
+            delay_ms = self.first_peck_latency_ms(rng)
+        else:
+            delay_ms = self.peck_interval_ms(rng)
+        if rng.random() < self.background_peck_prob:
+            return delay_ms, rng.uniform(0, width), rng.uniform(0, height)
+        target_x, target_y = keys[self.choose_key(rng, sorted(keys))].target_point()
+        return (delay_ms,
+                min(max(rng.gauss(target_x, self.aim_sd), 0), width - 1),
+                min(max(rng.gauss(target_y, self.aim_sd), 0), height - 1))
+
+
+class SideBiasedPigeon(SyntheticPigeon):
+    # Given a left and a right key, picks the left one with probability
+    # left_bias (0.5 = no bias)
+    name = "side_biased"
+
+    def __init__(self, left_bias = 0.8, **kwargs):
+        super().__init__(**kwargs)
+        self.left_bias = left_bias
+
+    def choose_key(self, rng, key_tags):
+        if "left_stimulus_key" in key_tags and "right_stimulus_key" in key_tags:
+            if rng.random() < self.left_bias:
+                return "left_stimulus_key"
+            return "right_stimulus_key"
+        return super().choose_key(rng, key_tags)
+
+
+class LatencyDistributedPigeon(SyntheticPigeon):
+    # Waits a log-normally distributed time before the first peck at new
+    # keys (median first_peck_median_s), then pecks in quick bouts
+    name = "latency"
+
+    def __init__(self, first_peck_median_s = 4.0, first_peck_sigma = 0.8,
+                 **kwargs):
+        kwargs.setdefault("peck_rate", 2.5)
+        super().__init__(**kwargs)
+        self.first_peck_median_s = first_peck_median_s
+        self.first_peck_sigma = first_peck_sigma
+
+    def first_peck_latency_ms(self, rng):
+        return rng.lognormvariate(0, self.first_peck_sigma) * self.first_peck_median_s * 1000
+
+
+AGENTS = {agent.name: agent for agent in [SyntheticPigeon, SideBiasedPigeon,
+                                         LatencyDistributedPigeon]}
+
+
+#%% Running sessions
+
+class HeadlessSession(object):
+    # Runs one complete session of the MainScreen on the virtual clock with
+    # a synthetic pigeon pecking at it.
+    def __init__(self, agent, subject_ID, training_phase, seed = None,
+                 data_folder_directory = None, max_session_minutes = 240):
+        if seed is not None:
+            seed_global_random(seed) # The MainScreen uses the global random module
+        self.rng = Random(seed)
+        self.agent = agent
+        self.max_session_ms = max_session_minutes * 60 * 1000
+        record_data = data_folder_directory is not None
+        if record_data:
+            makedirs(os_path.join(data_folder_directory, subject_ID), exist_ok = True)
+        # Each seed's session "starts" on a different day, so that sessions
+        # saved to the same data folder get different data file names (over
+        # up to 100000 days, for large seeds such as the fleet's)
+        screen_class = HeadlessMainScreen
+        if seed is not None:
+            screen_class = type("HeadlessMainScreen", (HeadlessMainScreen,),
+                                {"virtual_start": HeadlessMainScreen.virtual_start +
+                                                  timedelta(days = seed % 100000)})
+        self.screen = screen_class(subject_ID,
+                                   record_data,
+                                   data_folder_directory,
+                                   training_phase,
+                                   TRAINING_PHASE_NAME_LIST,
+                                   False) # No video recording
+        self.root = self.screen.root
+        self.scheduler = self.screen.scheduler
+        self.canvas = self.screen.mastercanvas
+        self.canvas.on_change = self.screen_changed
+        self.pending_peck = None # after ID of the next planned peck
+        self.replan_pending = False
+        self.peck_count = 0
+
+    def screen_changed(self):
+        # Items were added/removed; once the current callback has finished
+        # drawing, let the pigeon reconsider what to peck
+        if not self.replan_pending:
+            self.replan_pending = True
+            self.scheduler.after(0, lambda: self.plan_next_peck(onset = True))
+
+    def plan_next_peck(self, onset):
+        self.replan_pending = False
+        if self.pending_peck is not None:
+            self.scheduler.cancel(self.pending_peck)
+            self.pending_peck = None
+        keys = self.canvas.visible_keys()
+        if onset and not keys and not any(item.visible for item in self.canvas.items.values()):
+            return # Nothing on screen at all (e.g., during exit)
+        peck = self.agent.next_peck(self.rng, keys, self.canvas.width,
+                                    self.canvas.height, onset)
+        if peck is not None:
+            delay_ms, x, y = peck
+            self.pending_peck = self.scheduler.after(delay_ms, lambda: self.peck(x, y))
+
+    def peck(self, x, y):
+        self.pending_peck = None
+        self.peck_count += 1
+        self.canvas.click(int(x), int(y), self.scheduler.now_ms)
+        if not self.replan_pending:
+            self.plan_next_peck(onset = False)
+
+    def run(self):
+        self.root.press_key("<space>") # Bird is in the box
+        while self.screen.end_reason is None:
+            if self.scheduler.now_ms > self.max_session_ms:
+                self.screen.exit_program("SimulationTimeLimit")
+                break
+            if not self.scheduler.run_next():
+                self.screen.exit_program("SimulationStalled")
+                break
+        return self.result()
+
+    def result(self):
+        data = self.screen.session_data_frame
+        event_column = data.header_list.index("EventType")
+        event_counts = Counter(data.string_table[code]
+                               for code in data.columns[event_column])
+        return {"subject": self.screen.subject_ID,
+                "phase": self.screen.training_phase,
+                "agent": self.agent.name,
+                "end_reason": self.screen.end_reason,
+                "trials": self.screen.trial_num,
+                "virtual_minutes": self.scheduler.now_ms / 60000,
+                "pecks": self.peck_count,
+                "events": len(data) - 1,
+                "event_counts": event_counts,
+                "data": data}
+
+
+def run_headless_session(agent, subject_ID, training_phase, seed = None,
+                         data_folder_directory = None, verbose = False,
+                         max_session_minutes = 240):
+    # Runs one session and returns its summary dictionary. The MainScreen's
+    # terminal output is hidden unless verbose is True.
+    session = HeadlessSession(agent, subject_ID, training_phase, seed,
+                              data_folder_directory, max_session_minutes)
+    if verbose:
+        return session.run()
+    with open(devnull, "w") as hidden, redirect_stdout(hidden):
+        return session.run()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Run headless P039 sessions with synthetic pigeons")
+    parser.add_argument("--phase", type=int, choices=[0, 1, 2], default=1)
+    parser.add_argument("--subject", default="Itzamna")
+    parser.add_argument("--agent", choices=sorted(AGENTS), default="random")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first session")
+    parser.add_argument("--data-folder", default=None,
+                        help="Write each session's data .csv into this folder")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    chdir(os_path.dirname(os_path.abspath(__file__))) # Stimuli paths are relative
+    agent = AGENTS[args.agent]()
+    end_reasons = Counter()
+    t0 = perf_counter()
+    for s in range(args.sessions):
+        result = run_headless_session(agent, args.subject, args.phase,
+                                      args.seed + s, args.data_folder, args.verbose)
+        end_reasons[result["end_reason"]] += 1
+    elapsed = perf_counter() - t0
+    print(f"{args.sessions} sessions (phase {args.phase}, {args.agent} agent) in "
+          f"{elapsed:.1f} s ({args.sessions / elapsed * 60:.0f} sessions/min)")
+    print(f"Last session: {result['trials']} trials, {result['events']} events, "
+          f"{result['virtual_minutes']:.1f} virtual minutes")
+    print(f"End reasons: {dict(end_reasons)}")
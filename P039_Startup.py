@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Startup timing
+
+Times each step from launching P039_ExpProgram.py until the control panel
+is ready, and runs independent setup steps (e.g., connecting to the GPIO
+board, reading the hopper values and mapping the touchscreen) side by side
+on their own threads, so that the slowest step, rather than the sum of all
+of them, sets how long startup takes.
+
+Once the control panel is ready, a breakdown is printed (times in ms since
+launch):
+
+    Startup timing (ms since launch):
+                          Step |  start |    end | duration | thread
+                       imports |    0.0 |   85.2 |     85.2 | main
+                    GPIO board |   85.9 |  131.0 |     45.1 | startup
+                           ...
+    Control panel ready after 412.3 ms
+
+Heavy libraries (PIL, http.server, sqlite3) are only imported when the
+session needs them (see P039_Stimuli.py, P039_Telemetry.py and
+P039_Catalog.py), so they are not part of the "imports" step.
+"""
+
+from contextlib import contextmanager
+from threading import Thread, current_thread, main_thread, Lock
+from time import perf_counter
+
+
+class StartupTimer(object):
+    # launch_s: perf_counter() at launch (as early as possible in the main
+    # script). Steps can be recorded from any thread.
+    def __init__(self, launch_s = None):
+        self.launch_s = perf_counter() if launch_s is None else launch_s
+        self.steps = [] # (name, start s, end s, thread)
+        self.lock = Lock()
+
+    def add(self, name, start_s, end_s = None):
+        # Records a step that ran from start_s until end_s (default: now)
+        if end_s is None:
+            end_s = perf_counter()
+        thread = "main" if current_thread() is main_thread() else "startup"
+        with self.lock:
+            self.steps.append((name, start_s, end_s, thread))
+
+    @contextmanager
+    def step(self, name):
+        # with startup.step("control panel"): ...
+        start_s = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start_s)
+
+    def start_concurrently(self, steps):
+        # Starts each of steps ({name: function}) on its own thread; returns
+        # the ConcurrentSteps to join() once their results are needed
+        return ConcurrentSteps(self, steps).start()
+
+    def report(self, ready_name = "Control panel"):
+        # The breakdown, in the order the steps started
+        lines = ["Startup timing (ms since launch):",
+                 f"{'Step':>26} |  start |    end | duration | thread"]
+        with self.lock:
+            steps = sorted(self.steps, key = lambda s: s[1])
+        for name, start_s, end_s, thread in steps:
+            lines.append(f"{name:>26} | {(start_s - self.launch_s)*1000:6.1f} | "
+                         f"{(end_s - self.launch_s)*1000:6.1f} | "
+                         f"{(end_s - start_s)*1000:8.1f} | {thread}")
+        lines.append(f"{ready_name} ready after {(perf_counter() - self.launch_s)*1000:.1f} ms")
+        return "\n".join(lines)
+
+
+class ConcurrentSteps(object):
+    # Independent setup steps running on their own (daemon) threads. Each
+    # step is timed in the StartupTimer. join() waits for all of them and
+    # returns {name: result}; if a step raised an exception, join() raises
+    # it (the first one, in the order the steps were given) in the caller's
+    # thread.
+    def __init__(self, timer, steps):
+        self.timer = timer
+        self.results = {}
+        self.errors = {}
+        self.names = list(steps)
+        self.threads = [Thread(target = self.run, args = (name, function),
+                               name = f"P039 startup: {name}", daemon = True)
+                        for name, function in steps.items()]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def run(self, name, function):
+        try:
+            with self.timer.step(name):
+                self.results[name] = function()
+        except BaseException as e:
+            self.errors[name] = e
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        for name in self.names:
+            if name in self.errors:
+                raise self.errors[name]
+        return self.results
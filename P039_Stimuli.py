@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Stimulus loading helpers
+
+Each session uses the same handful of .jpg stimuli over and over (the phase 1
+schedule shows every stimulus several times, and phase 2 shows the same four
+stimuli in every permutation). Rather than opening, resizing and converting
+the file into a new Tkinter PhotoImage every time it shows up in the
+schedule, the StimulusCache decodes each (file, size) pair once and hands out
+the same PhotoImage for every trial that uses it.
+
+To avoid decoding the .jpgs at all during a session, the stimuli listed in
+the stimulus assignments .csv can be pre-rendered into a single "bundle"
+file: every image already resized to the image diameter and stored as raw
+pixels, plus an index. The MainScreen memory-maps the bundle and builds each
+PhotoImage straight from those pixels. The bundle remembers the size and
+modification time of every source .jpg and the image diameter it was built
+for, and is rebuilt automatically if any of them change. It can also be
+built ahead of time (e.g., after copying new stimuli onto a box) with:
+
+    python P039_Stimuli.py build --size 100
+
+PIL is only imported once the first image is needed (it is one of the
+slowest imports at startup, and pre-training doesn't show any stimuli).
+"""
+
+from argparse import ArgumentParser
+from csv import DictReader
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ
+from os import path as os_path, stat, replace
+from struct import pack, unpack
+from time import perf_counter
+
+BUNDLE_MAGIC = b"P039STIMBUNDLE1\n" # First bytes of every bundle file
+BUNDLE_ALIGNMENT = 64 # Pixel data starts on a multiple of this many bytes
+
+
+def make_photo_image(file_path, size):
+    # Opens a stimulus file and resizes it into a square Tkinter image
+    from PIL import ImageTk, Image
+    return ImageTk.PhotoImage(Image.open(file_path).resize((size, size)))
+
+
+class StimulusCache(object):
+    # Keyed by (file name, size). Keeping a reference to every PhotoImage in
+    # the cache also stops Tkinter from garbage collecting images that are
+    # still on the canvas.
+    def __init__(self, stimuli_folder, image_factory = make_photo_image):
+        self.stimuli_folder = stimuli_folder
+        self.image_factory = image_factory # function(file path, size) -> image
+        self.images = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_name, size):
+        key = (file_name, size)
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            image = self.image_factory(os_path.join(self.stimuli_folder, file_name),
+                                       size)
+            self.images[key] = image
+        else:
+            self.hits += 1
+        return image
+
+    def clear(self):
+        self.images.clear()
+
+    def report(self):
+        return (f"Stimulus cache: {self.misses} images decoded, "
+                f"{self.hits} reused ({len(self.images)} held in memory)")
+
+
+## Pre-rendered stimulus bundle
+
+def read_stimulus_names(assignments_csv):
+    # Returns the file names listed in the stimulus assignments .csv
+    with open(assignments_csv, 'r', encoding='utf-8-sig') as f:
+        return [d["Name"] for d in DictReader(f)]
+
+
+def source_signature(file_path):
+    # A cheap fingerprint of a source image: its size and modification time
+    file_stat = stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def default_bundle_path(stimuli_folder, size):
+    return os_path.join(stimuli_folder, f"stimuli_bundle_{size}px.bin")
+
+
+def build_stimulus_bundle(stimuli_folder, assignments_csv, size,
+                          bundle_path = None):
+    # Decodes and resizes every stimulus in the assignments .csv (exactly as
+    # make_photo_image() would) and writes the raw pixels to a single bundle
+    # file. The layout is:
+    #   magic | index length (uint32) | index (JSON) | padding | pixel data
+    # where the index gives each image's offset into the pixel data, its
+    # PIL mode and dimensions, and the signature of its source .jpg.
+    if bundle_path is None:
+        bundle_path = default_bundle_path(stimuli_folder, size)
+    from PIL import Image
+    images = {}
+    pixel_data = bytearray()
+    for name in read_stimulus_names(assignments_csv):
+        file_path = os_path.join(stimuli_folder, name)
+        image = Image.open(file_path).resize((size, size))
+        raw = image.tobytes()
+        images[name] = {"offset": len(pixel_data),
+                        "length": len(raw),
+                        "mode": image.mode,
+                        "width": image.width,
+                        "height": image.height,
+                        "source": source_signature(file_path)}
+        pixel_data += raw
+        pixel_data += bytes(-len(pixel_data) % BUNDLE_ALIGNMENT)
+    index = dumps({"image_diameter": size, "images": images}).encode("utf-8")
+    header = BUNDLE_MAGIC + pack("<I", len(index)) + index
+    header += bytes(-len(header) % BUNDLE_ALIGNMENT)
+
+    # Write to a temporary file first so a half-written bundle is never used
+    temp_path = bundle_path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(header)
+        f.write(pixel_data)
+    replace(temp_path, bundle_path)
+    return bundle_path
+
+
+class StimulusBundle(object):
+    # A read-only, memory-mapped view of a bundle file. Images are built from
+    # the mapped pixels without any .jpg decoding.
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        self.bundle_file = open(bundle_path, 'rb')
+        try:
+            self.mapped = mmap(self.bundle_file.fileno(), 0, access = ACCESS_READ)
+            magic_end = len(BUNDLE_MAGIC)
+            if self.mapped[:magic_end] != BUNDLE_MAGIC:
+                raise ValueError(f"{bundle_path} is not a stimulus bundle")
+            index_length = unpack("<I", self.mapped[magic_end:magic_end + 4])[0]
+            index_end = magic_end + 4 + index_length
+            index = loads(bytes(self.mapped[magic_end + 4:index_end]).decode("utf-8"))
+        except Exception:
+            self.bundle_file.close()
+            raise
+        self.data_start = index_end + (-index_end % BUNDLE_ALIGNMENT)
+        self.image_diameter = index["image_diameter"]
+        self.images = index["images"]
+
+    def is_current(self, stimuli_folder, names, size):
+        # True if the bundle was built for this size, holds every stimulus in
+        # names, and none of the source .jpgs have changed since
+        if size != self.image_diameter:
+            return False
+        for name in names:
+            entry = self.images.get(name)
+            if entry is None:
+                return False
+            try:
+                if source_signature(os_path.join(stimuli_folder, name)) != entry["source"]:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def get_image(self, name):
+        # Returns the pre-rendered stimulus as a PIL image that shares memory
+        # with the mapped file
+        from PIL import Image
+        entry = self.images[name]
+        start = self.data_start + entry["offset"]
+        pixels = memoryview(self.mapped)[start:start + entry["length"]]
+        return Image.frombuffer(entry["mode"], (entry["width"], entry["height"]),
+                                pixels, "raw", entry["mode"], 0, 1)
+
+    def make_photo_image(self, file_path, size):
+        # Drop-in replacement for make_photo_image() (for the StimulusCache).
+        # Falls back to decoding the .jpg if the image isn't in the bundle.
+        name = os_path.basename(file_path)
+        if size != self.image_diameter or name not in self.images:
+            return make_photo_image(file_path, size)
+        from PIL import ImageTk
+        return ImageTk.PhotoImage(self.get_image(name))
+
+    def close(self):
+        # Any images made from the bundle must be released before closing
+        self.mapped.close()
+        self.bundle_file.close()
+
+
+def load_stimulus_bundle(stimuli_folder, assignments_csv, size):
+    # Opens the bundle for this stimulus folder and image size, (re)building
+    # it first if it is missing or out of date. Returns None if the bundle
+    # can't be built (e.g., read-only folder), in which case the .jpgs are
+    # simply decoded as before.
+    bundle_path = default_bundle_path(stimuli_folder, size)
+    try:
+        names = read_stimulus_names(assignments_csv)
+        if os_path.isfile(bundle_path):
+            bundle = StimulusBundle(bundle_path)
+            if bundle.is_current(stimuli_folder, names, size):
+                return bundle
+            bundle.close()
+            print("Stimulus bundle out of date; rebuilding...")
+        build_stimulus_bundle(stimuli_folder, assignments_csv, size, bundle_path)
+        return StimulusBundle(bundle_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not use stimulus bundle ({e}); decoding .jpgs instead")
+        return None
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Build the P039 pre-rendered stimulus bundle")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("build", help="(Re)build the stimulus bundle")
+    p.add_argument("--folder", default="P039a_Stimuli")
+    p.add_argument("--csv", default="P039a_Stimuli/P039a_stimuli_assignments.csv")
+    p.add_argument("--size", type=int, default=100, help="Image diameter (pixels)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        t0 = perf_counter()
+        bundle_path = build_stimulus_bundle(args.folder, args.csv, args.size)
+        print(f"Wrote {bundle_path} ({os_path.getsize(bundle_path)/1024:.0f} KiB) "
+              f"in {(perf_counter() - t0)*1000:.0f} ms")
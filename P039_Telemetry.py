@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Live telemetry
+
+A small HTTP server, run on its own background thread, that reports what a
+running session is doing:
+
+    GET /status  -> JSON: subject, phase, trial number, trial type, state and
+                    substage, reinforcers delivered, pecks per minute (over
+                    the last minute and the whole session), peck latency
+                    percentiles, data writer queue depth and video commands
+                    waiting
+
+The status is put together on the server thread, only when someone asks for
+it, by reading the MainScreen's variables and copying its counters; the
+Tkinter thread never waits on the server (it only appends each peck's time to
+a fixed-size deque, see PeckRate).
+
+By default the server only listens on localhost (port 8039). To poll the
+boxes from one monitoring computer, either forward the port (ssh -L) or start
+the boxes with MainScreen.telemetry_host = "0.0.0.0". Usage:
+
+    python P039_Telemetry.py poll localhost:8039 box2.local:8039 ...
+
+http.server is only imported when a server is started (at the start of a
+session), so it doesn't slow down bringing up the control panel.
+"""
+
+from argparse import ArgumentParser
+from collections import deque
+from json import dumps, loads
+from threading import Thread
+
+DEFAULT_TELEMETRY_PORT = 8039
+
+
+class PeckRate(object):
+    # Pecks per minute. The Tkinter thread calls peck(now) (one deque append);
+    # the server thread reads the rate. Times are in seconds.
+    def __init__(self, window_s = 60, max_pecks = 10000):
+        self.window_s = window_s
+        self.peck_times = deque(maxlen = max_pecks)
+        self.total = 0
+
+    def peck(self, now):
+        self.peck_times.append(now)
+        self.total += 1
+
+    def per_minute(self, now):
+        # Over the last window_s seconds
+        times = list(self.peck_times) # A copy, so the Tkinter thread can keep appending
+        recent = 0
+        for t in reversed(times):
+            if now - t > self.window_s:
+                break
+            recent += 1
+        return recent * 60 / self.window_s
+
+
+def telemetry_handler():
+    # The request handler class (built here so that http.server is only
+    # imported once a server is started)
+    from http.server import BaseHTTPRequestHandler
+
+    class TelemetryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ["", "/status"]:
+                self.send_error(404, "Try /status")
+                return
+            try:
+                body = dumps(self.server.status_function(), default = str).encode()
+            except Exception as e: # Never take the session down
+                self.send_error(500, repr(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Keep the terminal for the session's own output
+
+    return TelemetryHandler
+
+
+class TelemetryServer(object):
+    # Serves status_function() (-> a JSON-able dict) at /status on a daemon
+    # thread until stop() is called
+    def __init__(self, status_function, host = "127.0.0.1",
+                 port = DEFAULT_TELEMETRY_PORT):
+        from http.server import ThreadingHTTPServer
+        self.httpd = ThreadingHTTPServer((host, port), telemetry_handler())
+        self.httpd.daemon_threads = True
+        self.httpd.status_function = status_function
+        self.thread = Thread(target = self.httpd.serve_forever,
+                             name = "P039 telemetry", daemon = True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def start_telemetry_server(status_function, host, port):
+    # Starts a TelemetryServer, or returns None (with a warning) if the port
+    # can't be used, e.g., because another session is still running
+    try:
+        server = TelemetryServer(status_function, host, port).start()
+    except OSError as e:
+        print(f"WARNING: live telemetry not available on {host}:{port} ({e})")
+        return None
+    print(f"Live telemetry at http://{host}:{server.address[1]}/status")
+    return server
+
+
+def poll(addresses, timeout_s = 2):
+    # Prints a line for each box's status
+    from urllib.request import urlopen
+    print(f"{'Box':>22} | {'Subject':>10} | Phase | Trial | {'Type':>11} | Stage | "
+          f"Food | Pecks/min | p95 ms | Queue")
+    for address in addresses:
+        try:
+            with urlopen(f"http://{address}/status", timeout = timeout_s) as response:
+                s = loads(response.read())
+        except Exception as e:
+            print(f"{address:>22} | not reachable ({e})")
+            continue
+        p95 = s["peck_latency_ms"].get("handler_duration", {}).get("p95")
+        print(f"{address:>22} | {s['subject']:>10} | {s['phase']:^5} | {s['trial_num']:5} | "
+              f"{str(s['trial_type']):>11} | {s['trial_stage']:^5} | {s['reinforcers']:4} | "
+              f"{s['pecks_per_minute']:9.1f} | {str(p95):>6} | {s['data_queue_depth']:5}")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Poll the live telemetry of running P039 sessions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("poll")
+    p.add_argument("addresses", nargs="+", help="host:port of each box")
+    args = parser.parse_args()
+    poll(args.addresses)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Timer registry
+
+Every timer the MainScreen sets goes through one TimerRegistry, keyed by
+what the timer is for:
+
+    session_start      -> the first ITI (60 s after the bird is placed)
+    ITI                -> the end of the ITI
+    recording_start    -> starting the cameras 3 s before the end of the ITI
+    trial_delay        -> substage 1 -> substage 2
+    auto_reinforcer    -> the auto-reinforcer
+    correction_timeout -> the grey screen before a correction trial
+    hopper             -> hopper_duration, then checking every ms until the
+                          hopper is down
+    video_poll         -> checking on a running camera script
+    stimulus_onset     -> measuring when the keys are on screen (after_idle)
+
+Only one timer per purpose can be pending. Setting a purpose again while
+its timer is pending cancels the old timer and counts (and, for trial
+timers, reports) a duplicate, so an ITI or a redraw can never be scheduled
+twice.
+
+Trial timers fire events of the trial state machine (see P039_TrialFSM.py).
+Whenever the trial changes state, every pending timer whose event the new
+state has no transition for is cancelled (cancel_stale); e.g., a peck that
+completes the ratio cancels the auto-reinforcer, and exit_program() (which
+ends the state machine) cancels every trial timer there is. The number of
+pending timers is served by the live telemetry, and a summary is printed at
+the end of the session.
+"""
+
+from collections import Counter
+
+
+class TimerRegistry(object):
+    # scheduler: the MainScreen's scheduler (see P039_Scheduler.py)
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.timers = {} # purpose -> [timer ID, trial event (or None)]
+        self.scheduled = Counter()
+        self.fired = Counter()
+        self.cancelled = Counter() # Cancelled before they fired (incl. stale)
+        self.stale = Counter() # Cancelled by a state change
+        self.duplicates = Counter() # Set again while still pending
+
+    def after(self, purpose, delay_ms, callback, event = None):
+        # Runs callback in delay_ms ms (replacing a pending timer for the
+        # same purpose). event: the trial event the timer fires, if any.
+        entry = self.replace(purpose, event)
+        entry[0] = self.scheduler.after(delay_ms, lambda: self.run(purpose, entry, callback))
+        return entry[0]
+
+    def after_idle(self, purpose, callback):
+        # Runs callback once the screen has been redrawn
+        entry = self.replace(purpose, None)
+        entry[0] = self.scheduler.after_idle(lambda: self.run(purpose, entry, callback))
+        return entry[0]
+
+    def replace(self, purpose, event):
+        if purpose in self.timers:
+            self.duplicates[purpose] += 1
+            if event is not None:
+                print(f"WARNING: {purpose} timer set again while pending (replaced)")
+            self.cancel(purpose)
+        entry = [None, event]
+        self.timers[purpose] = entry
+        self.scheduled[purpose] += 1
+        return entry
+
+    def run(self, purpose, entry, callback):
+        if self.timers.get(purpose) is not entry:
+            return # Cancelled (a scheduler may still run it)
+        del self.timers[purpose]
+        self.fired[purpose] += 1
+        callback()
+
+    def cancel(self, purpose):
+        # Cancels the purpose's pending timer; returns whether there was one
+        entry = self.timers.pop(purpose, None)
+        if entry is None:
+            return False
+        self.scheduler.cancel(entry[0])
+        self.cancelled[purpose] += 1
+        return True
+
+    def cancel_stale(self, handles):
+        # Cancels every pending trial timer whose event handles(event) says
+        # can no longer be handled (see the module docstring)
+        for purpose, (timer_id, event) in list(self.timers.items()):
+            if event is not None and not handles(event):
+                self.cancel(purpose)
+                self.stale[purpose] += 1
+
+    def cancel_all(self):
+        for purpose in list(self.timers):
+            self.cancel(purpose)
+
+    @property
+    def pending(self):
+        return len(self.timers)
+
+    def pending_purposes(self):
+        return sorted(self.timers)
+
+    def report(self):
+        # A short summary for the terminal
+        lines = ["Timers:",
+                 f"{'Purpose':>20} | scheduled |  fired | cancelled | stale | duplicates"]
+        for purpose in sorted(self.scheduled):
+            lines.append(f"{purpose:>20} | {self.scheduled[purpose]:9d} | {self.fired[purpose]:6d} | "
+                         f"{self.cancelled[purpose]:9d} | {self.stale[purpose]:5d} | "
+                         f"{self.duplicates[purpose]:10d}")
+        lines.append(f"Still pending: {', '.join(self.pending_purposes()) or 'none'}")
+        return "\n".join(lines)
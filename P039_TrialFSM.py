@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Trial state machine
+
+The flow of every trial is a table of (state, event) -> (next state, action)
+for the session's training phase, compiled once when the session starts
+(compile_trial_table). Actions are MainScreen methods (ITI, sub_stage_one,
+provide_food, ...). Timers, pecks and the cameras only ever fire events;
+an action that decides what happens next (e.g., a peck that completes the
+ratio) fires an event too, which is queued and dispatched once the action
+has returned. So each event is one dictionary lookup, and actions never
+call each other (the call stack stays flat however long the session runs).
+
+    Pre-training (0) and mixed autoshaping/instrumental (1):
+
+        waiting --start--> ITI --ITI_elapsed--> trial_delay --delay_elapsed--> response
+        response --key_peck--> response (counts the peck; fires ratio_met at the RR)
+        response --ratio_met / auto_timer_elapsed--> reinforcement
+        reinforcement --hopper_timer_elapsed--> reinforcement (fires hopper_down once it is down)
+        reinforcement --hopper_down--> ITI
+        ITI --trials_completed--> ended
+
+    Choice task (2):
+
+        waiting --start--> ITI --ITI_elapsed--> choice
+            (when recording video, the cameras are started 3 s before the
+            end of the ITI (ITI --recording_due--> ITI), and the trial only
+            starts once the ITI is over and the cameras have started, in
+            either order:
+            ITI --cameras_started--> ITI_cameras_ready --ITI_elapsed--> choice
+            ITI --ITI_elapsed--> awaiting_cameras --cameras_started--> choice)
+        choice --key_peck--> choice (counts the peck; fires the choice's outcome at the FR)
+        choice --correct_choice--> reinforcement (then as above)
+        choice --incorrect_choice--> correction_timeout --timeout_elapsed--> choice
+        choice --free_choice--> ITI
+        ITI --trials_completed--> ended
+
+Every state goes to "ended" on "exit" (exit_program), where every event is
+ignored. Pecks to keys in states without keys on screen are ignored too.
+Any other event that arrives in a state without a transition for it is
+reported (and otherwise ignored) as unexpected. Whenever the state changes,
+on_state_change(state, next state) is called before the action runs (the
+MainScreen uses it to cancel timers that the new state has no use for, see
+P039_Timers.py).
+
+compile_trial_table() checks each table before the session starts: no
+duplicate or unknown transitions, an action for every action name, every
+state reachable from "waiting" and able to reach "ended". Every transition
+of every phase can be exercised, and dispatch timed, with:
+
+    python P039_Benchmarks.py trial_fsm
+"""
+
+from collections import Counter, deque
+from time import perf_counter_ns
+
+# Entry kinds
+TRANSITION = "transition"
+IGNORED = "ignored"
+UNEXPECTED = "unexpected"
+
+
+class TransitionTableError(ValueError):
+    # Raised when a phase's transition table doesn't check out
+    pass
+
+
+def trial_transitions(training_phase, record_video = False):
+    # The (state, event, next state, action) rows of a phase's table, and
+    # the (state, event) pairs that are ignored. Actions are the names of
+    # MainScreen methods (None to only change state); they are called with
+    # the event's arguments.
+    rows = [("waiting", "start", "ITI", "ITI")]
+    if training_phase in [0, 1]:
+        key_states = ["response"]
+        rows += [("ITI", "ITI_elapsed", "trial_delay", "sub_stage_one"),
+                 ("trial_delay", "delay_elapsed", "response", "sub_stage_two"),
+                 ("response", "key_peck", "response", "count_peck"),
+                 ("response", "ratio_met", "reinforcement", "reinforce_peck"),
+                 ("response", "auto_timer_elapsed", "reinforcement", "auto_reinforce")]
+    else:
+        key_states = ["choice"]
+        if record_video:
+            rows += [("ITI", "recording_due", "ITI", "start_trial_recording"),
+                     ("ITI", "ITI_elapsed", "awaiting_cameras", None),
+                     ("ITI", "cameras_started", "ITI_cameras_ready", None),
+                     ("awaiting_cameras", "cameras_started", "choice", "sub_stage_one"),
+                     ("ITI_cameras_ready", "ITI_elapsed", "choice", "sub_stage_one")]
+        else:
+            rows += [("ITI", "ITI_elapsed", "choice", "sub_stage_one")]
+        rows += [("choice", "key_peck", "choice", "count_choice_peck"),
+                 ("choice", "correct_choice", "reinforcement", "reward_correct_choice"),
+                 ("choice", "incorrect_choice", "correction_timeout", "correction_trial_TO"),
+                 ("choice", "free_choice", "ITI", "ITI"),
+                 ("correction_timeout", "timeout_elapsed", "choice", "sub_stage_one")]
+    rows += [("ITI", "trials_completed", "ended", "exit_program"),
+             ("reinforcement", "hopper_timer_elapsed", "reinforcement", "check_hopper"),
+             ("reinforcement", "hopper_down", "ITI", "end_reinforcement")]
+
+    states = table_states(rows)
+    events = sorted({row[1] for row in rows} | {"exit"})
+    # Any state can be ended...
+    rows += [(state, "exit", "ended", None) for state in states if state != "ended"]
+    # ...after which nothing happens, and pecks only count while keys are up
+    ignored = [("ended", event) for event in events]
+    ignored += [(state, "key_peck") for state in states
+                if state not in key_states and state != "ended"]
+    return rows, ignored
+
+
+def compile_trial_table(training_phase, record_video, handler):
+    # Returns {(state, event): (next state, bound action or None, kind)}
+    # covering every state and event of the phase, with actions looked up
+    # on handler (the MainScreen). Raises TransitionTableError if the table
+    # doesn't check out (see the module docstring).
+    rows, ignored = trial_transitions(training_phase, record_video)
+    states = table_states(rows)
+    events = sorted({row[1] for row in rows})
+
+    table = {}
+    for state, event, next_state, action_name in rows:
+        if (state, event) in table:
+            raise TransitionTableError(f"Phase {training_phase}: two transitions for {event} in {state}")
+        action = None
+        if action_name is not None:
+            action = getattr(handler, action_name, None)
+            if not callable(action):
+                raise TransitionTableError(f"Phase {training_phase}: no action {action_name}() "
+                                           f"for {event} in {state}")
+        table[(state, event)] = (next_state, action, TRANSITION)
+    for state, event in ignored:
+        if (state, event) in table:
+            raise TransitionTableError(f"Phase {training_phase}: {event} in {state} "
+                                       f"is both a transition and ignored")
+        if state not in states or event not in events:
+            raise TransitionTableError(f"Phase {training_phase}: ignores unknown {event} in {state}")
+        table[(state, event)] = (state, None, IGNORED)
+    for state in states:
+        for event in events:
+            table.setdefault((state, event), (state, None, UNEXPECTED))
+
+    # Every state must be reachable from "waiting"...
+    successors = {state: set() for state in states}
+    for (state, event), (next_state, action, kind) in table.items():
+        if kind == TRANSITION and next_state != state:
+            successors[state].add(next_state)
+    unreachable = set(states) - reachable_from("waiting", successors)
+    if unreachable:
+        raise TransitionTableError(f"Phase {training_phase}: can't reach {sorted(unreachable)}")
+    # ...and able to get to "ended"
+    stuck = [state for state in states if "ended" not in reachable_from(state, successors)]
+    if stuck:
+        raise TransitionTableError(f"Phase {training_phase}: can't end the session from {stuck}")
+    return table
+
+
+def table_states(rows):
+    # The states in a table's rows, in the order they first appear
+    states = []
+    for state, event, next_state, action in rows:
+        for s in [state, next_state]:
+            if s not in states:
+                states.append(s)
+    return states
+
+
+def reachable_from(state, successors):
+    # Every state that can be reached from state (including itself)
+    seen, to_visit = {state}, [state]
+    while to_visit:
+        for next_state in successors[to_visit.pop()]:
+            if next_state not in seen:
+                seen.add(next_state)
+                to_visit.append(next_state)
+    return seen
+
+
+class TrialStateMachine(object):
+    # Runs a compiled table. fire(event, *args) can be called from anywhere
+    # (timers, the touch handler, actions); events fired while another is
+    # being dispatched are queued and run, in order, once it has finished.
+    # on_transition(state, event, next state, ns) is called after every
+    # transition with how long it took, and on_state_change(state, next
+    # state) whenever the state changes (before the action).
+    def __init__(self, table, state = "waiting", on_transition = None,
+                 on_state_change = None):
+        self.table = table
+        self.state = state
+        self.on_transition = on_transition
+        self.on_state_change = on_state_change
+        self.queue = deque()
+        self.dispatching = False
+        self.unexpected = Counter() # (state, event) -> times
+
+    def fire(self, event, *args):
+        self.queue.append((event, args))
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.queue:
+                event, args = self.queue.popleft()
+                self.dispatch(event, args)
+        finally:
+            self.dispatching = False
+            self.queue.clear() # (only left over if an action raised)
+
+    def handles(self, event):
+        # Whether event would move the trial on in the current state
+        entry = self.table.get((self.state, event))
+        return entry is not None and entry[2] == TRANSITION
+
+    def dispatch(self, event, args):
+        state = self.state
+        try:
+            next_state, action, kind = self.table[(state, event)]
+        except KeyError:
+            raise ValueError(f"Unknown trial event: {event}") from None
+        if kind != TRANSITION:
+            if kind == UNEXPECTED:
+                self.unexpected[(state, event)] += 1
+                print(f"WARNING: unexpected {event} in trial state {state} (ignored)")
+            return
+        start_ns = perf_counter_ns()
+        self.state = next_state
+        if next_state != state and self.on_state_change is not None:
+            self.on_state_change(state, next_state)
+        if action is not None:
+            action(*args)
+        if self.on_transition is not None:
+            self.on_transition(state, event, next_state, perf_counter_ns() - start_ns)
+
+
+class TransitionTimes(object):
+    # The per-transition timing hook: count, mean and max time spent in
+    # each transition (its action and any timers it cancelled)
+    def __init__(self):
+        self.times = {} # (state, event, next state) -> [count, total ns, max ns]
+
+    def record(self, state, event, next_state, ns):
+        times = self.times.get((state, event, next_state))
+        if times is None:
+            self.times[(state, event, next_state)] = [1, ns, ns]
+        else:
+            times[0] += 1
+            times[1] += ns
+            if ns > times[2]:
+                times[2] = ns
+
+    def report(self):
+        # A short summary for the terminal, slowest (max) first
+        lines = ["Trial transitions (time per transition):",
+                 f"{'Transition':>52} |     n |  mean ms |   max ms"]
+        for (state, event, next_state), (count, total_ns, max_ns) in sorted(
+                self.times.items(), key = lambda item: -item[1][2]):
+            label = f"{state} --{event}--> {next_state}"
+            lines.append(f"{label:>52} | {count:5d} | {total_ns / count / 1e6:8.3f} | "
+                         f"{max_ns / 1e6:8.3f}")
+        return "\n".join(lines)
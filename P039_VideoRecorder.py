@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+P039 - Non-blocking video recording control
+
+The top and side cameras are started and stopped by two shell scripts
+(start_recording.sh and stop_recording.sh). These used to be called with
+subprocess.run() from inside the Tkinter loop, which froze the touchscreen
+and every timer for as long as the scripts took. The AsyncVideoRecorder
+launches the scripts in the background instead, checks on them every few
+milliseconds from the Tkinter loop, and calls back once each one finishes
+with how long it took (its latency).
+
+Commands are run one at a time in the order they were requested, so a
+"start" asked for while the previous trial's "stop" is still running simply
+waits for it.
+
+For testing on a computer without cameras, Video_Recording_Stub/ holds
+stand-in scripts that just wait a moment (P039_STUB_RECORDING_DELAY seconds,
+0.5 s by default) before returning.
+"""
+
+from collections import deque
+from subprocess import Popen, DEVNULL, TimeoutExpired
+from time import monotonic
+
+
+class AsyncVideoRecorder(object):
+    # schedule is a function(delay_ms, callback) used to check back on the
+    # running script (i.e., the Tkinter root's after() function). Every
+    # command's on_done callback is called exactly once, on the Tkinter
+    # thread, as on_done(succeeded, latency_ms, message).
+    def __init__(self, start_script, stop_script, schedule,
+                 poll_interval_ms = 20, timeout_ms = 10000):
+        self.start_script = start_script
+        self.stop_script = stop_script
+        self.schedule = schedule
+        self.poll_interval_ms = poll_interval_ms
+        self.timeout_ms = timeout_ms
+        self.pending = deque() # Commands waiting for the current one to finish
+        self.active = None # The command currently running
+        self.latencies = {"start": [], "stop": []} # Completed latencies (ms)
+
+    def start(self, top_file_path, side_file_path, on_done):
+        self.request("start", [self.start_script, top_file_path, side_file_path], on_done)
+
+    def stop(self, trial_num, on_done):
+        self.request("stop", [self.stop_script, str(trial_num)], on_done)
+
+    @property
+    def busy(self):
+        return self.active is not None or len(self.pending) > 0
+
+    def request(self, kind, args, on_done):
+        self.pending.append({"kind": kind, "args": args, "on_done": on_done,
+                             "requested": monotonic()})
+        if self.active is None:
+            self.launch_next()
+
+    def launch_next(self):
+        # Launches the next waiting command (if any) without waiting for it
+        while self.active is None and self.pending:
+            command = self.pending.popleft()
+            try:
+                command["process"] = Popen(command["args"],
+                                           stdin = DEVNULL)
+            except (FileNotFoundError, PermissionError) as e:
+                self.finish(command, False, f"cannot run {command['args'][0]} ({e})")
+                continue
+            command["reported"] = False
+            self.active = command
+            self.schedule(self.poll_interval_ms, lambda: self.poll(command))
+
+    def poll(self, command):
+        # Called from the Tkinter loop every poll_interval_ms while a script runs
+        if command is not self.active:
+            return # Already dealt with
+        return_code = command["process"].poll()
+        if return_code is not None:
+            self.active = None
+            if not command["reported"]:
+                self.finish(command, return_code == 0,
+                            "ok" if return_code == 0 else f"exit code {return_code}")
+            self.launch_next()
+            return
+        # Still running; report a timeout once (so the session can go on),
+        # but keep waiting for the script before launching the next one
+        if not command["reported"] and self.elapsed_ms(command) > self.timeout_ms:
+            self.finish(command, False, f"no response after {self.timeout_ms} ms")
+        self.schedule(self.poll_interval_ms, lambda: self.poll(command))
+
+    def finish(self, command, succeeded, message):
+        command["reported"] = True
+        latency_ms = self.elapsed_ms(command)
+        if succeeded:
+            self.latencies[command["kind"]].append(latency_ms)
+        command["on_done"](succeeded, latency_ms, message)
+
+    def elapsed_ms(self, command):
+        # Latency is measured from when the command was requested, so it
+        # includes any time spent waiting for the previous command
+        return round((monotonic() - command["requested"]) * 1000, 3)
+
+    def wait_until_idle(self, timeout_s = 15):
+        # Blocks until every requested command has finished. Only used when
+        # the session is ending (e.g., the Tkinter loop may already be gone).
+        deadline = monotonic() + timeout_s
+        while self.busy:
+            if self.active is None:
+                self.launch_next()
+                continue
+            try:
+                self.active["process"].wait(max(0, deadline - monotonic()))
+            except TimeoutExpired:
+                print("WARNING: video recording script still running at exit")
+                return False
+            self.poll(self.active)
+        return True
@@ -0,0 +1,7 @@
+#!/bin/sh
+# Stand-in for ~/Desktop/Video_Recording_Software/start_recording.sh on
+# computers without cameras. Takes the same arguments ($1 = top camera file,
+# $2 = side camera file) and waits P039_STUB_RECORDING_DELAY seconds (0.5 s
+# by default) to mimic the cameras starting up.
+sleep "${P039_STUB_RECORDING_DELAY:-0.5}"
+echo "[stub] recording started: $1 $2"
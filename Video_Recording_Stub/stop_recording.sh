@@ -0,0 +1,5 @@
+#!/bin/sh
+# Stand-in for ~/Desktop/Video_Recording_Software/stop_recording.sh on
+# computers without cameras ($1 = trial number).
+sleep "${P039_STUB_RECORDING_DELAY:-0.5}"
+echo "[stub] recording stopped (trial $1)"